@@ -0,0 +1,280 @@
+'''
+Benchmarks of the overhead of the pipeline itself, on synthetic cohorts.
+
+    crpipe benchmark --samples 100 1000 10000
+
+For each number of samples a cohort is generated in a directory of its
+own: a sample manifest, tiny FASTQ files, a reference and a configuration
+file. The external tools (bwa, samtools, delly and so on) are replaced by
+stubs which do nothing, or sleep for --stub_time seconds, and the jobs run
+on the mock cluster (see executor.py), so all that is measured is the
+pipeline:
+
+    build        seconds to read the configuration and the sample manifest,
+                 and build the pipeline graph
+    dry_run      seconds to check whether every job is up to date, as
+                 crpipe -n does
+    run          seconds to run every job, through the job engine, the run
+                 database and the logger, as crpipe does
+    jobs         jobs run by the pipeline
+    jobs/s       jobs dispatched per second of the run
+    peak_rss     the peak memory of the pipeline process, in MB
+
+Each cohort is measured by a process of its own, which runs this module
+as a program, so that the peak memory of one cohort doesn't hide that of
+the next. The stubs don't write the outputs of the jobs, so the task
+functions of the pipeline are made to touch them after each job, as
+ruffus does with --touch_files_only.
+'''
+
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import yaml
+
+
+# Numbers of samples in the cohorts, by default
+DEFAULT_SAMPLES = [100, 1000, 10000]
+# Pipeline threads, as with crpipe --use_threads --jobs N
+DEFAULT_JOBS = 200
+DEFAULT_BENCHMARK_DIR = 'crpipe_benchmark'
+# Verbosity of the dry run, which lists each job and whether it is up to date
+DRY_RUN_VERBOSE = 3
+# Read pairs in each synthetic FASTQ file
+READS_PER_FILE = 4
+READ_LENGTH = 100
+# External tools run by the stages, which are replaced by stubs
+STUB_TOOLS = ['bwa', 'samtools', 'sambamba', 'bedtools', 'bamtools',
+              'bcftools', 'lumpyexpress', 'svtyper', 'delly', 'fastqc',
+              'Socrates', 'java', 'bowtie2', 'bowtie2-build', 'pindel',
+              'gustaf_mate_joining', 'fastq_to_fasta']
+# Settings of the stages of the default pipeline
+BENCHMARK_STAGES = {
+    'fastqc': {},
+    'align_bwa': {'cores': 8, 'mem': 8},
+    'sort_bam_sambamba': {'cores': 4, 'mem': 16},
+    'extract_genes_bedtools': {'bed': 'genes.bed'},
+    'extract_chromosomes_samtools': {},
+    'index_bam': {},
+    'bamtools_stats': {},
+    'extract_discordant_alignments': {},
+    'extract_split_read_alignments': {},
+    'sort_bam': {},
+    'structural_variants_lumpy': {},
+    'structural_variants_socrates': {'jvm_mem': 4, 'bowtie2_ref_dir': 'reference/bowtie2'},
+    'structural_variants_delly': {'exclude': 'exclude.tsv', 'cores': 4},
+}
+# Allocations for packed jobs, with --pack
+BENCHMARK_PACK = {'cores': 16, 'mem': 64, 'walltime': '1:00', 'threshold': '1:00'}
+COLUMNS = ['samples', 'build', 'dry_run', 'run', 'jobs', 'jobs/s', 'peak_rss']
+
+
+def make_cohort(cohort_dir, samples, stub_time=0, array=False, pack=False):
+    '''Write a cohort of samples with tiny FASTQ files, and the reference,
+    stub tools and configuration file to run the pipeline on them'''
+    bases = 'ACGT' * (READ_LENGTH // 4)
+    read = '@read{{n}}/{{end}}\n{bases}\n+\n{quality}\n'.format(
+        bases=bases, quality='I' * len(bases))
+    with open(os.path.join(cohort_dir, 'samples.tsv'), 'w') as manifest:
+        manifest.write('sample\tfastq1\tfastq2\n')
+        for n in range(samples):
+            name = 'sample{}'.format(n)
+            sample_dir = os.path.join(cohort_dir, 'samples', name)
+            os.makedirs(sample_dir)
+            fastqs = []
+            for end in (1, 2):
+                path = os.path.join(sample_dir, '{}_R{}.fastq.gz'.format(name, end))
+                with gzip.open(path, 'wb') as fastq:
+                    for read_n in range(READS_PER_FILE):
+                        fastq.write(read.format(n=read_n, end=end))
+                fastqs.append(path)
+            manifest.write('{}\t{}\t{}\n'.format(name, fastqs[0], fastqs[1]))
+    os.makedirs(os.path.join(cohort_dir, 'reference'))
+    with open(os.path.join(cohort_dir, 'reference', 'genome.fa'), 'w') as reference:
+        reference.write('>chr1\n' + 'ACGT' * 250 + '\n')
+    for path in ['genes.bed', 'exclude.tsv']:
+        open(os.path.join(cohort_dir, path), 'w').close()
+    write_stubs(os.path.join(cohort_dir, 'stubs'), stub_time)
+    defaults = {'cores': 1, 'mem': 4, 'account': 'benchmark', 'queue': 'benchmark',
+                'walltime': '1:00', 'modules': [], 'local': False, 'array': array}
+    stages = dict(BENCHMARK_STAGES)
+    if pack:
+        stages['pack'] = BENCHMARK_PACK
+    config = {'pipeline_id': 'benchmark',
+              'defaults': defaults,
+              'stages': stages,
+              'reference': 'reference/genome.fa',
+              'manifest': 'samples.tsv',
+              'tmp': os.path.join(cohort_dir, 'tmp'),
+              'executor': 'mock',
+              'array_window': 1}
+    os.makedirs(config['tmp'])
+    with open(os.path.join(cohort_dir, 'pipeline.config'), 'w') as config_file:
+        yaml.safe_dump(config, config_file, default_flow_style=False)
+
+
+def write_stubs(stub_dir, stub_time):
+    '''Write a stub for each external tool, which sleeps for stub_time
+    seconds and succeeds'''
+    os.makedirs(stub_dir)
+    for tool in STUB_TOOLS:
+        path = os.path.join(stub_dir, tool)
+        with open(path, 'w') as stub:
+            stub.write('#!/bin/sh\n')
+            if stub_time:
+                stub.write('sleep {}\n'.format(stub_time))
+        os.chmod(path, 0755)
+
+
+def touch_outputs(pipeline):
+    '''Make the task functions of the pipeline touch the outputs of their
+    jobs, which the stub tools don't write'''
+    from ruffus.task import job_wrapper_io_files
+    for task in pipeline.tasks:
+        if task.job_wrapper is job_wrapper_io_files:
+            task.user_defined_work_func = touching(task.user_defined_work_func)
+
+
+def touching(task_func):
+    from ruffus.ruffus_utility import get_strings_in_flattened_sequence
+    def touch_after(*params):
+        result = task_func(*params)
+        for path in get_strings_in_flattened_sequence(params[1]):
+            if os.path.exists(path):
+                os.utime(path, None)
+            else:
+                open(path, 'a').close()
+        return result
+    return touch_after
+
+
+def measure(cohort_dir, jobs, run=True):
+    '''Build, check and run the pipeline on a cohort, in the cohort's
+    directory, returning the measurements'''
+    # main imports this module, as a subcommand
+    from main import parse_command_line, make_state
+    from config import Config
+    from logger import Logger
+    from pipeline import make_pipeline
+    from engine import THREAD_STACK_SIZE
+    import threading
+    import ruffus.cmdline as cmdline
+    os.chdir(cohort_dir)
+    os.environ['PATH'] = os.path.join(cohort_dir, 'stubs') + os.pathsep + os.environ['PATH']
+    options = parse_command_line(['--config', 'pipeline.config', '--use_threads',
+        '--jobs', str(jobs), '--log_file', 'pipeline.log', '--verbose', '0'])
+    logger = Logger(__name__, options.log_file, options.verbose)
+    start = time.time()
+    config = Config(options.config)
+    config.validate()
+    state = make_state(options, config, logger)
+    pipeline = make_pipeline(state)
+    build = time.time() - start
+    touch_outputs(pipeline)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        pipeline.printout(devnull, verbose=DRY_RUN_VERBOSE)
+    dry_run = time.time() - start
+    result = {'samples': len(config.get_samples()), 'build': build, 'dry_run': dry_run}
+    if run:
+        threading.stack_size(THREAD_STACK_SIZE)
+        start = time.time()
+        cmdline.run(options)
+        state.engine.stop()
+        logger.info(state.engine.executor.summary())
+        result['run'] = time.time() - start
+        result['jobs'] = state.engine.jobs_submitted
+        result['jobs/s'] = result['jobs'] / max(result['run'], 1e-6)
+    # ru_maxrss is in KB on Linux
+    result['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return result
+
+
+def benchmark_cohort(benchmark_dir, samples, options):
+    '''Generate a cohort, and measure the pipeline on it in a process of
+    its own'''
+    cohort_dir = os.path.abspath(tempfile.mkdtemp(
+        prefix='cohort_{}_'.format(samples), dir=benchmark_dir))
+    try:
+        make_cohort(cohort_dir, samples, options.stub_time, options.array, options.pack)
+        program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        args = [sys.executable, program, '--jobs', str(options.jobs), cohort_dir]
+        if options.no_run:
+            args.insert(2, '--no_run')
+        output = subprocess.check_output(args)
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        if not options.keep:
+            shutil.rmtree(cohort_dir, ignore_errors=True)
+
+
+def format_row(values):
+    return ' '.join('{:>10}'.format(value) for value in values)
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return str(value)
+
+
+def benchmark_command(args):
+    '''Measure the overhead of the pipeline on synthetic cohorts:
+    crpipe benchmark'''
+    parser = argparse.ArgumentParser(prog='crpipe benchmark',
+        description='Measure the overhead of the pipeline on synthetic cohorts')
+    parser.add_argument('--samples', type=int, nargs='+', default=DEFAULT_SAMPLES,
+        help='Numbers of samples in the cohorts, defaults to {}' \
+            .format(' '.join(map(str, DEFAULT_SAMPLES))))
+    parser.add_argument('--dir', type=str, default=DEFAULT_BENCHMARK_DIR,
+        help='Directory to generate the cohorts in, defaults to {}' \
+            .format(DEFAULT_BENCHMARK_DIR))
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+        help='Pipeline threads, defaults to {}'.format(DEFAULT_JOBS))
+    parser.add_argument('--stub_time', type=float, default=0,
+        help='Seconds each stub tool sleeps for, defaults to 0')
+    parser.add_argument('--array', action='store_true',
+        help='Submit the jobs of every stage as job arrays')
+    parser.add_argument('--pack', action='store_true',
+        help='Pack the jobs into shared allocations')
+    parser.add_argument('--no_run', action='store_true',
+        help='Only build the pipeline and check which jobs are up to date')
+    parser.add_argument('--keep', action='store_true',
+        help='Keep the cohorts, instead of removing them when they are measured')
+    options = parser.parse_args(args)
+    if not os.path.isdir(options.dir):
+        os.makedirs(options.dir)
+    print(format_row(COLUMNS))
+    for samples in options.samples:
+        result = benchmark_cohort(options.dir, samples, options)
+        print(format_row([format_value(result.get(column)) for column in COLUMNS]))
+        sys.stdout.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the pipeline on a cohort')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help='Pipeline threads')
+    parser.add_argument('--no_run', action='store_true', help="Don't run the jobs")
+    parser.add_argument('cohort_dir', help='Directory of the cohort, made by make_cohort')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    result = measure(args.cohort_dir, args.jobs, not args.no_run)
+    # ruffus and the logger may have written to stdout, the results are
+    # the last line
+    sys.stdout.write('\n' + json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
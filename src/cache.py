@@ -0,0 +1,277 @@
+'''
+A content addressed cache of the outputs of pipeline stages.
+
+The outputs of a job are stored under a key which is a hash of:
+    - the command, with the paths of its input and output files replaced
+      by placeholders, so the key does not depend on where the project is
+    - the checksums of the contents of its input files
+    - the modules loaded for the stage (a stand-in for tool versions)
+
+When a job with the same key is run again, in this project or another one,
+its outputs are linked from the cache instead of running the command.
+
+The cache directory looks like this:
+
+    cache_dir/index.db            sqlite index of entries and file checksums
+    cache_dir/objects/ab/abcd...  one directory per entry, holding the
+                                  output files, named by position
+
+The total size of the cache is bounded, entries are evicted in least
+recently used order.
+'''
+
+import os
+import errno
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import time
+import argparse
+from utils import safe_make_dir
+from config import Config, DEFAULT_CONFIG_FILE
+
+
+# Read files in 1MB blocks when computing checksums
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+# The cache size limit is configured in GB
+BYTES_IN_GIGABYTE = 1024 ** 3
+# Seconds to wait for another process to release a lock on the index
+INDEX_TIMEOUT = 60
+
+SCHEMA = '''
+create table if not exists entries (
+    key text primary key,
+    stage text,
+    size integer,
+    created real,
+    last_used real
+);
+create table if not exists checksums (
+    path text primary key,
+    size integer,
+    mtime real,
+    inode integer,
+    digest text
+);
+'''
+
+
+class OutputCache(object):
+    '''Store and restore the outputs of jobs, keyed on their contents'''
+    def __init__(self, cache_dir, max_size=None, link='hardlink'):
+        self.cache_dir = cache_dir
+        # maximum size of the cache in bytes, None means unbounded
+        self.max_size = max_size
+        # how to restore outputs: 'hardlink' (falling back to symlinks
+        # across filesystems) or 'symlink'
+        self.link = link
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, 'index.db')
+        # sqlite connections can't be shared between threads, so each
+        # operation opens its own, and this lock serialises them within
+        # the pipeline process
+        self.lock = threading.Lock()
+        safe_make_dir(self.objects_dir)
+        with self.index() as index:
+            index.executescript(SCHEMA)
+
+    def index(self):
+        '''A new connection to the cache index'''
+        return sqlite3.connect(self.index_path, timeout=INDEX_TIMEOUT)
+
+    def key(self, command, inputs, outputs, modules):
+        '''The cache key of a job'''
+        # Replace longer paths first, in case one path is a prefix of another
+        placeholders = [(path, '{{input{}}}'.format(n)) for n, path in enumerate(inputs)] + \
+                       [(path, '{{output{}}}'.format(n)) for n, path in enumerate(outputs)]
+        placeholders.sort(key=lambda item: len(item[0]), reverse=True)
+        for path, placeholder in placeholders:
+            command = command.replace(path, placeholder)
+        key = hashlib.sha1()
+        key.update(command)
+        for path in inputs:
+            key.update('\0' + self.checksum(path))
+        for module in modules or []:
+            key.update('\0' + module)
+        return key.hexdigest()
+
+    def checksum(self, path):
+        '''Checksum of the contents of a file, remembered in the index for
+        as long as the file's size, modification time and inode are the same'''
+        info = os.stat(path)
+        with self.lock:
+            with self.index() as index:
+                row = index.execute('select size, mtime, inode, digest from checksums '
+                    'where path = ?', (os.path.abspath(path),)).fetchone()
+        if row is not None and tuple(row[:3]) == (info.st_size, info.st_mtime, info.st_ino):
+            return row[3]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(CHECKSUM_BLOCK_SIZE), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        with self.lock:
+            with self.index() as index:
+                index.execute('insert or replace into checksums values (?, ?, ?, ?, ?)',
+                    (os.path.abspath(path), info.st_size, info.st_mtime, info.st_ino, digest))
+        return digest
+
+    def entry_dir(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def restore(self, key, outputs):
+        '''Link the cached outputs of a job into place. Return True if the
+        job was in the cache.'''
+        entry_dir = self.entry_dir(key)
+        cached = [os.path.join(entry_dir, str(n)) for n in range(len(outputs))]
+        if not all(os.path.exists(path) for path in cached):
+            return False
+        for cached_path, output in zip(cached, outputs):
+            remove_file(output)
+            self.link_file(cached_path, output)
+            # make the output look newer than its inputs
+            os.utime(output, None)
+        with self.lock:
+            with self.index() as index:
+                index.execute('update entries set last_used = ? where key = ?',
+                    (time.time(), key))
+        return True
+
+    def link_file(self, source, destination):
+        '''Link a cached file to an output path'''
+        if self.link == 'hardlink':
+            try:
+                os.link(source, destination)
+                return
+            except OSError as err:
+                # cache and project are on different filesystems
+                if err.errno != errno.EXDEV:
+                    raise
+        os.symlink(os.path.abspath(source), destination)
+
+    def store(self, key, stage, outputs):
+        '''Add the outputs of a successful job to the cache'''
+        entry_dir = self.entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        # A job which did not make all of its outputs can't be cached
+        if not all(os.path.isfile(output) for output in outputs):
+            return
+        safe_make_dir(os.path.dirname(entry_dir))
+        # Build the entry in a temporary directory and rename it into place,
+        # so a partly written entry is never seen
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key, dir=os.path.dirname(entry_dir))
+        size = 0
+        try:
+            for n, output in enumerate(outputs):
+                cached_path = os.path.join(tmp_dir, str(n))
+                try:
+                    os.link(output, cached_path)
+                except OSError:
+                    # output and cache are on different filesystems
+                    shutil.copy2(output, cached_path)
+                size += os.path.getsize(cached_path)
+            os.rename(tmp_dir, entry_dir)
+        except (IOError, OSError):
+            # another job stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if os.path.exists(entry_dir):
+                return
+            raise
+        now = time.time()
+        with self.lock:
+            with self.index() as index:
+                index.execute('insert or replace into entries values (?, ?, ?, ?, ?)',
+                    (key, stage, size, now, now))
+        if self.max_size is not None:
+            self.prune(self.max_size)
+
+    def entries(self):
+        '''All entries in the cache, most recently used first'''
+        with self.lock:
+            with self.index() as index:
+                return index.execute('select key, stage, size, created, last_used '
+                    'from entries order by last_used desc').fetchall()
+
+    def prune(self, max_size):
+        '''Evict least recently used entries until the cache is no larger
+        than max_size bytes. Return the evicted entries.'''
+        entries = self.entries()
+        total = sum(entry[2] for entry in entries)
+        evicted = []
+        while entries and total > max_size:
+            entry = entries.pop()
+            shutil.rmtree(self.entry_dir(entry[0]), ignore_errors=True)
+            total -= entry[2]
+            evicted.append(entry)
+        if evicted:
+            with self.lock:
+                with self.index() as index:
+                    index.executemany('delete from entries where key = ?',
+                        [(entry[0],) for entry in evicted])
+        return evicted
+
+
+def remove_file(path):
+    '''Remove a file if it exists'''
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def make_cache(config):
+    '''The output cache described by the configuration, or None if the
+    configuration does not define a cache_dir'''
+    cache_dir = config.get_optional_option('cache_dir')
+    if cache_dir is None:
+        return None
+    max_size = config.get_optional_option('cache_max_size')
+    if max_size is not None:
+        max_size = int(float(max_size) * BYTES_IN_GIGABYTE)
+    link = config.get_optional_option('cache_link', 'hardlink')
+    if link not in ('hardlink', 'symlink'):
+        raise Exception("Unknown cache_link: {}, expected hardlink or " \
+            "symlink in configuration file: {}".format(link, config.config_filename))
+    return OutputCache(cache_dir, max_size, link)
+
+
+def cache_command(args):
+    '''Inspect or prune the output cache: crpipe cache {list,prune}'''
+    parser = argparse.ArgumentParser(prog='crpipe cache',
+        description='Inspect or prune the pipeline output cache')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG_FILE,
+        help='Pipeline configuration file in YAML format, defaults to {}' \
+            .format(DEFAULT_CONFIG_FILE))
+    parser.add_argument('action', choices=['list', 'prune'],
+        help='list the cache entries, or prune the cache')
+    parser.add_argument('--max_size', type=float,
+        help='Size in GB to prune the cache to, defaults to cache_max_size ' \
+             'from the configuration file')
+    options = parser.parse_args(args)
+    config = Config(options.config)
+    cache = make_cache(config)
+    if cache is None:
+        raise Exception("Configuration file {} does not have 'cache_dir' " \
+            "field".format(options.config))
+    if options.action == 'list':
+        entries = cache.entries()
+        for key, stage, size, created, last_used in entries:
+            print('{}\t{}\t{:.3f}GB\t{}'.format(key, stage,
+                float(size) / BYTES_IN_GIGABYTE, time.ctime(last_used)))
+        total = sum(entry[2] for entry in entries)
+        print('{} entries, {:.3f}GB'.format(len(entries), float(total) / BYTES_IN_GIGABYTE))
+    else:
+        if options.max_size is not None:
+            max_size = int(options.max_size * BYTES_IN_GIGABYTE)
+        elif cache.max_size is not None:
+            max_size = cache.max_size
+        else:
+            raise Exception("Give --max_size or set cache_max_size in the " \
+                "configuration file")
+        evicted = cache.prune(max_size)
+        print('Evicted {} entries, {:.3f}GB'.format(len(evicted),
+            float(sum(entry[2] for entry in evicted)) / BYTES_IN_GIGABYTE))
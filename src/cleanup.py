@@ -0,0 +1,292 @@
+'''
+Automatic cleanup of intermediate files.
+
+The unsorted alignment, the unsorted discordant and split-read
+alignments, the extracted chromosomes and the per-region results of
+scattered stages are only read by the next stage or two, but are kept
+forever, so a cohort needs several times the storage of its final
+results. With the "cleanup" option, an intermediate file is removed as
+soon as every job which reads it has finished. The option is a list of
+rules, tried in order, and the first rule whose pattern matches a file
+decides what happens to it:
+
+    cleanup:
+        - pattern: '*.sorted.bam'
+          action: keep
+        - pattern: '*.unsorted.bam'
+          action: delete
+        - pattern: '*.bam'
+          action: move
+          destination: /cold/storage/crpipe
+
+A pattern without a / is matched against the file name, otherwise against
+the whole path. The actions are keep (the default for files which match
+no rule), delete, and move, which copies the file under destination
+(keeping its path, so files with the same name don't collide) and then
+removes it.
+
+Which jobs read each file is learnt from the pipeline graph when the
+pipeline is built. Files which no job reads, such as the final results,
+are never removed, and nor are the files read by jobs which are found by
+wildcards when they run (the chunks of a chunked alignment).
+
+Removed files are recorded in the run database. When the cleanup is on,
+the up to date checks of ruffus treat a removed file as if it were still
+there, as long as every job which reads it is up to date, so removing a
+file does not make the job which made it run again. If a job which reads
+a removed file does need to run, a moved file is copied back first, and a
+deleted file is made again by running the job which made it.
+'''
+
+import os
+import shutil
+import fnmatch
+import threading
+from functools import wraps
+from collections import namedtuple
+from statcache import check_times
+from utils import file_names, safe_make_dir
+
+
+CleanupRule = namedtuple("CleanupRule", ["pattern", "action", "destination"])
+
+ACTIONS = ['keep', 'delete', 'move']
+
+
+class Cleanup(object):
+    '''Remove intermediate files once every job which reads them has
+    finished'''
+    def __init__(self, rules, rundb, logger=None, stat_cache=None):
+        self.rules = rules
+        self.rundb = rundb
+        self.logger = logger
+        self.stat_cache = stat_cache
+        self.lock = threading.Lock()
+        # job key -> (inputs, outputs) of each job of the pipeline
+        self.jobs = {}
+        # path -> keys of the jobs which read the file
+        self.readers = {}
+        # path -> keys of the jobs which read the file and have not finished
+        self.waiting = {}
+        # path -> (modification time, destination) of the removed files
+        self.retired = {}
+        # the outputs of the jobs which ruffus has recorded as finished,
+        # or None if ruffus keeps no job history
+        self.history = None
+
+    def track(self, jobs, history=None):
+        '''Learn which jobs read the files to be cleaned up, from the
+        (stage, [(inputs, outputs)]) of each stage of the pipeline, and the
+        job history of ruffus. Returns the stages which read or make those
+        files.'''
+        stages = set()
+        with self.lock:
+            self.jobs, self.readers = {}, {}
+            for stage, stage_jobs in jobs:
+                for inputs, outputs in stage_jobs:
+                    key = job_key(inputs, outputs)
+                    self.jobs[key] = (inputs, outputs)
+                    for path in inputs:
+                        if self.rule(path).action != 'keep':
+                            self.readers.setdefault(path, set()).add(key)
+                            stages.add(stage)
+            for stage, stage_jobs in jobs:
+                if any(path in self.readers for _, outputs in stage_jobs
+                       for path in outputs):
+                    stages.add(stage)
+            self.waiting = dict((path, set(keys)) for path, keys in self.readers.items())
+        self.retired = self.rundb.retired_files()
+        self.history = history
+        return stages
+
+    def rule(self, path):
+        '''The first rule which matches a file'''
+        for rule in self.rules:
+            if '/' in rule.pattern:
+                name = os.path.abspath(path)
+            else:
+                name = os.path.basename(path)
+            if fnmatch.fnmatch(name, rule.pattern):
+                return rule
+        return CleanupRule(None, 'keep', None)
+
+    def file_mtime(self, path):
+        '''The modification time of a file which exists, or None'''
+        if self.stat_cache is not None:
+            return self.stat_cache.mtime(path)
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def mtime(self, path, assumed=frozenset()):
+        '''The modification time of a file, or of a removed file if it is
+        as good as there (None otherwise). Removed files in assumed are
+        taken to be there.'''
+        mtime = self.file_mtime(path)
+        if mtime is not None or path not in self.retired:
+            return mtime
+        retired_mtime, destination = self.retired[path]
+        if path in assumed:
+            return retired_mtime
+        if destination is not None:
+            # it can be copied back if a job needs it
+            return retired_mtime if os.path.exists(destination) else None
+        return retired_mtime if self.satisfied(path, assumed) else None
+
+    def satisfied(self, path, assumed=frozenset()):
+        '''Whether every job which reads a removed file is up to date, when
+        the file is taken to be there'''
+        assumed = assumed | set([path])
+        for key in self.readers.get(path, []):
+            inputs, outputs = self.jobs[key]
+            needs_update, _ = check_times(inputs, outputs,
+                lambda name: self.mtime(name, assumed), self.history)
+            if needs_update:
+                return False
+        return True
+
+    def needs_update(self, *params):
+        '''Whether a ruffus job needs to run, with removed files counting
+        as there. For Task.check_if_uptodate.'''
+        inputs = file_names(params[0]) if params else []
+        outputs = file_names(params[1]) if len(params) > 1 else []
+        return check_times(inputs, outputs, self.mtime, self.history)
+
+    def wrap(self, task_func):
+        '''Wrap the function of a ruffus task: its removed inputs are put
+        back before a job runs, and the inputs which no other job needs
+        are removed after it succeeds'''
+        @wraps(task_func)
+        def run_job(*params):
+            inputs = file_names(params[0]) if params else []
+            outputs = file_names(params[1]) if len(params) > 1 else []
+            self.restore(inputs)
+            result = task_func(*params)
+            with self.lock:
+                # The outputs were made again, so every job which reads
+                # them will run again
+                for path in outputs:
+                    if path in self.readers:
+                        self.waiting[path] = set(self.readers[path])
+            for path in self.finished(job_key(inputs, outputs)):
+                self.retire(path)
+            return result
+        return run_job
+
+    def finished(self, key):
+        '''Note that a job has finished with its inputs. Returns the inputs
+        which no other job is waiting for.'''
+        done = []
+        if key not in self.jobs:
+            return done
+        with self.lock:
+            for path in self.jobs[key][0]:
+                waiting = self.waiting.get(path)
+                if waiting is None:
+                    continue
+                waiting.discard(key)
+                if not waiting:
+                    done.append(path)
+        return done
+
+    def finish(self):
+        '''Remove every file which no job is waiting for, including those
+        whose readers were all up to date. Called after a successful run.'''
+        # A job which is up to date won't read its inputs again
+        with self.lock:
+            keys = set(key for waiting in self.waiting.values() for key in waiting)
+        for key in keys:
+            inputs, outputs = self.jobs[key]
+            needs_update, _ = check_times(inputs, outputs, self.mtime, self.history)
+            if not needs_update:
+                self.finished(key)
+        with self.lock:
+            done = [path for path, waiting in self.waiting.items() if not waiting]
+        for path in done:
+            self.retire(path)
+
+    def retire(self, path):
+        '''Delete a file, or move it to cold storage, as its rule says'''
+        rule = self.rule(path)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            # removed already
+            return
+        destination = None
+        if rule.action == 'move':
+            destination = cold_path(rule.destination, path)
+            copy_file(path, destination)
+        os.remove(path)
+        self.rundb.record_retired(path, mtime, destination)
+        self.retired[path] = (mtime, destination)
+        if self.stat_cache is not None:
+            self.stat_cache.invalidate([path])
+        if self.logger is not None:
+            if destination is None:
+                self.logger.info('Cleanup: deleted {}'.format(path))
+            else:
+                self.logger.info('Cleanup: moved {} to {}'.format(path, destination))
+
+    def restore(self, paths):
+        '''Copy back the moved files among paths, for a job which reads them'''
+        for path in paths:
+            retired = self.retired.get(path)
+            if retired is None or retired[1] is None or os.path.exists(path):
+                continue
+            copy_file(retired[1], path)
+            os.remove(retired[1])
+            self.rundb.forget_retired(path)
+            self.retired.pop(path, None)
+            if self.stat_cache is not None:
+                self.stat_cache.invalidate([path])
+            if self.logger is not None:
+                self.logger.info('Cleanup: restored {} from {}'.format(path, retired[1]))
+
+
+def job_key(inputs, outputs):
+    '''A name for a job which is the same in the pipeline graph and when
+    the job runs'''
+    return tuple(outputs) if outputs else ('',) + tuple(inputs)
+
+
+def cold_path(destination, path):
+    '''Where a file is moved to under destination'''
+    return os.path.join(destination, os.path.abspath(path).lstrip('/'))
+
+
+def copy_file(source, target):
+    '''Copy a file (keeping its modification time) under a temporary name,
+    then rename it into place, so that a partial copy is never taken for
+    the file'''
+    safe_make_dir(os.path.dirname(os.path.abspath(target)))
+    shutil.copy2(source, target + '.crpipe_part')
+    os.rename(target + '.crpipe_part', target)
+
+
+def read_rules(rules):
+    '''The cleanup rules of the configuration file'''
+    result = []
+    for rule in rules:
+        if not isinstance(rule, dict) or 'pattern' not in rule:
+            raise Exception("Cleanup rule: {} does not have a pattern".format(rule))
+        action = rule.get('action', 'delete')
+        if action not in ACTIONS:
+            raise Exception("Cleanup rule for: {} has unknown action: {}, " \
+                "expected one of: {}".format(rule['pattern'], action, ', '.join(ACTIONS)))
+        destination = rule.get('destination')
+        if action == 'move' and destination is None:
+            raise Exception("Cleanup rule for: {} moves files, but does not " \
+                "have a destination".format(rule['pattern']))
+        result.append(CleanupRule(rule['pattern'], action, destination))
+    return result
+
+
+def make_cleanup(config, rundb, logger=None, stat_cache=None):
+    '''The cleanup of intermediate files, or None if the configuration does
+    not have any cleanup rules'''
+    rules = config.get_optional_option('cleanup')
+    if not rules:
+        return None
+    return Cleanup(read_rules(rules), rundb, logger, stat_cache)
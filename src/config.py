@@ -8,6 +8,27 @@ TODO: validation of config file input.
 '''
 
 import yaml
+from manifest import read_manifest, samples_from_fastqs
+# The C parser of libyaml is much faster, if PyYAML was built with it
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+# default name of the pipeline configuration file
+DEFAULT_CONFIG_FILE = 'pipeline.config'
+# formats of the sorted alignments, for the alignment_format option
+ALIGNMENT_FORMATS = ['bam', 'cram']
+# ways of checking the quality of the FASTQ files, for the qc option
+QC_MODES = ['fastqc', 'native', 'tap']
+# backends which run the jobs, for the executor option
+EXECUTORS = ['drmaa', 'local', 'mock']
+# stages whose tools write files they are not given the paths of (indexes
+# next to their inputs, outputs named from a prefix), which would be lost
+# with the private directory of the scratch option
+NO_SCRATCH_STAGES = ['index_bam', 'sort_bam', 'index_reference_bwa',
+                     'index_reference_samtools', 'index_reference_bowtie2',
+                     'merge_delly_calls']
 
 
 class Config(object):
@@ -15,12 +36,16 @@ class Config(object):
         # Try to open and parse the YAML formatted config file
         with open(config_filename) as config_file:
             try:
-                config = yaml.load(config_file)
+                config = yaml.load(config_file, Loader=Loader)
             except yaml.YAMLError, exc:
                 print("Error in configuration file:", exc)
                 raise exc
         self.config = config
         self.config_filename = config_filename
+        # The sample manifest is read once, here
+        self.manifest = None
+        if 'manifest' in config:
+            self.manifest = read_manifest(config['manifest'])
 
     def get_options(self, *options):
         num_options = len(options)
@@ -37,6 +62,11 @@ class Config(object):
             raise Exception("Unknown option: {}, not in configuration " \
                 "file: {}".format(option, self.config_filename))
 
+    def get_optional_option(self, option, default=None):
+        '''Retrieve a global option from the configuration, or the default
+        value if the configuration does not define it'''
+        return self.config.get(option, default)
+
     def get_stage_options(self, stage, *options):
         num_options = len(options)
         if num_options == 1:
@@ -70,6 +100,38 @@ class Config(object):
             raise Exception("Unknown stage: {}, not in configuration " \
                 "file: {}".format(stage, self.config_filename))
 
+    def get_optional_stage_option(self, stage, option, default=None):
+        '''Retrieve a configuration option for a particular stage, falling
+        back to the defaults like get_stage_option. Return the default value
+        instead of raising an exception if the option is not defined
+        anywhere.
+        '''
+        this_stage = self.config['stages'].get(stage) or {}
+        if option in this_stage:
+            return this_stage[option]
+        defaults = self.config['defaults'] or {}
+        return defaults.get(option, default)
+
+    def get_samples(self, fastq_files=None):
+        '''The samples to run the pipeline on: the ones in the given FASTQ
+        files, or in the sample manifest, or in the fastqs option'''
+        if fastq_files is None and self.manifest is not None:
+            return list(self.manifest)
+        if fastq_files is None:
+            fastq_files = self.get_option('fastqs')
+        return samples_from_fastqs(fastq_files,
+            self.get_optional_option('read_groups'))
+
+    def get_read_group(self, sample):
+        '''The read group of a sample, from the sample manifest or else the
+        read_groups option'''
+        if self.manifest is not None and sample in self.manifest.by_name:
+            return self.manifest.get(sample).read_group
+        read_groups = self.get_optional_option('read_groups') or {}
+        if sample in read_groups:
+            return read_groups[sample]
+        raise Exception("No read group for sample: {} in configuration " \
+            "file: {}".format(sample, self.config_filename))
 
     def validate(self):
         '''Check that the configuration is valid.'''
@@ -79,8 +141,38 @@ class Config(object):
         check_required_field(config, filename, 'defaults')
         check_required_field(config, filename, 'reference')
         check_required_field(config, filename, 'stages')
-        check_required_field(config, filename, 'fastqs')
+        # In watch mode the FASTQ files are found as they arrive, and a
+        # sample manifest lists them instead
+        if 'watch' not in config and 'manifest' not in config:
+            check_required_field(config, filename, 'fastqs')
         check_required_field(config, filename, 'pipeline_id')
+        alignment_format = config.get('alignment_format', 'bam')
+        if alignment_format not in ALIGNMENT_FORMATS:
+            raise Exception("Configuration file {} has unknown alignment_format: " \
+                "{}, expected one of: {}".format(filename, alignment_format,
+                ', '.join(ALIGNMENT_FORMATS)))
+        qc = config.get('qc', 'fastqc')
+        if qc not in QC_MODES:
+            raise Exception("Configuration file {} has unknown qc: " \
+                "{}, expected one of: {}".format(filename, qc, ', '.join(QC_MODES)))
+        workers = config.get('decompress_workers')
+        if workers is not None and (not isinstance(workers, int) or workers < 1):
+            raise Exception("Configuration file {} has decompress_workers: {}, " \
+                "expected a positive number".format(filename, workers))
+        executor = config.get('executor', 'drmaa')
+        if executor not in EXECUTORS:
+            raise Exception("Configuration file {} has unknown executor: " \
+                "{}, expected one of: {}".format(filename, executor, ', '.join(EXECUTORS)))
+        no_scratch = list(NO_SCRATCH_STAGES)
+        # delly indexes the BCF files of incremental calling by itself
+        if self.get_optional_stage_option('structural_variants_delly', 'incremental'):
+            no_scratch.append('structural_variants_delly')
+        for stage in no_scratch:
+            if self.get_optional_stage_option(stage, 'scratch') is not None:
+                raise Exception("Configuration file {} gives stage: {} a scratch " \
+                    "directory, but its tool writes files which would be lost " \
+                    "there (give the stage scratch: null to override the " \
+                    "defaults)".format(filename, stage))
 
 
 
@@ -0,0 +1,390 @@
+'''
+Job engine: submits pipeline jobs to the cluster (through DRMAA) or runs
+them as local processes, and tracks them until they finish.
+
+Ruffus calls each stage function in its own worker thread. Rather than
+each of those threads driving its own DRMAA submission and blocking wait,
+the threads hand their jobs to the engine and sleep until the job is done.
+A single engine thread owns the DRMAA session: it submits queued jobs,
+then reaps whichever jobs have finished, in bulk, using a wait on any job
+in the session. The session (and the drmaa module, which loads the DRMAA
+library) is only opened when the first cluster job is submitted, so dry
+runs and local jobs don't touch the cluster. Local jobs are child
+processes which the same thread polls. They are only started when their
+cores and memory fit in what is left of the budget for the local machine,
+and are pinned to their own processors.
+The engine therefore only holds a small record for each job in flight,
+and a single pipeline process can keep thousands of jobs in the queue.
+
+Cluster jobs of stages with the "array" option are not submitted straight
+away. The engine collects the jobs of the same stage which arrive within
+a short window and submits them together as one job array (a DRMAA bulk
+job). Each task of the array runs the job script of one of the jobs, and
+is tracked by the engine like any other job, so each task still succeeds
+or fails on its own.
+
+Short cluster jobs of stages which are packed are collected in the same
+way, and submitted together as one allocation, in which the packer runs
+as many of them at a time as fit (see packer.py).
+
+What runs the jobs is up to an executor (see executor.py). The engine
+thread calls a DRMAA executor for the cluster jobs and a local executor
+for the local jobs, unless the executor option chooses another one for
+the cluster jobs, such as the mock cluster used for testing.
+'''
+
+import os
+import stat
+import time
+import datetime
+import tempfile
+import threading
+from collections import deque
+from packer import write_pack_manifest, pack_command, status_path, read_status
+from executor import DrmaaExecutor, LocalExecutor
+
+
+# Seconds to wait for a job to finish before checking for new submissions
+POLL_INTERVAL = 1
+# Seconds to collect the jobs of a stage before submitting them as an array
+ARRAY_WINDOW = 10
+# Maximum number of tasks in one job array
+MAX_ARRAY_SIZE = 1000
+# Stack size for threads, small because pipeline worker threads only wait
+# for their jobs, and there may be thousands of them
+THREAD_STACK_SIZE = 512 * 1024
+
+
+class JobError(Exception):
+    '''A job failed to run, or finished with an error'''
+    pass
+
+
+class Job(object):
+    '''A command to run, and its outcome once it has finished'''
+    def __init__(self, command, name, options='', local=False, array=False,
+            pack=False, cores=1, mem=0, walltime=0, priority=0):
+        self.command = command
+        self.name = name
+        # native options for the cluster scheduler
+        self.options = options
+        # run on the local machine instead of on the cluster
+        self.local = local
+        # submit in a job array with other jobs of the same stage
+        self.array = array
+        # run in an allocation with other short jobs
+        self.pack = pack
+        # resources of the job, memory in MB and walltime in minutes
+        self.cores = cores
+        self.mem = mem
+        self.walltime = walltime
+        # jobs with a higher priority are started first
+        self.priority = priority
+        # the jobs run by an allocation of packed jobs
+        self.members = []
+        self.script_path = None
+        self.stdout_path = None
+        self.stderr_path = None
+        self.job_id = None
+        self.exit_status = None
+        self.signal = None
+        self.aborted = False
+        # peak_rss (MB), cpu_time (seconds), start_time and end_time, as
+        # far as they are known
+        self.resource_usage = {}
+        self.submit_time = None
+        self.start_time = None
+        self.end_time = None
+        # exception raised while trying to run the job
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        '''Wait for the job to finish'''
+        # Waiting with a timeout keeps the thread responsive to Ctrl-C
+        while not self.done.wait(POLL_INTERVAL):
+            pass
+
+    def failed(self):
+        return self.error is not None or self.aborted or \
+            self.signal is not None or self.exit_status != 0
+
+    def result(self):
+        '''The (stdout, stderr) lines of a finished job. Raises JobError if
+        the job failed.'''
+        if self.error is not None:
+            raise JobError('The job could not be run: {}\nThe job script was: {}' \
+                .format(self.error, self.script_path))
+        stdout, stderr = read_lines(self.stdout_path), read_lines(self.stderr_path)
+        if not self.failed():
+            return stdout, stderr
+        if self.aborted:
+            reason = 'The job was aborted before it ran'
+        elif self.signal is not None:
+            reason = 'The job was terminated by signal {}'.format(self.signal)
+        else:
+            reason = 'The job exited with status {}'.format(self.exit_status)
+        raise JobError('\n'.join([reason,
+            'The job id was: {}'.format(self.job_id),
+            'The job script was: {}'.format(self.script_path),
+            'The stderr was:', ''.join(stderr),
+            'The stdout was:', ''.join(stdout)]))
+
+
+class JobEngine(object):
+    '''Runs jobs on the cluster or locally, tracking all of them from one
+    thread'''
+    def __init__(self, executor, job_script_dir, poll_interval=POLL_INTERVAL,
+            array_window=ARRAY_WINDOW, max_array_size=MAX_ARRAY_SIZE,
+            packing=None, local_budget=None):
+        # cores and memory for local jobs (a ResourceBudget), None if
+        # local jobs are not limited
+        self.local_budget = local_budget
+        # The executor of the jobs which are not local, submitting them to
+        # the cluster through DRMAA unless another one is given. Local jobs
+        # share it if it runs jobs locally too.
+        if executor is None:
+            executor = DrmaaExecutor(job_script_dir)
+        self.executor = executor
+        if isinstance(executor, LocalExecutor):
+            self.local = executor
+        else:
+            self.local = LocalExecutor(local_budget)
+        self.job_script_dir = job_script_dir
+        self.poll_interval = poll_interval
+        self.array_window = array_window
+        self.max_array_size = max_array_size
+        # resources of the allocations for packed jobs, None if jobs are
+        # never packed
+        self.packing = packing
+        # Protects the submission queue, which is the only state shared
+        # with the pipeline threads. Everything else belongs to the
+        # engine thread.
+        self.condition = threading.Condition()
+        self.submit_queue = deque()
+        self.stopping = False
+        self.thread = None
+        # number of jobs submitted by the pipeline
+        self.jobs_submitted = 0
+        # (stage name, job options) -> (time of first job, [Job]) for
+        # jobs waiting to be submitted in an array
+        self.arrays = {}
+        # (time of first job, [Job]) for jobs waiting to be packed
+        self.packed = None
+
+    def run(self, job):
+        '''Run a job and wait for it to finish. Returns (stdout, stderr),
+        raises JobError if the job failed.'''
+        self.submit(job)
+        job.wait()
+        return job.result()
+
+    def submit(self, job):
+        '''Queue a job to be started by the engine thread'''
+        write_job_script(job, self.job_script_dir)
+        job.submit_time = time.time()
+        with self.condition:
+            self.submit_queue.append(job)
+            self.jobs_submitted += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name='crpipe-engine')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def stop(self):
+        '''Stop the engine thread once all jobs in flight have finished'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.close()
+
+    def busy(self):
+        return self.submit_queue or self.executor.busy() or self.local.busy() or \
+            self.arrays or self.packed
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.busy() and not self.stopping:
+                    self.condition.wait()
+                if self.stopping and not self.busy():
+                    return
+                submissions = sorted(self.submit_queue, key=lambda job: -job.priority)
+                self.submit_queue.clear()
+            for job in submissions:
+                if job.pack and not job.local and self.packing is not None and \
+                        self.packing.fits(job):
+                    self.add_to_pack(job)
+                elif job.array and not job.local:
+                    self.add_to_array(job)
+                else:
+                    self.start_job(job)
+            self.start_arrays()
+            self.start_pack()
+            # local processes are polled
+            for job in self.local.reap(0):
+                self.finish(job)
+            if self.executor is not self.local and self.executor.busy():
+                # waits for up to poll_interval
+                for job in self.executor.reap(self.poll_interval):
+                    self.finish(job)
+            elif self.local.busy() or self.arrays or self.packed:
+                with self.condition:
+                    if not self.submit_queue:
+                        self.condition.wait(self.poll_interval)
+
+    def start_job(self, job):
+        executor = self.local if job.local else self.executor
+        try:
+            executor.start(job)
+        except Exception as err:
+            job.error = err
+            self.finish(job)
+
+    def add_to_array(self, job):
+        key = (job.name, job.options)
+        if key not in self.arrays:
+            self.arrays[key] = (time.time(), [])
+        jobs = self.arrays[key][1]
+        jobs.append(job)
+        # The scheduler rejects arrays larger than its maximum, so a full
+        # array is submitted straight away, and the next job starts another
+        if len(jobs) >= self.max_array_size:
+            del self.arrays[key]
+            self.start_array(jobs)
+
+    def start_arrays(self):
+        '''Submit the arrays which are full, or have waited long enough for
+        more jobs to arrive'''
+        now = time.time()
+        for key, (start_time, jobs) in list(self.arrays.items()):
+            if self.stopping or len(jobs) >= self.max_array_size or \
+                    now - start_time >= self.array_window:
+                del self.arrays[key]
+                self.start_array(jobs)
+
+    def start_array(self, jobs):
+        if len(jobs) == 1:
+            self.start_job(jobs[0])
+            return
+        try:
+            self.executor.start_array(jobs)
+        except Exception as err:
+            for job in jobs:
+                job.error = err
+                self.finish(job)
+
+    def add_to_pack(self, job):
+        # A job which would overfill the allocation goes in the next one
+        if self.packed is not None and not self.packing.has_room(self.packed[1], job):
+            self.submit_pack()
+        if self.packed is None:
+            self.packed = (time.time(), [])
+        self.packed[1].append(job)
+        if self.packing.full(self.packed[1]):
+            self.submit_pack()
+
+    def start_pack(self):
+        '''Submit the packed jobs in an allocation when there are enough of
+        them to fill it, or they have waited long enough for more jobs'''
+        if self.packed is None:
+            return
+        start_time, jobs = self.packed
+        if not (self.stopping or self.packing.full(jobs) or
+                time.time() - start_time >= self.array_window):
+            return
+        self.submit_pack()
+
+    def submit_pack(self):
+        '''Submit the packed jobs in an allocation'''
+        _, jobs = self.packed
+        self.packed = None
+        if len(jobs) == 1:
+            self.start_job(jobs[0])
+            return
+        try:
+            manifest = write_pack_manifest(jobs, self.job_script_dir)
+        except (IOError, OSError) as err:
+            for job in jobs:
+                job.error = err
+                self.finish(job)
+            return
+        allocation = Job(pack_command(manifest, self.packing), 'pack',
+            options=self.packing.options, cores=self.packing.cores,
+            mem=self.packing.mem, walltime=self.packing.walltime)
+        allocation.members = jobs
+        write_job_script(allocation, self.job_script_dir)
+        allocation.submit_time = time.time()
+        self.start_job(allocation)
+
+    def finish(self, job):
+        job.end_time = time.time()
+        if job.members:
+            self.finish_members(job)
+        job.done.set()
+
+    def finish_members(self, allocation):
+        '''Record the outcome of each job run by a finished allocation'''
+        # After a successful allocation every job has an exit status, which
+        # may take a moment to appear on a shared filesystem
+        tries = 5 if not allocation.failed() else 1
+        for job in allocation.members:
+            job.job_id = allocation.job_id
+            if allocation.error is not None:
+                job.error = allocation.error
+                self.finish(job)
+                continue
+            status = read_lines(status_path(job.script_path), tries)
+            if not status:
+                job.error = 'the job did not finish in its allocation, ' \
+                    'whose job script was: {}'.format(allocation.script_path)
+            else:
+                exit_status, job.resource_usage = read_status(status)
+                if exit_status < 0:
+                    job.signal = -exit_status
+                else:
+                    job.exit_status = exit_status
+            self.finish(job)
+
+
+def write_job_script(job, job_script_dir):
+    '''Write the command of a job to a shell script, which is kept in
+    job_script_dir for diagnostic purposes, along with its stdout and
+    stderr'''
+    try:
+        os.makedirs(job_script_dir)
+    except OSError:
+        # ignore errors rather than test for existence to avoid races
+        pass
+    time_stamp = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    script = tempfile.NamedTemporaryFile(mode='w', dir=job_script_dir,
+        prefix='{}_{}__'.format(job.name, time_stamp), suffix='.sh', delete=False)
+    with script:
+        script.write('#!/bin/sh\n')
+        script.write('#job_name={}\n'.format(job.name))
+        if job.options and not job.local:
+            script.write('#job_other_options={}\n'.format(job.options))
+        script.write(job.command + '\n')
+    job.script_path = os.path.abspath(script.name)
+    job.stdout_path = job.script_path + '.stdout'
+    job.stderr_path = job.script_path + '.stderr'
+    os.chmod(job.script_path, stat.S_IRWXU | stat.S_IRWXG)
+
+
+def read_lines(path, tries=5):
+    '''The lines of a job's output file. The file may take a moment to
+    appear on a shared filesystem after the job has finished.'''
+    if path is None:
+        return []
+    for attempt in range(tries):
+        if attempt > 0:
+            time.sleep(1)
+        try:
+            with open(path) as output:
+                return output.readlines()
+        except IOError:
+            pass
+    return []
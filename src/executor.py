@@ -0,0 +1,451 @@
+'''
+Executors: the backends which run the jobs of the job engine.
+
+The job engine decides when jobs are submitted, and collects them into job
+arrays and packed allocations. An executor runs them, and reports when
+they have finished. The executor which runs the jobs which are not local
+is chosen by the executor option:
+
+- drmaa (the default) submits them to the cluster through DRMAA
+- local runs them as processes on the local machine, as many at a time as
+  fit in local_cores and local_mem, so the pipeline runs without a cluster
+- mock runs them on a cluster simulated in the pipeline process, whose
+  nodes and queue are described by the mock_* options
+
+Jobs of stages with "local: True" always run as local processes.
+
+Every executor has the same methods, which are called from the engine
+thread: start(job) starts a job, or raises an exception if it can't;
+start_array(jobs) starts the jobs of a stage as one job array (or one by
+one if the executor has no arrays); reap(timeout) returns the jobs which
+have finished, with their outcome recorded, waiting up to timeout seconds
+for the first one; busy() tells whether any job is waiting or running;
+close() releases the executor once all of its jobs have finished; and
+summary() gives a message about the jobs it has run, or None.
+
+The mock cluster is for testing and measuring the pipeline itself: how
+fast jobs are submitted, and how packing and job arrays change the use of
+the nodes, with graphs of thousands of samples, on a laptop. Its jobs run
+their job scripts as local processes, so the tools are usually replaced
+by stubs, but each one holds cores and memory on a simulated node, and
+waits in a simulated queue before it starts.
+'''
+
+import os
+import stat
+import time
+import datetime
+import tempfile
+import subprocess
+from resources import ResourceBudget, limit_command, usage_from_rusage, \
+    usage_from_drmaa
+
+
+# Nodes of the mock cluster, and the cores and memory (in MB) of each one
+MOCK_NODES = 10
+MOCK_NODE_CORES = 32
+MOCK_NODE_MEM = 256 * 1024
+# Seconds between checks for finished processes on the mock cluster
+MOCK_POLL_INTERVAL = 0.01
+
+
+class DrmaaExecutor(object):
+    '''Submits jobs to the cluster through DRMAA, reaping the finished ones
+    in bulk by waiting on any job in the session. The session (and the
+    drmaa module, which loads the DRMAA library) is only opened when the
+    first job is submitted.'''
+    def __init__(self, job_script_dir, session=None):
+        self.job_script_dir = job_script_dir
+        # A session opened by the executor is closed by close
+        self.drmaa_session = session
+        self.drmaa = None
+        self.owns_session = False
+        # cluster job id -> Job
+        self.jobs = {}
+
+    def session(self):
+        '''The DRMAA session, opened the first time it is needed'''
+        if self.drmaa is None:
+            import drmaa
+            self.drmaa = drmaa
+        if self.drmaa_session is None:
+            self.drmaa_session = self.drmaa.Session()
+            self.drmaa_session.initialize()
+            self.owns_session = True
+        return self.drmaa_session
+
+    def busy(self):
+        return bool(self.jobs)
+
+    def close(self):
+        if self.owns_session:
+            self.drmaa_session.exit()
+            self.drmaa_session = None
+            self.owns_session = False
+
+    def summary(self):
+        return None
+
+    def job_template(self, name, options, script_path, stdout_path, stderr_path):
+        template = self.session().createJobTemplate()
+        template.workingDirectory = os.getcwd()
+        template.jobName = name
+        template.nativeSpecification = options
+        template.remoteCommand = script_path
+        template.args = []
+        template.joinFiles = False
+        # drmaa paths are specified as [hostname]:file_path
+        template.outputPath = ':' + stdout_path
+        template.errorPath = ':' + stderr_path
+        return template
+
+    def start(self, job):
+        template = self.job_template(job.name, job.options, job.script_path,
+            job.stdout_path, job.stderr_path)
+        try:
+            job.job_id = self.drmaa_session.runJob(template)
+        finally:
+            self.drmaa_session.deleteJobTemplate(template)
+        self.jobs[job.job_id] = job
+
+    def start_array(self, jobs):
+        '''Submit the jobs as a DRMAA bulk job, each task of which runs the
+        job script of one of the jobs'''
+        script_path = write_array_script(jobs, self.job_script_dir)
+        # Each task gets its own input file, holding the path of the job
+        # script it runs, and its own stdout and stderr
+        session = self.session()
+        task_path = script_path + '.' + self.drmaa.JobTemplate.PARAMETRIC_INDEX
+        template = self.job_template(jobs[0].name, jobs[0].options,
+            script_path, task_path + '.stdout', task_path + '.stderr')
+        try:
+            template.inputPath = ':' + task_path + '.task'
+            job_ids = session.runBulkJobs(template, 1, len(jobs), 1)
+        finally:
+            session.deleteJobTemplate(template)
+        for job_id, job in zip(job_ids, jobs):
+            job.job_id = job_id
+            self.jobs[job_id] = job
+
+    def reap(self, timeout):
+        finished = []
+        while self.jobs:
+            try:
+                info = self.drmaa_session.wait(self.drmaa.Session.JOB_IDS_SESSION_ANY, timeout)
+            except self.drmaa.ExitTimeoutException:
+                break
+            except self.drmaa.errors.DrmaaException:
+                # Some DRMs can't report on a finished job (for example PBS
+                # error code 24), fall back to asking about each job
+                finished.extend(self.poll(timeout))
+                break
+            timeout = self.drmaa.Session.TIMEOUT_NO_WAIT
+            job = self.jobs.pop(info.jobId, None)
+            if job is None:
+                continue
+            job.aborted = info.wasAborted
+            if info.hasSignal:
+                job.signal = info.terminatedSignal
+            job.exit_status = info.exitStatus
+            job.resource_usage = usage_from_drmaa(info.resourceUsage or {}, time.time())
+            finished.append(job)
+        return finished
+
+    def poll(self, interval):
+        '''Check the status of each job in flight'''
+        finished = []
+        for job_id, job in list(self.jobs.items()):
+            try:
+                status = self.drmaa_session.jobStatus(job_id)
+            except self.drmaa.errors.DrmaaException as err:
+                status, job.error = self.drmaa.JobState.FAILED, err
+            if status == self.drmaa.JobState.DONE:
+                job.exit_status = 0
+            elif status == self.drmaa.JobState.FAILED:
+                job.exit_status = job.exit_status or 1
+            else:
+                continue
+            del self.jobs[job_id]
+            finished.append(job)
+        time.sleep(interval)
+        return finished
+
+
+class LocalExecutor(object):
+    '''Runs jobs as child processes of the pipeline. They are only started
+    when their cores and memory fit in what is left of the budget for the
+    local machine (if there is one), and are pinned to their own
+    processors. The processes are polled, so reap does not wait.'''
+    def __init__(self, budget=None):
+        # cores and memory for the jobs (a ResourceBudget), None if the
+        # jobs are not limited
+        self.budget = budget
+        # process id -> (Job, Popen, Grant)
+        self.processes = {}
+        # jobs waiting for their resources
+        self.queue = []
+
+    def busy(self):
+        return bool(self.processes or self.queue)
+
+    def start(self, job):
+        '''Add a job to the queue, behind the jobs with the same or a
+        higher priority'''
+        position = len(self.queue)
+        while position > 0 and self.queue[position - 1].priority < job.priority:
+            position -= 1
+        self.queue.insert(position, job)
+
+    def start_array(self, jobs):
+        '''Local jobs have no arrays, the jobs are queued one by one'''
+        for job in jobs:
+            self.start(job)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return None
+
+    def reap(self, timeout):
+        finished = self.reap_processes()
+        finished.extend(self.start_waiting())
+        return finished
+
+    def start_waiting(self):
+        '''Start the waiting jobs which fit in the budget, in order of
+        priority, then of submission. Smaller jobs may start ahead of a job
+        which does not fit yet. Returns the jobs which could not be
+        started.'''
+        failed = []
+        for job in list(self.queue):
+            grant = None
+            if self.budget is not None:
+                grant = self.budget.try_acquire(job.cores, job.mem)
+                if grant is None:
+                    continue
+            self.queue.remove(job)
+            try:
+                self.start_process(job, grant)
+            except Exception as err:
+                if grant is not None:
+                    self.budget.release(grant)
+                job.error = err
+                failed.append(job)
+        return failed
+
+    def start_process(self, job, grant):
+        args, env = ['/bin/sh', job.script_path], None
+        if grant is not None:
+            args, env = limit_command(args, grant)
+        process = start_process(job, args, env)
+        self.processes[process.pid] = (job, process, grant)
+
+    def reap_processes(self):
+        finished = []
+        for pid, (job, process, grant) in list(self.processes.items()):
+            if not reap_process(job, process):
+                continue
+            del self.processes[pid]
+            if grant is not None:
+                self.budget.release(grant)
+            finished.append(job)
+        return finished
+
+
+class MockCluster(object):
+    '''A cluster simulated in the pipeline process, with a number of nodes
+    of the same cores and memory (in MB). Each submission (of a job, or of
+    a job array) keeps the engine thread busy for submit_latency seconds,
+    as a call to a real scheduler does. A job waits in the queue for
+    queue_latency seconds after it is submitted, then starts on the first
+    node where it fits, in order of submission, except that smaller jobs
+    may start ahead of a job which does not fit yet. It runs its job
+    script as a local process, and holds its node for at least runtime
+    seconds, which stands in for the run time of the real tool.'''
+    def __init__(self, nodes=MOCK_NODES, cores=MOCK_NODE_CORES, mem=MOCK_NODE_MEM,
+            queue_latency=0, submit_latency=0, runtime=0):
+        self.nodes = [ResourceBudget(cores, mem) for _ in range(nodes)]
+        self.node_cores = cores
+        self.node_mem = mem
+        self.queue_latency = queue_latency
+        self.submit_latency = submit_latency
+        self.runtime = runtime
+        # (time the job may start, Job), in order of submission
+        self.queue = []
+        # process id -> (Job, Popen, node, Grant)
+        self.processes = {}
+        # (time the job finishes, Job, node, Grant) for jobs whose
+        # process has finished before their runtime is up
+        self.finishing = []
+        self.next_id = 1
+        # for the summary
+        self.submissions = 0
+        self.jobs_run = 0
+        self.queue_wait = 0.0
+        self.busy_cores = 0
+        self.peak_cores = 0
+        self.first_submit_time = None
+
+    def busy(self):
+        return bool(self.queue or self.processes or self.finishing)
+
+    def start(self, job):
+        self.submit([job])
+
+    def start_array(self, jobs):
+        self.submit(jobs)
+
+    def submit(self, jobs):
+        for job in jobs:
+            if job.cores > self.node_cores or job.mem > self.node_mem:
+                raise Exception("Job asks for {} cores and {}MB, more than a node " \
+                    "of the mock cluster: {} cores and {}MB".format(job.cores,
+                    job.mem, self.node_cores, self.node_mem))
+        if self.submit_latency:
+            time.sleep(self.submit_latency)
+        now = time.time()
+        if self.first_submit_time is None:
+            self.first_submit_time = now
+        self.submissions += 1
+        for job in jobs:
+            job.job_id = 'mock.{}'.format(self.next_id)
+            self.next_id += 1
+            self.queue.append((now + self.queue_latency, job))
+
+    def reap(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            finished = self.reap_processes()
+            finished.extend(self.start_waiting())
+            if finished or not self.busy():
+                return finished
+            now = time.time()
+            if now >= deadline:
+                return finished
+            # sleep until the next job may start or finish
+            wake = [deadline, now + MOCK_POLL_INTERVAL]
+            wake.extend(start_time for start_time, _ in self.queue[:1] if start_time > now)
+            wake.extend(finish_time for finish_time, _, _, _ in self.finishing)
+            time.sleep(max(min(wake) - now, 0))
+
+    def start_waiting(self):
+        '''Start the queued jobs whose queue latency is up on the first
+        node they fit on. Returns the jobs which could not be started.'''
+        failed = []
+        now = time.time()
+        for item in list(self.queue):
+            start_time, job = item
+            if start_time > now:
+                # the rest of the queue was submitted later
+                break
+            for node in self.nodes:
+                grant = node.try_acquire(job.cores, job.mem)
+                if grant is not None:
+                    break
+            else:
+                continue
+            self.queue.remove(item)
+            try:
+                process = start_process(job, ['/bin/sh', job.script_path], None)
+            except Exception as err:
+                node.release(grant)
+                job.error = err
+                failed.append(job)
+                continue
+            self.processes[process.pid] = (job, process, node, grant)
+            self.jobs_run += 1
+            self.queue_wait += job.start_time - job.submit_time
+            self.busy_cores += grant.cores
+            self.peak_cores = max(self.peak_cores, self.busy_cores)
+        return failed
+
+    def reap_processes(self):
+        now = time.time()
+        for pid, (job, process, node, grant) in list(self.processes.items()):
+            if reap_process(job, process):
+                del self.processes[pid]
+                self.finishing.append((job.start_time + self.runtime, job, node, grant))
+        finished = []
+        for item in list(self.finishing):
+            finish_time, job, node, grant = item
+            if finish_time > now:
+                continue
+            self.finishing.remove(item)
+            node.release(grant)
+            self.busy_cores -= grant.cores
+            job.resource_usage['end_time'] = max(finish_time,
+                job.resource_usage.get('end_time', now))
+            finished.append(job)
+        return finished
+
+    def close(self):
+        pass
+
+    def summary(self):
+        if not self.jobs_run:
+            return None
+        elapsed = max(time.time() - self.first_submit_time, 1e-6)
+        total_cores = self.node_cores * len(self.nodes)
+        return '\n'.join(['Mock cluster: {} nodes of {} cores'.format(
+                              len(self.nodes), self.node_cores),
+                          'Jobs run: {}'.format(self.jobs_run),
+                          'Submissions: {}'.format(self.submissions),
+                          'Jobs per second: {:.1f}'.format(self.jobs_run / elapsed),
+                          'Mean queue wait: {:.2f}s'.format(self.queue_wait / self.jobs_run),
+                          'Peak cores in use: {} of {}'.format(self.peak_cores, total_cores)])
+
+
+def start_process(job, args, env):
+    '''Run the job script of a job as a child process'''
+    with open(job.stdout_path, 'w') as stdout, open(job.stderr_path, 'w') as stderr:
+        process = subprocess.Popen(args, env=env, stdout=stdout,
+            stderr=stderr, close_fds=True)
+    if job.job_id is None:
+        job.job_id = process.pid
+    job.start_time = time.time()
+    return process
+
+
+def reap_process(job, process):
+    '''Record the outcome of a job's process if it has finished, and
+    return whether it has'''
+    # wait4 gives the resource usage of the process, unlike poll
+    finished, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    if finished == 0:
+        return False
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # stop subprocess from trying to reap the process again
+    process.returncode = returncode
+    job.resource_usage = usage_from_rusage(rusage)
+    if returncode < 0:
+        job.signal = -returncode
+    else:
+        job.exit_status = returncode
+    return True
+
+
+def write_array_script(jobs, job_script_dir):
+    '''Write the script run by each task of a job array, and the input
+    files of the tasks, numbered from 1. The script runs the job script
+    named in its input, which keeps its usual stdout and stderr files.'''
+    time_stamp = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    script = tempfile.NamedTemporaryFile(mode='w', dir=job_script_dir,
+        prefix='{}_array_{}__'.format(jobs[0].name, time_stamp), suffix='.sh',
+        delete=False)
+    with script:
+        script.write('#!/bin/sh\n')
+        script.write('#job_name={}\n'.format(jobs[0].name))
+        if jobs[0].options:
+            script.write('#job_other_options={}\n'.format(jobs[0].options))
+        script.write('read script\n')
+        script.write('exec /bin/sh "$script" < /dev/null > "$script.stdout" 2> "$script.stderr"\n')
+    script_path = os.path.abspath(script.name)
+    os.chmod(script_path, stat.S_IRWXU | stat.S_IRWXG)
+    for task, job in enumerate(jobs, 1):
+        with open('{}.{}.task'.format(script_path, task), 'w') as task_file:
+            task_file.write(job.script_path + '\n')
+    return script_path
@@ -0,0 +1,311 @@
+'''
+Quality summary of FASTQ files, without a JVM per file.
+
+The fastqc stage starts Java for each FASTQ file, as a separate job, to
+compute what are mostly counts: the number of reads, the distributions
+of read length, GC content and mean quality, and the quality and number
+of Ns at each position. This module computes them in a single job for
+both files of a sample, and is run as a program:
+
+    python fastq_qc.py --json S.qc.json --tsv S.qc.tsv S_R1.fastq.gz S_R2.fastq.gz
+
+Each file is read by its own worker process. The reads are handled in
+batches, as arrays of bases and quality scores if numpy is installed (and
+one read at a time otherwise). The summary of each file is written to the
+JSON file, and one line per file with the headline numbers to the TSV
+file.
+
+With --tap PATH (once per file) each worker also writes the decompressed
+FASTQ to PATH, usually a named pipe read by the aligner, so that the
+files are only read once when the QC is done during the alignment.
+'''
+
+import os
+import sys
+import json
+import signal
+import argparse
+import subprocess
+from multiprocessing import Pool
+from fastq_reader import fastq_reader_args
+# The reads are summarised a batch at a time with numpy where it is
+# available, which is much faster than one read at a time. It is imported
+# by main, so that the pipeline, which imports this module to build the
+# command of the program, doesn't load it.
+numpy = None
+
+
+# Bytes of FASTQ read at a time
+BLOCK_SIZE = 4 * 1024 * 1024
+# Seconds to wait for the workers, a timeout makes the wait interruptible
+WORKER_TIMEOUT = 7 * 24 * 3600
+# Quality scores are ASCII characters from this offset (Sanger, Illumina 1.8+)
+QUALITY_OFFSET = 33
+# Largest quality score counted in the distribution of mean read quality
+MAX_QUALITY = 93
+# Bases with at least this quality are counted as Q30 in the TSV summary
+Q30 = 30
+TSV_COLUMNS = ['file', 'reads', 'bases', 'mean_length', 'gc_percent',
+               'mean_quality', 'q30_percent']
+
+
+class FastqStats(object):
+    '''Summary statistics of the reads of a FASTQ file'''
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.gc_bases = 0
+        self.q30_bases = 0
+        self.quality_total = 0
+        # read length -> number of reads
+        self.lengths = {}
+        # sum of the qualities, and number of Ns, at each position
+        self.position_quality = []
+        self.position_n = []
+        # number of reads covering each position
+        self.position_reads = []
+        # number of reads with each GC percent, and each mean quality
+        self.gc_distribution = [0] * 101
+        self.quality_distribution = [0] * (MAX_QUALITY + 1)
+
+    def grow(self, length):
+        '''Make room for the positions of reads of a length'''
+        extra = length - len(self.position_reads)
+        if extra > 0:
+            self.position_quality.extend([0] * extra)
+            self.position_n.extend([0] * extra)
+            self.position_reads.extend([0] * extra)
+
+    def add(self, sequences, qualities):
+        '''Add a batch of reads'''
+        if numpy is not None:
+            self.add_arrays(sequences, qualities)
+        else:
+            for sequence, quality in zip(sequences, qualities):
+                self.add_read(sequence, quality)
+
+    def add_read(self, sequence, quality):
+        '''Add one read, without numpy'''
+        length = len(sequence)
+        self.grow(length)
+        self.reads += 1
+        self.bases += length
+        self.lengths[length] = self.lengths.get(length, 0) + 1
+        gc = sequence.count('G') + sequence.count('C') + \
+            sequence.count('g') + sequence.count('c')
+        self.gc_bases += gc
+        total = 0
+        for position, char in enumerate(quality):
+            score = ord(char) - QUALITY_OFFSET
+            total += score
+            self.position_quality[position] += score
+            self.position_reads[position] += 1
+            if score >= Q30:
+                self.q30_bases += 1
+        for position, base in enumerate(sequence):
+            if base == 'N' or base == 'n':
+                self.position_n[position] += 1
+        self.quality_total += total
+        if length:
+            self.gc_distribution[(gc * 100 + length // 2) // length] += 1
+            self.quality_distribution[min((total + length // 2) // length, MAX_QUALITY)] += 1
+
+    def add_arrays(self, sequences, qualities):
+        '''Add a batch of reads, as arrays of reads of the same length'''
+        if len(set(map(len, sequences))) == 1:
+            batches = [(sequences, qualities)]
+        else:
+            by_length = {}
+            for sequence, quality in zip(sequences, qualities):
+                batch = by_length.setdefault(len(sequence), ([], []))
+                batch[0].append(sequence)
+                batch[1].append(quality)
+            batches = by_length.values()
+        for batch_sequences, batch_qualities in batches:
+            length = len(batch_sequences[0])
+            count = len(batch_sequences)
+            self.reads += count
+            self.bases += length * count
+            self.lengths[length] = self.lengths.get(length, 0) + count
+            if length == 0:
+                continue
+            self.grow(length)
+            bases = numpy.frombuffer(''.join(batch_sequences), dtype=numpy.uint8) \
+                .reshape(count, length) | 0x20
+            scores = numpy.frombuffer(''.join(batch_qualities), dtype=numpy.uint8) \
+                .reshape(count, length).astype(numpy.int64) - QUALITY_OFFSET
+            # bases are lower case after | 0x20
+            gc = ((bases == ord('g')) | (bases == ord('c'))).sum(axis=1)
+            totals = scores.sum(axis=1)
+            self.gc_bases += int(gc.sum())
+            self.q30_bases += int((scores >= Q30).sum())
+            self.quality_total += int(totals.sum())
+            for position, value in enumerate(scores.sum(axis=0)):
+                self.position_quality[position] += int(value)
+            for position, value in enumerate((bases == ord('n')).sum(axis=0)):
+                self.position_n[position] += int(value)
+            for position in range(length):
+                self.position_reads[position] += count
+            for percent, value in enumerate(numpy.bincount(
+                    (gc * 100 + length // 2) // length, minlength=101)):
+                self.gc_distribution[percent] += int(value)
+            mean_qualities = numpy.minimum((totals + length // 2) // length, MAX_QUALITY)
+            for score, value in enumerate(numpy.bincount(mean_qualities,
+                                                         minlength=MAX_QUALITY + 1)):
+                self.quality_distribution[score] += int(value)
+
+    def summary(self, path):
+        '''The statistics, for the JSON summary'''
+        quality_distribution = list(self.quality_distribution)
+        while quality_distribution and quality_distribution[-1] == 0:
+            quality_distribution.pop()
+        return {
+            'file': path,
+            'reads': self.reads,
+            'bases': self.bases,
+            'gc_percent': percent(self.gc_bases, self.bases),
+            'mean_quality': ratio(self.quality_total, self.bases),
+            'q30_percent': percent(self.q30_bases, self.bases),
+            'length_distribution': dict((str(length), count)
+                for length, count in sorted(self.lengths.items())),
+            'position_mean_quality': [ratio(total, reads) for total, reads
+                in zip(self.position_quality, self.position_reads)],
+            'position_n_percent': [percent(n, reads) for n, reads
+                in zip(self.position_n, self.position_reads)],
+            'gc_distribution': self.gc_distribution,
+            'mean_quality_distribution': quality_distribution,
+        }
+
+
+def ratio(numerator, denominator):
+    return round(float(numerator) / denominator, 2) if denominator else 0.0
+
+
+def percent(numerator, denominator):
+    return ratio(100 * numerator, denominator)
+
+
+def open_fastq(path, workers=1):
+    '''Open a FASTQ file for reading, decompressing it in another process
+    if it is gzipped, with a number of worker processes'''
+    if path.endswith('.gz'):
+        if workers > 1:
+            args = fastq_reader_args([path], workers)
+        else:
+            args = ['gzip', '-dc', path]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+        return process.stdout, process
+    return open(path, 'rb'), None
+
+
+def read_batches(stream, tap=None):
+    '''The (sequences, qualities) of the reads in a FASTQ stream, a block
+    at a time. The stream is copied to tap as it is read.'''
+    pending = ''
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        if not block:
+            break
+        if tap is not None:
+            tap.write(block)
+        lines = (pending + block).split('\n')
+        # The last line may be incomplete, and so may the last record
+        complete = (len(lines) - 1) // 4 * 4
+        pending = '\n'.join(lines[complete:])
+        yield lines[1:complete:4], lines[3:complete:4]
+    lines = pending.split('\n')
+    if len(lines) >= 4:
+        yield [lines[1]], [lines[3]]
+
+
+def fastq_stats(args):
+    '''Summarise a FASTQ file, copying it to tap if that is not None.
+    Runs in a worker process.'''
+    path, tap_path, workers = args
+    stream, process = open_fastq(path, workers)
+    tap = open(tap_path, 'wb', BLOCK_SIZE) if tap_path is not None else None
+    stats = FastqStats()
+    try:
+        for sequences, qualities in read_batches(stream, tap):
+            stats.add(sequences, qualities)
+    finally:
+        stream.close()
+        if tap is not None:
+            tap.close()
+    if process is not None and process.wait() != 0:
+        raise Exception("Failed to decompress FASTQ file: {}".format(path))
+    return stats.summary(path)
+
+
+def write_tsv(summaries, tsv_out):
+    '''One line with the headline numbers of each file'''
+    with open(tsv_out, 'w') as tsv:
+        tsv.write('\t'.join(TSV_COLUMNS) + '\n')
+        for summary in summaries:
+            mean_length = ratio(summary['bases'], summary['reads'])
+            tsv.write('\t'.join(str(value) for value in [summary['file'],
+                summary['reads'], summary['bases'], mean_length,
+                summary['gc_percent'], summary['mean_quality'],
+                summary['q30_percent']]) + '\n')
+
+
+def qc_tsv(json_out):
+    '''The TSV summary which goes with a JSON summary'''
+    return os.path.splitext(json_out)[0] + '.tsv'
+
+
+def fastq_qc_command(fastqs, json_out, tsv_out, taps=None, workers=None):
+    '''The command which summarises FASTQ files, writing the decompressed
+    FASTQ to the taps if they are given. Each file is decompressed with
+    the given number of worker processes.'''
+    program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    tap_args = ''.join(' --tap {}'.format(tap) for tap in taps or [])
+    worker_args = ' --workers {}'.format(workers) if workers else ''
+    return '{python} {program} --json {json} --tsv {tsv}{taps}{workers} {fastqs}' \
+        .format(python=sys.executable, program=program, json=json_out,
+                tsv=tsv_out, taps=tap_args, workers=worker_args,
+                fastqs=' '.join(fastqs))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Summarise the quality of FASTQ files')
+    parser.add_argument('--json', required=True, help='JSON summary of each file')
+    parser.add_argument('--tsv', required=True, help='Headline numbers of each file')
+    parser.add_argument('--tap', action='append', default=[],
+        help='Copy the decompressed FASTQ to this file (once per FASTQ file)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='Worker processes decompressing each BGZF file')
+    parser.add_argument('fastqs', nargs='+', help='FASTQ files, optionally gzipped')
+    return parser.parse_args()
+
+
+def main():
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    args = parse_args()
+    if args.tap and len(args.tap) != len(args.fastqs):
+        raise Exception("--tap is needed once for each FASTQ file")
+    taps = args.tap or [None] * len(args.fastqs)
+    # A job script kills the QC if the aligner reading the taps fails, and
+    # the workers (which may be waiting for the aligner to open the taps)
+    # are stopped as the program exits
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    # The files are read in parallel, and all at once if they are tapped,
+    # as the aligner reads the taps together
+    pool = Pool(len(args.fastqs))
+    try:
+        summaries = pool.map_async(fastq_stats,
+            zip(args.fastqs, taps, [args.workers] * len(args.fastqs))) \
+            .get(WORKER_TIMEOUT)
+    finally:
+        pool.close()
+    with open(args.json, 'w') as json_file:
+        json.dump({'files': summaries}, json_file, sort_keys=True)
+    write_tsv(summaries, args.tsv)
+
+
+if __name__ == '__main__':
+    main()
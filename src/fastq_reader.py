@@ -0,0 +1,231 @@
+'''
+Read gzipped FASTQ files with more than one core, and feed read pairs to
+the aligner through a pipe.
+
+zcat, and bwa itself, decompress a .fastq.gz file with a single thread,
+which limits how fast bwa can align on a node with many cores. This
+module is run as a program which writes the decompressed FASTQ to its
+output:
+
+    python fastq_reader.py --workers 4 --interleave S_R1.fastq.gz S_R2.fastq.gz | bwa mem -p ...
+
+A file compressed with bgzip (BGZF) is a series of gzip members of up to
+64KB, whose sizes are in their headers, so it is cut into chunks of
+members without decompressing it, and the chunks are decompressed by a
+pool of worker processes, in order. The members of other gzip files can't
+be found without decompressing them, so they are decompressed by gzip
+in a process of their own, which still takes the work away from the
+aligner. With --interleave the records of a pair of files are written in
+turn, one from each, as bwa mem -p reads them.
+'''
+
+import os
+import sys
+import zlib
+import struct
+import argparse
+import subprocess
+from collections import deque
+from multiprocessing import Pool
+
+
+# Bytes read or written at a time
+BLOCK_SIZE = 4 * 1024 * 1024
+# Bytes of compressed BGZF members given to a worker at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+# Chunks being decompressed per worker, which bounds the memory used
+CHUNKS_PER_WORKER = 2
+# gzip header: magic, compression method, flags, mtime, extra flags, OS
+GZIP_HEADER = struct.Struct('<BBBBIBB')
+GZIP_MAGIC = (0x1f, 0x8b)
+# Flag of a gzip header with an extra field
+FEXTRA = 4
+# zlib window bits for decompressing a gzip member
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def is_bgzf(path):
+    '''Whether a file is compressed with BGZF, from the header of its first
+    member'''
+    with open(path, 'rb') as fastq:
+        header = fastq.read(GZIP_HEADER.size + 2)
+        if len(header) < GZIP_HEADER.size + 2:
+            return False
+        id1, id2, _, flags, _, _, _ = GZIP_HEADER.unpack(header[:GZIP_HEADER.size])
+        if (id1, id2) != GZIP_MAGIC or not flags & FEXTRA:
+            return False
+        extra_length, = struct.unpack('<H', header[GZIP_HEADER.size:])
+        return bgzf_block_size(fastq.read(extra_length)) is not None
+
+
+def bgzf_block_size(extra):
+    '''The size of a BGZF member from the extra field of its header, or
+    None if it is not there'''
+    offset = 0
+    while offset + 4 <= len(extra):
+        tag, length = extra[offset:offset + 2], struct.unpack('<H', extra[offset + 2:offset + 4])[0]
+        if tag == 'BC' and length == 2:
+            return struct.unpack('<H', extra[offset + 4:offset + 6])[0] + 1
+        offset += 4 + length
+    return None
+
+
+def bgzf_chunks(path):
+    '''The members of a BGZF file, as strings of about CHUNK_SIZE bytes of
+    whole members'''
+    header_size = GZIP_HEADER.size + 2
+    with open(path, 'rb') as fastq:
+        chunk = []
+        chunk_size = 0
+        while True:
+            header = fastq.read(header_size)
+            if not header:
+                break
+            if len(header) != header_size:
+                raise Exception("Truncated BGZF file: {}".format(path))
+            extra_length, = struct.unpack('<H', header[GZIP_HEADER.size:])
+            extra = fastq.read(extra_length)
+            block_size = bgzf_block_size(extra)
+            if block_size is None:
+                raise Exception("Not a BGZF file, or it is truncated: {}".format(path))
+            rest = fastq.read(block_size - header_size - extra_length)
+            if len(rest) != block_size - header_size - extra_length:
+                raise Exception("Truncated BGZF file: {}".format(path))
+            chunk.extend([header, extra, rest])
+            chunk_size += block_size
+            if chunk_size >= CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+
+def inflate(chunk):
+    '''Decompress a string of whole gzip members. Runs in a worker process.'''
+    result = []
+    while chunk:
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        result.append(decompressor.decompress(chunk))
+        chunk = decompressor.unused_data
+    return ''.join(result)
+
+
+def read_blocks(path, pool=None, workers=1):
+    '''The decompressed contents of a FASTQ file, a block at a time. BGZF
+    files are decompressed by the pool of workers if there is one.'''
+    if path.endswith('.gz') and pool is not None and is_bgzf(path):
+        # A chunk is decompressed by each worker, in order, while the next
+        # chunks are read
+        pending = deque()
+        for chunk in bgzf_chunks(path):
+            pending.append(pool.apply_async(inflate, (chunk,)))
+            if len(pending) >= workers * CHUNKS_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        return
+    if path.endswith('.gz'):
+        process = subprocess.Popen(['gzip', '-dc', path], stdout=subprocess.PIPE,
+                                   bufsize=BLOCK_SIZE)
+        stream = process.stdout
+    else:
+        process = None
+        stream = open(path, 'rb')
+    try:
+        while True:
+            block = stream.read(BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+    finally:
+        stream.close()
+    if process is not None and process.wait() != 0:
+        raise Exception("Failed to decompress FASTQ file: {}".format(path))
+
+
+def record_lines(blocks):
+    '''The lines of the whole FASTQ records in each of a series of blocks'''
+    pending = ''
+    for block in blocks:
+        lines = (pending + block).split('\n')
+        # The last line may be incomplete, and so may the last record
+        complete = (len(lines) - 1) // 4 * 4
+        pending = '\n'.join(lines[complete:])
+        yield lines[:complete]
+    lines = pending.split('\n')
+    if len(lines) >= 4:
+        yield lines[:4]
+
+
+def interleave(blocks1, blocks2, output):
+    '''Write the records of a pair of FASTQ files in turn, one from each'''
+    records1 = record_lines(blocks1)
+    records2 = record_lines(blocks2)
+    lines1, lines2 = [], []
+    while True:
+        more1 = next(records1, None)
+        more2 = next(records2, None)
+        if more1 is None and more2 is None:
+            break
+        lines1.extend(more1 or [])
+        lines2.extend(more2 or [])
+        count = min(len(lines1), len(lines2))
+        interleaved = []
+        for start in xrange(0, count, 4):
+            interleaved.extend(lines1[start:start + 4])
+            interleaved.extend(lines2[start:start + 4])
+        if interleaved:
+            output.write('\n'.join(interleaved) + '\n')
+        del lines1[:count]
+        del lines2[:count]
+    if lines1 or lines2:
+        raise Exception("The FASTQ files of a pair have different numbers of reads")
+
+
+def fastq_reader_args(fastqs, workers, interleave=False):
+    '''The arguments of the program which writes the decompressed FASTQ
+    files, interleaved if the flag is set, with a number of worker
+    processes'''
+    program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    return [sys.executable, program, '--workers', str(workers)] + \
+        (['--interleave'] if interleave else []) + list(fastqs)
+
+
+def fastq_reader_command(fastqs, workers, interleave=False):
+    '''The command which writes the decompressed FASTQ files'''
+    return ' '.join(fastq_reader_args(fastqs, workers, interleave))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Decompress FASTQ files in parallel')
+    parser.add_argument('--workers', type=int, default=1,
+        help='Worker processes decompressing BGZF files')
+    parser.add_argument('--interleave', action='store_true',
+        help='Write the records of a pair of files in turn')
+    parser.add_argument('fastqs', nargs='+', help='FASTQ files, optionally gzipped')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.interleave and len(args.fastqs) != 2:
+        raise Exception("--interleave needs a pair of FASTQ files")
+    pool = Pool(args.workers) if args.workers > 1 else None
+    output = sys.stdout
+    try:
+        if args.interleave:
+            interleave(read_blocks(args.fastqs[0], pool, args.workers),
+                       read_blocks(args.fastqs[1], pool, args.workers), output)
+        else:
+            for path in args.fastqs:
+                for block in read_blocks(path, pool, args.workers):
+                    output.write(block)
+        output.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+if __name__ == '__main__':
+    main()
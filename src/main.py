@@ -10,25 +10,38 @@ See ../README.md for details about how to use the program.
 Repository: https://github.com/bjpop/crpipe
 '''
 
-from ruffus import *
-import ruffus.cmdline as cmdline
-import drmaa
-from version import version
 import sys
-from config import Config
-from state import State
-from logger import Logger
-from pipeline import make_pipeline
+from config import Config, DEFAULT_CONFIG_FILE
 
 # default place to save cluster job scripts
 # (mostly useful for post-mortem debugging)
 DEFAULT_JOBSCRIPT_DIR = 'jobscripts'
-# default name of the pipeline configuration file
-DEFAULT_CONFIG_FILE = 'pipeline.config'
+# subcommands which inspect the pipeline instead of running it, with the
+# module and function which implement each one:
+#    crpipe <subcommand> [arguments]
+# The modules are only imported when their subcommand is run, and ruffus
+# and the stages of the pipeline are not imported for the subcommands.
+SUBCOMMANDS = {
+    'benchmark': ('benchmark', 'benchmark_command'),
+    'cache': ('cache', 'cache_command'),
+    'report': ('report', 'report_command'),
+    'status': ('status', 'status_command'),
+}
 
 
-def parse_command_line():
-    '''Parse the command line arguments of the pipeline'''
+def run_subcommand(name, args):
+    '''Run a subcommand with its command line arguments'''
+    module, function = SUBCOMMANDS[name]
+    getattr(__import__(module), function)(args)
+
+
+def parse_command_line(args=None):
+    '''Parse the command line arguments of the pipeline, from sys.argv
+    unless they are given'''
+    # Finding the version scans the installed packages, which is slow on
+    # a parallel filesystem, so it is not done for the subcommands
+    from version import version
+    import ruffus.cmdline as cmdline
     parser = cmdline.get_argparse(description='Colorectal cancer pipeline',
         ignored_args = ["version"] )
     parser.add_argument('--config', type=str, default=DEFAULT_CONFIG_FILE,
@@ -38,33 +51,96 @@ def parse_command_line():
         default=DEFAULT_JOBSCRIPT_DIR,
         help='Directory to store cluster job scripts created by the ' \
              'pipeline, defaults to {}'.format(DEFAULT_JOBSCRIPT_DIR))
+    parser.add_argument('--watch', action='store_true',
+        help='Keep running, and run the pipeline on new samples as their ' \
+             'FASTQ files arrive, see the watch option of the configuration')
     parser.add_argument('--version', action='version',
         version='%(prog)s ' + version)
-    return parser.parse_args()
+    options = parser.parse_args(args)
+    # Watch mode runs the pipeline once per batch of samples, which cannot
+    # be printed, drawn or touched ahead of time
+    if options.watch and not runs_jobs(options):
+        parser.error('--watch cannot be used with --just_print, --flowchart '
+                     'or --touch_files_only')
+    return options
+
+
+def make_state(options, config, logger):
+    '''The global state of the pipeline'''
+    from state import State
+    from runner import make_packing, make_local_budget, make_executor
+    from rundb import RunDatabase, DEFAULT_RUN_DB
+    from priority import make_priorities
+    from cache import make_cache
+    from statcache import make_stat_cache
+    from cleanup import make_cleanup
+    from engine import JobEngine, ARRAY_WINDOW
+    # All jobs are run by the job engine, whose executor opens a DRMAA
+    # session when the first cluster job is submitted, so dry runs and
+    # flowcharts don't need one
+    local_budget = make_local_budget(config)
+    engine = JobEngine(make_executor(config, options.jobscripts, local_budget),
+        options.jobscripts,
+        array_window=config.get_optional_option('array_window', ARRAY_WINDOW),
+        packing=make_packing(config), local_budget=local_budget)
+    rundb = RunDatabase(config.get_optional_option('run_db', DEFAULT_RUN_DB))
+    stat_cache = make_stat_cache(config)
+    return State(options=options, config=config, logger=logger,
+                 cache=make_cache(config), engine=engine, rundb=rundb,
+                 priorities=make_priorities(config, rundb),
+                 stat_cache=stat_cache,
+                 cleanup=make_cleanup(config, rundb, logger, stat_cache))
+
+
+def runs_jobs(options):
+    '''Whether the jobs of the pipeline are run, rather than the pipeline
+    being printed or drawn, or its outputs touched'''
+    return not (options.just_print or options.flowchart or options.touch_files_only)
 
 
 def main():
     '''Initialise the pipeline, then run it'''
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        run_subcommand(sys.argv[1], sys.argv[2:])
+        return
+    import threading
+    import ruffus.cmdline as cmdline
+    from logger import Logger
+    from pipeline import make_pipeline
+    from watch import watch
+    from engine import THREAD_STACK_SIZE
     # Parse command line arguments
     options = parse_command_line()
     # Initialise the logger
     logger = Logger(__name__, options.log_file, options.verbose)
     # Log the command line used to run the pipeline
     logger.info(' '.join(sys.argv))
-    # Set up the DRMAA session for running cluster jobs
-    drmaa_session = drmaa.Session()
-    drmaa_session.initialize()
     # Parse the configuration file, and initialise global state
     config = Config(options.config)
     config.validate()
-    state = State(options=options, config=config, logger=logger,
-                  drmaa_session=drmaa_session)
-    # Build the pipeline workflow
-    pipeline = make_pipeline(state)
-    # Run (or print) the pipeline
-    cmdline.run(options)
-    # Shut down the DRMAA session
-    drmaa_session.exit()
+    state = make_state(options, config, logger)
+    engine = state.engine
+    # Pipeline threads only wait for the job engine, so they can have
+    # small stacks, which allows many of them with --use_threads --jobs N
+    threading.stack_size(THREAD_STACK_SIZE)
+    if options.watch:
+        # Build and run the pipeline for each new batch of samples
+        watch(state)
+    else:
+        # Build the pipeline workflow
+        pipeline = make_pipeline(state)
+        # Run (or print) the pipeline
+        cmdline.run(options)
+        # Remove the intermediate files which were only read by jobs which
+        # were already up to date
+        if state.cleanup is not None and runs_jobs(options):
+            state.cleanup.finish()
+    # Wait for the job engine to finish, which shuts down the DRMAA
+    # session if it was opened
+    engine.stop()
+    summary = engine.executor.summary()
+    if summary is not None:
+        logger.info(summary)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+'''
+The samples of a cohort: their names, FASTQ files and read groups.
+
+Large cohorts are described by a sample manifest, a table with a header
+line and one row per sample, named by the "manifest" option in the
+configuration file. Files ending in .csv are comma separated, anything
+else is tab separated. The columns are:
+
+    sample    name of the sample (letters and digits only)
+    fastq1    path of the read 1 FASTQ file
+    fastq2    path of the read 2 FASTQ file
+    read_group  (optional) read group for bwa, eg: @RG\\tID:s1\\tSM:s1
+    lane      (optional) sequencing lane, the PU of a generated read group
+    library   (optional) library, the LB of a generated read group
+
+Rows with an empty read_group get a read group made from the sample,
+lane and library. Without a manifest, the samples are found by pairing
+the SAMPLE_R1.fastq.gz and SAMPLE_R2.fastq.gz files in the "fastqs"
+option.
+'''
+
+import os
+import re
+import csv
+from collections import namedtuple
+
+
+Sample = namedtuple("Sample", ["name", "fastq1", "fastq2", "read_group",
+                               "lane", "library"])
+
+REQUIRED_COLUMNS = ['sample', 'fastq1', 'fastq2']
+OPTIONAL_COLUMNS = ['read_group', 'lane', 'library']
+# Sample names are used in file names which later stages match with
+# [a-zA-Z0-9]+
+SAMPLE_NAME_REGEX = re.compile('^[a-zA-Z0-9]+$')
+# Read 1 files of pairs in the fastqs option
+READ1_REGEX = re.compile('^(?P<sample>[a-zA-Z0-9]+)_R1.fastq.gz$')
+
+
+class SampleManifest(object):
+    '''The samples of a cohort, indexed by name'''
+    def __init__(self, samples, filename=None):
+        self.samples = samples
+        self.filename = filename
+        self.by_name = {}
+        for sample in samples:
+            if sample.name in self.by_name:
+                raise Exception("Sample: {} appears more than once in " \
+                    "sample manifest: {}".format(sample.name, filename))
+            self.by_name[sample.name] = sample
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def get(self, name):
+        '''The sample with the given name'''
+        if name in self.by_name:
+            return self.by_name[name]
+        raise Exception("Unknown sample: {}, not in sample manifest: {}" \
+            .format(name, self.filename))
+
+    def fastqs(self):
+        '''The FASTQ files of all the samples'''
+        return [path for sample in self.samples
+                for path in (sample.fastq1, sample.fastq2)]
+
+
+def read_manifest(filename):
+    '''Read a sample manifest in TSV or CSV format'''
+    delimiter = ',' if filename.lower().endswith('.csv') else '\t'
+    with open(filename, 'rb') as manifest_file:
+        rows = csv.reader(manifest_file, delimiter=delimiter)
+        header = [column.strip().lower() for column in next(rows, [])]
+        for column in REQUIRED_COLUMNS:
+            if column not in header:
+                raise Exception("Sample manifest: {} does not have a '{}' " \
+                    "column".format(filename, column))
+        columns = [header.index(column) if column in header else None
+                   for column in REQUIRED_COLUMNS + OPTIONAL_COLUMNS]
+        samples = []
+        for line_number, row in enumerate(rows, 2):
+            if not row or row[0].startswith('#') or not ''.join(row).strip():
+                continue
+            values = [row[index].strip() if index is not None and index < len(row)
+                      else '' for index in columns]
+            name, fastq1, fastq2, read_group, lane, library = values
+            if not SAMPLE_NAME_REGEX.match(name):
+                raise Exception("Sample name: '{}' on line {} of sample " \
+                    "manifest: {} may only contain letters and digits" \
+                    .format(name, line_number, filename))
+            if not fastq1 or not fastq2:
+                raise Exception("Sample: {} on line {} of sample manifest: " \
+                    "{} needs two FASTQ files".format(name, line_number, filename))
+            samples.append(Sample(name, fastq1, fastq2,
+                read_group or make_read_group(name, lane, library), lane, library))
+    return SampleManifest(samples, filename)
+
+
+def samples_from_fastqs(fastqs, read_groups=None):
+    '''The samples of the SAMPLE_R1.fastq.gz and SAMPLE_R2.fastq.gz pairs in
+    a list of FASTQ files, with read groups from the read_groups option'''
+    read_groups = read_groups or {}
+    samples = []
+    for path in fastqs:
+        directory, name = os.path.split(path)
+        match = READ1_REGEX.match(name)
+        if match is None:
+            continue
+        sample = match.group('sample')
+        read2 = os.path.join(directory, sample + '_R2.fastq.gz')
+        samples.append(Sample(sample, path, read2, read_groups.get(sample),
+                              None, None))
+    return samples
+
+
+def make_read_group(sample, lane=None, library=None):
+    '''A read group for bwa mem -R, with the fields separated by \\t as in
+    the read_groups option'''
+    fields = ['@RG', 'ID:' + (sample + '_' + lane if lane else sample),
+              'SM:' + sample, 'PL:ILLUMINA']
+    if lane:
+        fields.append('PU:' + lane)
+    if library:
+        fields.append('LB:' + library)
+    return '\\t'.join(fields)
@@ -0,0 +1,173 @@
+'''
+Packing of short jobs into a single cluster allocation.
+
+Short jobs, such as indexing a BAM file, spend much longer waiting in the
+cluster queue than running. The job engine collects the jobs of stages
+which are packed, and submits them together as one allocation. This
+module is run as a program inside that allocation:
+
+    python packer.py --cores N --mem MB manifest
+
+The manifest has one line per job: its cores, its memory in MB and the
+path of its job script. The jobs are run concurrently, as many at a time
+as fit in the cores and memory of the allocation. The stdout and stderr of
+each job go next to its job script as usual, and its exit status is
+written to a file next to its job script, along with its peak memory,
+CPU time and start and end times, from which the job engine reports on
+each job separately.
+'''
+
+import os
+import sys
+import time
+import argparse
+import datetime
+import tempfile
+import subprocess
+from collections import deque
+from resources import ResourceBudget, allowed_cpus, limit_command, \
+    usage_from_rusage
+
+
+# Maximum number of jobs in one allocation
+MAX_PACK_JOBS = 100
+
+
+class Packing(object):
+    '''The resources of the cluster allocations which packed jobs run in'''
+    def __init__(self, cores, mem, walltime, options, max_jobs=MAX_PACK_JOBS):
+        self.cores = cores
+        # memory in MB
+        self.mem = mem
+        # walltime in minutes
+        self.walltime = walltime
+        # native options for the cluster scheduler
+        self.options = options
+        self.max_jobs = max_jobs
+
+    def fits(self, job):
+        '''Can the job run in an allocation?'''
+        return job.cores <= self.cores and job.mem <= self.mem and \
+            job.walltime <= self.walltime
+
+    def full(self, jobs):
+        '''Are there enough jobs to fill an allocation? The allocation is
+        full when the jobs would take all of its walltime to run, if each
+        one ran for its whole walltime.'''
+        return len(jobs) >= self.max_jobs or \
+            core_minutes(jobs) >= self.cores * self.walltime
+
+    def has_room(self, jobs, job):
+        '''Can the job be added to the jobs of an allocation, without them
+        taking more than its walltime to run, if each one ran for its whole
+        walltime?'''
+        return len(jobs) < self.max_jobs and \
+            core_minutes(jobs) + job.cores * job.walltime <= self.cores * self.walltime
+
+
+def core_minutes(jobs):
+    '''The cores times the walltime (in minutes) of the jobs'''
+    return sum(job.cores * job.walltime for job in jobs)
+
+
+def write_pack_manifest(jobs, job_script_dir):
+    '''Write the manifest of the jobs to run in an allocation'''
+    time_stamp = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    manifest = tempfile.NamedTemporaryFile(mode='w', dir=job_script_dir,
+        prefix='pack_{}__'.format(time_stamp), suffix='.txt', delete=False)
+    with manifest:
+        for job in jobs:
+            manifest.write('{}\t{}\t{}\n'.format(job.cores, job.mem, job.script_path))
+    return os.path.abspath(manifest.name)
+
+
+def pack_command(manifest, packing):
+    '''The command which runs the jobs in a manifest inside an allocation'''
+    worker = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    return '{python} {worker} --cores {cores} --mem {mem} {manifest}' \
+        .format(python=sys.executable, worker=worker, cores=packing.cores,
+                mem=packing.mem, manifest=manifest)
+
+
+def status_path(script_path):
+    '''The file holding the exit status of a packed job'''
+    return script_path + '.exit'
+
+
+def read_status(lines):
+    '''The exit status and resource usage of a packed job, from the lines
+    of its status file'''
+    fields = lines[0].split()
+    exit_status = int(fields[0])
+    usage = {}
+    if len(fields) == 5:
+        usage = dict(zip(['peak_rss', 'cpu_time', 'start_time', 'end_time'],
+                         map(float, fields[1:])))
+    return exit_status, usage
+
+
+def read_manifest(manifest):
+    jobs = []
+    with open(manifest) as manifest_file:
+        for line in manifest_file:
+            cores, mem, script_path = line.rstrip('\n').split('\t')
+            jobs.append((int(cores), int(mem), script_path))
+    return jobs
+
+
+def run_packed_jobs(jobs, budget):
+    '''Run jobs as the budget allows, starting each job as soon as it
+    fits, and record the exit status of each one'''
+    pending = deque(jobs)
+    # process id -> (Popen, script path, grant, start time). The Popen
+    # objects are kept so that subprocess does not reap the processes
+    # itself.
+    running = {}
+    while pending or running:
+        for job in list(pending):
+            cores, mem, script_path = job
+            grant = budget.try_acquire(cores, mem)
+            if grant is None:
+                continue
+            pending.remove(job)
+            args, env = limit_command(['/bin/sh', script_path], grant)
+            with open(script_path + '.stdout', 'w') as stdout, \
+                 open(script_path + '.stderr', 'w') as stderr:
+                process = subprocess.Popen(args, env=env, stdout=stdout,
+                    stderr=stderr, close_fds=True)
+            running[process.pid] = (process, script_path, grant, time.time())
+        pid, status, rusage = os.wait3(0)
+        if pid not in running:
+            continue
+        _, script_path, grant, start_time = running.pop(pid)
+        budget.release(grant)
+        if os.WIFSIGNALED(status):
+            exit_status = -os.WTERMSIG(status)
+        else:
+            exit_status = os.WEXITSTATUS(status)
+        usage = usage_from_rusage(rusage)
+        with open(status_path(script_path), 'w') as status_file:
+            status_file.write('{} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(exit_status,
+                usage['peak_rss'], usage['cpu_time'], start_time, time.time()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run packed pipeline jobs inside a cluster allocation')
+    parser.add_argument('--cores', type=int, required=True,
+        help='Number of cores in the allocation')
+    parser.add_argument('--mem', type=int, required=True,
+        help='Memory in the allocation in MB')
+    parser.add_argument('manifest', type=str,
+        help='File listing the cores, memory and job script of each job')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    budget = ResourceBudget(options.cores, options.mem, allowed_cpus())
+    run_packed_jobs(read_manifest(options.manifest), budget)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,19 +2,37 @@
 Build the pipeline workflow by plumbing the stages together.
 '''
 
-from ruffus import Pipeline, suffix, formatter, add_inputs, output_from
-from stages import Stages
-
-
-def make_pipeline(state):
-    '''Build the pipeline by constructing stages and connecting them together'''
+import os
+from ruffus import Pipeline, suffix, formatter, add_inputs, inputs, output_from
+from ruffus.task import Task
+from ruffus.file_name_parameters import needs_update_check_modify_time
+from stages import Stages, task_stage
+from utils import read_regions, region_name, file_names, alignment_index
+from reference import index_files
+from statcache import job_history
+
+
+def make_pipeline(state, fastq_files=None, name='crpipe', cohort=True):
+    '''Build the pipeline by constructing stages and connecting them together.
+
+    The FASTQ files default to the ones in the sample manifest, or else
+    the ones listed in the configuration file. Without cohort the stages
+    which combine all the samples are left out, and only the per-sample
+    stages are run.
+    '''
     # Build an empty pipeline
-    pipeline = Pipeline(name='crpipe')
-    # Get a list of paths to all the FASTQ files
-    fastq_files = state.config.get_option('fastqs')
+    pipeline = Pipeline(name=name)
+    # The samples, each with a pair of FASTQ files, and a list of paths to
+    # all the FASTQ files
+    samples = state.config.get_samples(fastq_files)
+    if fastq_files is None:
+        fastq_files = [path for sample in samples
+                       for path in (sample.fastq1, sample.fastq2)]
     # Find the path to the reference genome
     # Stages are dependent on the state
     stages = Stages(state)
+    # Genomic regions for stages which are scattered over the genome
+    regions = read_regions(state.config.get_optional_option('scatter_regions', []))
 
     # The original FASTQ files
     # This is a dummy stage. It is useful because it makes a node in the
@@ -32,103 +50,98 @@ def make_pipeline(state):
     #     filter=suffix('.fastq.gz'),
     #     output='.fasta')
 
-    # The original reference file
-    # This is a dummy stage. It is useful because it makes a node in the
-    # pipeline graph, and gives the pipeline an obvious starting point.
-    #pipeline.originate(
-    #    task_func=stages.original_reference,
-    #    name='original_reference',
-    #    output=reference_file)
-
-    # Run fastQC on the FASTQ files
-    pipeline.transform(
-        task_func=stages.fastqc,
-        name='fastqc',
-        input=output_from('original_fastqs'),
-        filter=suffix('.fastq.gz'),
-        output='_fastqc')
-
-    # Index the reference using BWA 
-    #pipeline.transform(
-    #    task_func=stages.index_reference_bwa,
-    #    name='index_reference_bwa',
-    #    input=output_from('original_reference'),
-    #    filter=suffix('.fa'),
-    #    output=['.fa.amb', '.fa.ann', '.fa.pac', '.fa.sa', '.fa.bwt'])
-    
-    # Index the reference using samtools 
-    # pipeline.transform(
-    #     task_func=stages.index_reference_samtools,
-    #    name='index_reference_samtools',
-    #    input=output_from('original_reference'),
-    #    filter=suffix('.fa'),
-    #    output='.fa.fai')
-
-    # Index the reference using bowtie 2 
-    # pipeline.transform(
-    #     task_func=stages.index_reference_bowtie2,
-    #     name='index_reference_bowtie2',
-    #     input=output_from('original_reference'),
-    #     filter=formatter('.+/(?P<refname>[a-zA-Z0-9]+\.fa)'),
-    #     output=['{path[0]}/{refname[0]}.1.bt2',
-    #             '{path[0]}/{refname[0]}.2.bt2',
-    #             '{path[0]}/{refname[0]}.3.bt2',
-    #             '{path[0]}/{refname[0]}.4.bt2',
-    #             '{path[0]}/{refname[0]}.rev.1.bt2',
-    #             '{path[0]}/{refname[0]}.rev.2.bt2'],
-    #     extras=['{path[0]}/{refname[0]}'])
-
-    # # Create a FASTA sequence dictionary for the reference using picard
-    # pipeline.transform(
-    #     task_func=stages.reference_dictionary_picard,
-    #     name='reference_dictionary_picard',
-    #     input=output_from('original_reference'),
-    #     filter=suffix('.fa'),
-    #     output='.dict')
-
-    # Align paired end reads in FASTQ to the reference producing a BAM file
-    pipeline.transform(
-        task_func=stages.align_bwa,
-        name='align_bwa',
-        input=output_from('original_fastqs'),
-        # Match the R1 (read 1) FASTQ file and grab the path and sample name. 
-        # This will be the first input to the stage.
-        # We assume the sample name may consist of only alphanumeric
-        # characters.
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+)_R1.fastq.gz'),
-        # Add two more inputs to the stage:
-        #    1. The corresponding R2 FASTQ file
-        add_inputs=add_inputs('{path[0]}/{sample[0]}_R2.fastq.gz'),
-        # Add an "extra" argument to the state (beyond the inputs and outputs)
-        # which is the sample name. This is needed within the stage for finding out
-        # sample specific configuration options
-        extras=['{sample[0]}'],
-        # The output file name is the sample name with a .bam extension.
-        output='{path[0]}/{sample[0]}.bam')
+    # With the reference_cache option the reference is put in the cache,
+    # and indexed there once for all the projects which use it. These are
+    # the index tasks which the alignment and Socrates follow.
+    align_indexes, socrates_indexes = make_reference(pipeline, stages, state)
+
+    # Quality check the FASTQ files. By default with fastQC, one job per
+    # file. With the qc option native, one job per sample summarises both
+    # files, and with tap the summary is made by the alignment as it reads
+    # the files (unless the alignment is chunked).
+    qc = state.config.get_optional_option('qc', 'fastqc')
+    if qc == 'fastqc':
+        pipeline.transform(
+            task_func=stages.fastqc,
+            name='fastqc',
+            input=output_from('original_fastqs'),
+            filter=suffix('.fastq.gz'),
+            output='_fastqc')
+    elif not stages.qc_tap():
+        pipeline.files(stages.fastq_qc,
+            sample_jobs(samples, '{path}/{sample}.qc.json'),
+            name='fastq_qc').follows('original_fastqs')
+
+    # Align paired end reads in FASTQ to the reference producing a BAM file.
+    # If the align_bwa stage sets a chunk_size the alignment is scattered
+    # over chunks of the FASTQ files and gathered back into one BAM file.
+    # If the align_bwa stage sets fused_sort the aligner output is sorted and
+    # indexed as it is streamed, and no unsorted BAM file is written.
+    chunk_size = state.config.get_optional_stage_option('align_bwa', 'chunk_size')
+    fused_sort = state.config.get_optional_stage_option('align_bwa', 'fused_sort')
+    # The sorted alignment of each sample is BAM, or with the
+    # alignment_format option CRAM, compressed against the reference
+    sorted_suffix = '.sorted.' + state.config.get_optional_option('alignment_format', 'bam')
+    sorted_filter = sorted_alignment_filter(sorted_suffix)
+    if fused_sort:
+        # Stages which read the whole alignment use the sorted BAM instead
+        # of the unsorted one
+        bam_task = 'sort_alignment'
+        bam_filter = sorted_filter
+    else:
+        bam_task = 'align_bwa'
+        bam_filter = formatter('.+/(?P<sample>[a-zA-Z0-9]+).bam')
+
+    # The stages which read the FASTQ files have one job per sample, made
+    # from the list of samples rather than by matching file names
+    if chunk_size:
+        make_chunked_alignment(pipeline, stages, samples, fused_sort, sorted_suffix,
+                               align_indexes)
+    elif fused_sort:
+        # Align, sort and index in one job producing a sorted BAM file and
+        # its index
+        follows_all(pipeline.files(stages.align_sort_bwa,
+            sample_jobs(samples, '{path}/{sample}' + sorted_suffix),
+            name='sort_alignment').follows('original_fastqs'), align_indexes)
+    else:
+        # Align the pair of FASTQ files of each sample. The sample name is
+        # an "extra" argument to the stage, needed for finding sample
+        # specific configuration options. The output file name is the
+        # sample name with a .bam extension, next to the FASTQ files.
+        follows_all(pipeline.files(stages.align_bwa,
+            sample_jobs(samples, '{path}/{sample}.bam'),
+            name='align_bwa').follows('original_fastqs'), align_indexes)
 
     # Sort alignment with sambamba
-    pipeline.transform(
-        task_func=stages.sort_bam_sambamba,
-        name='sort_alignment',
-        input=output_from('align_bwa'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).bam'),
-        output='{path[0]}/{sample[0]}.sorted.bam')
+    if not fused_sort:
+        pipeline.transform(
+            task_func=stages.sort_bam_sambamba,
+            name='sort_alignment',
+            input=output_from('align_bwa'),
+            filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).bam'),
+            output='{path[0]}/{sample[0]}' + sorted_suffix)
+
+    # Optionally extract everything that needs a whole pass over the
+    # alignment in a single stage
+    fan_out = state.config.get_optional_option('fan_out', False)
 
     # Extract MMR genes from the sorted BAM file
     pipeline.transform(
         task_func=stages.extract_genes_bedtools,
         name='extract_genes_bedtools',
         input=output_from('sort_alignment'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).sorted.bam'),
+        filter=sorted_filter,
         output='{path[0]}/{sample[0]}.mmr.bam')
 
-    # Extract selected chromosomes from the sorted BAM file
-    pipeline.transform(
-        task_func=stages.extract_chromosomes_samtools,
-        name='extract_chromosomes_samtools',
-        input=output_from('sort_alignment'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).sorted.bam'),
-        output='{path[0]}/{sample[0]}.chroms.bam')
+    # Extract selected chromosomes from the sorted BAM file, unless this is
+    # done by the fan out stage below
+    if not fan_out:
+        pipeline.transform(
+            task_func=stages.extract_chromosomes_samtools,
+            name='extract_chromosomes_samtools',
+            input=output_from('sort_alignment'),
+            filter=sorted_filter,
+            output='{path[0]}/{sample[0]}.chroms.bam')
 
     # Index the MMR genes bam file with samtools 
     pipeline.transform(
@@ -148,37 +161,57 @@ def make_pipeline(state):
     #    output='{path[0]}/{sample[0]}.coverage_summary',
     #    extras=['{path[0]}/{sample[0]}_coverage'])
 
-    # Index the alignment with samtools 
+    # Index the alignment with samtools. A fused sort has already written
+    # the index, in which case the stage only checks that it exists.
     pipeline.transform(
-        task_func=stages.index_bam,
+        task_func=stages.check_index if fused_sort else stages.index_bam,
         name='index_alignment',
         input=output_from('sort_alignment'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).sorted.bam'),
-        output='{path[0]}/{sample[0]}.sorted.bam.bai')
-
-    # Generate alignment stats with bamtools
-    pipeline.transform(
-        task_func=stages.bamtools_stats,
-        name='bamtools_stats',
-        input=output_from('align_bwa'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).bam'),
-        output='{path[0]}/{sample[0]}.stats.txt')
-
-    # Extract the discordant paired-end alignments
-    pipeline.transform(
-        task_func=stages.extract_discordant_alignments,
-        name='extract_discordant_alignments',
-        input=output_from('align_bwa'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).bam'),
-        output='{path[0]}/{sample[0]}.discordants.unsorted.bam')
-
-    # Extract split-read alignments
-    pipeline.transform(
-        task_func=stages.extract_split_read_alignments,
-        name='extract_split_read_alignments',
-        input=output_from('align_bwa'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).bam'),
-        output='{path[0]}/{sample[0]}.splitters.unsorted.bam')
+        filter=sorted_filter,
+        output=alignment_index('{path[0]}/{sample[0]}' + sorted_suffix))
+
+    # Read the alignment once to extract the discordant alignments, the
+    # split-read alignments and the selected chromosomes, and to generate
+    # alignment stats. Otherwise each of these is a separate stage which
+    # reads the whole alignment.
+    if fan_out:
+        pipeline.transform(
+            task_func=stages.fan_out_alignment,
+            name='fan_out_alignment',
+            input=output_from('sort_alignment'),
+            filter=sorted_filter,
+            output=['{path[0]}/{sample[0]}.discordants.unsorted.bam',
+                    '{path[0]}/{sample[0]}.splitters.unsorted.bam',
+                    '{path[0]}/{sample[0]}.chroms.bam',
+                    '{path[0]}/{sample[0]}.stats.txt'])
+        discordants_task = 'fan_out_alignment'
+        splitters_task = 'fan_out_alignment'
+    else:
+        # Generate alignment stats with bamtools
+        pipeline.transform(
+            task_func=stages.bamtools_stats,
+            name='bamtools_stats',
+            input=output_from(bam_task),
+            filter=bam_filter,
+            output='{path[0]}/{sample[0]}.stats.txt')
+
+        # Extract the discordant paired-end alignments
+        pipeline.transform(
+            task_func=stages.extract_discordant_alignments,
+            name='extract_discordant_alignments',
+            input=output_from(bam_task),
+            filter=bam_filter,
+            output='{path[0]}/{sample[0]}.discordants.unsorted.bam')
+
+        # Extract split-read alignments
+        pipeline.transform(
+            task_func=stages.extract_split_read_alignments,
+            name='extract_split_read_alignments',
+            input=output_from(bam_task),
+            filter=bam_filter,
+            output='{path[0]}/{sample[0]}.splitters.unsorted.bam')
+        discordants_task = 'extract_discordant_alignments'
+        splitters_task = 'extract_split_read_alignments'
 
     # Sort discordant reads.
     # Samtools annoyingly takes the prefix of the output bam name as its argument.
@@ -187,8 +220,11 @@ def make_pipeline(state):
     pipeline.transform(
         task_func=stages.sort_bam,
         name='sort_discordants',
-        input=output_from('extract_discordant_alignments'),
+        input=output_from(discordants_task),
+        # The fan out stage has several outputs, the first of which is the
+        # discordants. Pick out the discordants as the input.
         filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).discordants.unsorted.bam'),
+        replace_inputs=inputs('{path[0]}/{sample[0]}.discordants.unsorted.bam'),
         extras=['{path[0]}/{sample[0]}.discordants'],
         output='{path[0]}/{sample[0]}.discordants.bam')
 
@@ -207,8 +243,11 @@ def make_pipeline(state):
     pipeline.transform(
         task_func=stages.sort_bam,
         name='sort_splitters',
-        input=output_from('extract_split_read_alignments'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).splitters.unsorted.bam'),
+        input=output_from(splitters_task),
+        # The fan out stage has several outputs, the first of which is the
+        # discordants. Pick out the splitters as the input.
+        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).(splitters|discordants).unsorted.bam'),
+        replace_inputs=inputs('{path[0]}/{sample[0]}.splitters.unsorted.bam'),
         extras=['{path[0]}/{sample[0]}.splitters'],
         output='{path[0]}/{sample[0]}.splitters.bam')
 
@@ -220,17 +259,20 @@ def make_pipeline(state):
     #    filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).splitters.bam'),
     #    output='{path[0]}/{sample[0]}.splitters.bam.bai')
 
-    # Call structural variants with lumpy
-    (pipeline.transform(
-        task_func=stages.structural_variants_lumpy,
-        name='structural_variants_lumpy',
-        input=output_from('sort_alignment'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).sorted.bam'),
-        add_inputs=add_inputs(['{path[0]}/{sample[0]}.splitters.bam', '{path[0]}/{sample[0]}.discordants.bam']),
-        output='{path[0]}/{sample[0]}.lumpy.vcf')
-        .follows('index_alignment')
-        .follows('sort_splitters')
-        .follows('sort_discordants'))
+    # Call structural variants with lumpy, optionally scattered over genomic regions
+    if state.config.get_optional_stage_option('structural_variants_lumpy', 'scatter'):
+        make_scattered_lumpy(pipeline, stages, regions, sorted_suffix)
+    else:
+        (pipeline.transform(
+            task_func=stages.structural_variants_lumpy,
+            name='structural_variants_lumpy',
+            input=output_from('sort_alignment'),
+            filter=sorted_filter,
+            add_inputs=add_inputs(['{path[0]}/{sample[0]}.splitters.bam', '{path[0]}/{sample[0]}.discordants.bam']),
+            output='{path[0]}/{sample[0]}.lumpy.vcf')
+            .follows('index_alignment')
+            .follows('sort_splitters')
+            .follows('sort_discordants'))
 
     # Call genotypes on lumpy output using SVTyper 
     #(pipeline.transform(
@@ -246,43 +288,21 @@ def make_pipeline(state):
     #    .follows('index_splitters')
     #    .follows('index_discordants'))
 
-    # Call SVs with Socrates
-    (pipeline.transform(
-        task_func=stages.structural_variants_socrates,
-        name='structural_variants_socrates',
-        input=output_from('sort_alignment'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).sorted.bam'),
-        # output goes to {path[0]}/socrates/
-        output='{path[0]}/socrates/results_Socrates_paired_{sample[0]}.sorted_long_sc_l25_q5_m5_i95.txt',
-        extras=['{path[0]}']))
-
-    # Call DELs with DELLY 
-    pipeline.merge(
-        task_func=stages.deletions_delly,
-        name='deletions_delly',
-        input=output_from('sort_alignment'),
-        output='delly.DEL.vcf')
-
-    # Call DUPs with DELLY 
-    pipeline.merge(
-        task_func=stages.duplications_delly,
-        name='duplications_delly',
-        input=output_from('sort_alignment'),
-        output='delly.DUP.vcf')
-
-    # Call INVs with DELLY 
-    pipeline.merge(
-        task_func=stages.inversions_delly,
-        name='inversions_delly',
-        input=output_from('sort_alignment'),
-        output='delly.INV.vcf')
-
-    # Call TRAs with DELLY 
-    pipeline.merge(
-        task_func=stages.translocations_delly,
-        name='translocations_delly',
-        input=output_from('sort_alignment'),
-        output='delly.TRA.vcf')
+    # Call SVs with Socrates, optionally scattered over genomic regions
+    if state.config.get_optional_stage_option('structural_variants_socrates', 'scatter'):
+        make_scattered_socrates(pipeline, stages, regions, sorted_suffix, socrates_indexes)
+    else:
+        follows_all(pipeline.transform(
+            task_func=stages.structural_variants_socrates,
+            name='structural_variants_socrates',
+            input=output_from('sort_alignment'),
+            filter=sorted_filter,
+            # output goes to {path[0]}/socrates/
+            output='{path[0]}/socrates/results_Socrates_paired_{sample[0]}.sorted_long_sc_l25_q5_m5_i95.txt',
+            extras=['{path[0]}']), socrates_indexes)
+
+    # Call structural variants over the cohort with DELLY
+    make_delly(pipeline, stages, state, regions, sorted_suffix, cohort)
 
     # Join both read pair files using gustaf_mate_joining
     #pipeline.transform(
@@ -311,4 +331,405 @@ def make_pipeline(state):
     #    .follows('index_reference_bwa')
     #    .follows('index_reference_samtools'))
 
+    # Remove intermediate files once the jobs which read them have finished,
+    # and count removed files as there in the up to date checks
+    if state.cleanup is not None:
+        cleaned = state.cleanup.track(pipeline_jobs(pipeline), job_history(state.options))
+        for task in pipeline.tasks:
+            if is_checked(task):
+                task.check_if_uptodate(state.cleanup.needs_update)
+            if task._name in cleaned:
+                task.user_defined_work_func = state.cleanup.wrap(task.user_defined_work_func)
+    # Answer the up to date checks of every job from the stat cache rather
+    # than looking at each file
+    elif state.stat_cache is not None:
+        state.stat_cache.history = job_history(state.options)
+        for task in pipeline.tasks:
+            if is_checked(task):
+                task.check_if_uptodate(state.stat_cache.needs_update)
+
+    # Give the jobs of each task the length of the critical path which
+    # follows the task in the pipeline graph as their priority
+    if state.priorities is not None:
+        state.priorities.track(task_graph(pipeline))
+        for task in pipeline.tasks:
+            if task.user_defined_work_func is not None:
+                task.user_defined_work_func = state.priorities.wrap(task._name,
+                    task.user_defined_work_func)
+
     return pipeline
+
+
+def is_checked(task):
+    '''Whether the up to date checks of a ruffus task can be answered by
+    check_times: the tasks which compare the modification times of files,
+    apart from the originate tasks, which keep the check of ruffus'''
+    return task.needs_update_func is needs_update_check_modify_time and \
+        task._action_type != Task._action_task_originate
+
+
+def make_reference(pipeline, stages, state):
+    '''Put the reference in the reference cache and build its indexes
+    there, in parallel, if the reference_cache option is set. Returns the
+    names of the index tasks which the alignment follows, and those which
+    Socrates follows.'''
+    if stages.reference_cache is None:
+        return [], []
+    pipeline.originate(
+        task_func=stages.original_reference,
+        name='original_reference',
+        output=stages.reference)
+    # The bowtie2 index is only built for Socrates if the stage does not
+    # give its own
+    indexes = ['bwa', 'samtools']
+    if state.config.get_optional_stage_option('structural_variants_socrates',
+                                              'bowtie2_ref_dir') is None:
+        indexes.append('bowtie2')
+    for index in indexes:
+        pipeline.transform(
+            task_func=getattr(stages, 'index_reference_' + index),
+            name='index_reference_' + index,
+            input=output_from('original_reference'),
+            filter=formatter(),
+            output=index_files(stages.reference, index))
+    return ['index_reference_bwa', 'index_reference_samtools'], \
+        ['index_reference_bowtie2'] if 'bowtie2' in indexes else []
+
+
+def follows_all(task, names):
+    '''Make a task follow each of the named tasks'''
+    for name in names:
+        task.follows(name)
+    return task
+
+
+def sorted_alignment_filter(sorted_suffix):
+    '''Match the sorted alignment of a sample, whose name ends with
+    sorted_suffix (.sorted.bam or .sorted.cram)'''
+    return formatter('.+/(?P<sample>[a-zA-Z0-9]+)' + sorted_suffix)
+
+
+def pipeline_jobs(pipeline):
+    '''The tasks of a pipeline, in an order in which they can run, each
+    with the (inputs, outputs) of its jobs. The jobs of tasks whose inputs
+    are found by wildcards are only listed once the files exist.'''
+    # ruffus has no public way to list the jobs of a task without checking
+    # them, these are the internals its own printout uses
+    pipeline._complete_task_setup(set())
+    tasks = dict((task._name, task) for task in pipeline.tasks)
+    result, done = [], set()
+
+    def add(task):
+        if task._name in done:
+            return
+        done.add(task._name)
+        for upstream in task._get_inward():
+            if upstream._name in tasks:
+                add(upstream)
+        jobs = []
+        if task.param_generator_func is not None:
+            for params, _ in task.param_generator_func({}):
+                jobs.append((file_names(params[0]),
+                             file_names(params[1]) if len(params) > 1 else []))
+        result.append((task._name, jobs))
+
+    for name in sorted(tasks):
+        add(tasks[name])
+    return result
+
+
+def task_graph(pipeline):
+    '''The tasks of a pipeline, each with the stage it runs and the tasks
+    which follow it'''
+    pipeline._complete_task_setup(set())
+    names = set(task._name for task in pipeline.tasks)
+    following = dict((name, []) for name in names)
+    for task in pipeline.tasks:
+        for upstream in task._get_inward():
+            if upstream._name in names:
+                following[upstream._name].append(task._name)
+    return [(task._name, task_stage(task.user_defined_work_func)
+             if task.user_defined_work_func is not None else None,
+             following[task._name]) for task in pipeline.tasks]
+
+
+def sample_jobs(samples, output, extras=None):
+    '''The parameters of the jobs of a stage which reads the FASTQ files of
+    each sample: ([read 1, read 2], output, sample name). The output is
+    formatted with the path of the FASTQ files and the sample name, and so
+    are the extras which follow the sample name.'''
+    jobs = []
+    for sample in samples:
+        names = sample_names(sample)
+        jobs.append([[sample.fastq1, sample.fastq2], output.format(**names),
+                     sample.name] + [extra.format(**names) for extra in extras or []])
+    return jobs
+
+
+def sample_names(sample):
+    '''The names which stage outputs are formatted with: the path of the
+    sample's FASTQ files, as ruffus gives it, and the sample name'''
+    return dict(path=os.path.dirname(os.path.abspath(sample.fastq1)),
+                sample=sample.name)
+
+
+def make_chunked_alignment(pipeline, stages, samples, fused_sort, sorted_suffix='.sorted.bam',
+                           align_indexes=()):
+    '''Align the FASTQ files in chunks of reads, in parallel, and merge
+    the alignments of each sample into a single BAM file. The merge task is
+    called align_bwa so that the rest of the pipeline does not need to know
+    whether the alignment was chunked or not. With fused_sort each chunk is
+    sorted as it is aligned, and the merge task is called sort_alignment
+    instead. The chunks are aligned after the align_indexes tasks.'''
+
+    # Split the paired FASTQ files into chunks of chunk_size reads.
+    # The chunks of a sample are written to the directory {sample}_chunks
+    # next to the FASTQ files, as chunkNNNN_R1.fastq.gz and chunkNNNN_R2.fastq.gz.
+    # The first chunk stands for all of them when ruffus checks whether a
+    # sample has been split.
+    chunk_dir = '{path}/{sample}_chunks'
+    pipeline.files(stages.split_fastqs,
+        sample_jobs(samples, chunk_dir + '/chunk0000_R1.fastq.gz', [chunk_dir]),
+        name='split_fastqs').follows('original_fastqs')
+
+    # Align each pair of chunks to the reference producing a BAM file. The
+    # chunks are found when the stage runs, after the FASTQ files are split.
+    chunks = [chunk_dir.format(**sample_names(sample)) + '/chunk*_R1.fastq.gz'
+              for sample in samples]
+    follows_all(pipeline.transform(
+        task_func=stages.align_sort_bwa if fused_sort else stages.align_bwa,
+        name='align_bwa_chunks',
+        input=chunks,
+        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+)_chunks/(?P<chunk>chunk[0-9]+)_R1.fastq.gz'),
+        add_inputs=add_inputs('{path[0]}/{chunk[0]}_R2.fastq.gz'),
+        extras=['{sample[0]}'],
+        output='{path[0]}/{chunk[0]}.bam')
+        .follows('split_fastqs'), align_indexes)
+
+    # Gather the chunk alignments of each sample into a single BAM file
+    if fused_sort:
+        pipeline.collate(
+            task_func=stages.merge_sorted_alignment_chunks,
+            name='sort_alignment',
+            input=output_from('align_bwa_chunks'),
+            filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+)_chunks/chunk[0-9]+.bam'),
+            output='{subpath[0][1]}/{sample[0]}' + sorted_suffix)
+    else:
+        pipeline.collate(
+            task_func=stages.merge_alignment_chunks,
+            name='align_bwa',
+            input=output_from('align_bwa_chunks'),
+            filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+)_chunks/chunk[0-9]+.bam'),
+            output='{subpath[0][1]}/{sample[0]}.bam')
+
+
+def make_delly(pipeline, stages, state, regions, sorted_suffix='.sorted.bam', cohort=True):
+    '''Call structural variants with DELLY, jointly over all the samples.
+    Without cohort only the per-sample stages of incremental calling are
+    made.'''
+    if state.config.get_optional_stage_option('structural_variants_delly', 'incremental'):
+        make_incremental_delly(pipeline, stages, sorted_suffix, cohort)
+        return
+    if not cohort:
+        return
+    # Call DELs, DUPs and INVs with DELLY, optionally scattered over genomic
+    # regions
+    if state.config.get_optional_stage_option('structural_variants_delly', 'scatter'):
+        for sv_type, name in [('DEL', 'deletions_delly'),
+                              ('DUP', 'duplications_delly'),
+                              ('INV', 'inversions_delly')]:
+            make_scattered_delly(pipeline, stages, regions, sv_type, name)
+    else:
+        # Call DELs with DELLY 
+        pipeline.merge(
+            task_func=stages.deletions_delly,
+            name='deletions_delly',
+            input=output_from('sort_alignment'),
+            output='delly.DEL.vcf')
+
+        # Call DUPs with DELLY 
+        pipeline.merge(
+            task_func=stages.duplications_delly,
+            name='duplications_delly',
+            input=output_from('sort_alignment'),
+            output='delly.DUP.vcf')
+
+        # Call INVs with DELLY 
+        pipeline.merge(
+            task_func=stages.inversions_delly,
+            name='inversions_delly',
+            input=output_from('sort_alignment'),
+            output='delly.INV.vcf')
+
+    # Call TRAs with DELLY.
+    # Translocations join two chromosomes, so they can't be found within a
+    # single region. This stage is never scattered.
+    pipeline.merge(
+        task_func=stages.translocations_delly,
+        name='translocations_delly',
+        input=output_from('sort_alignment'),
+        output='delly.TRA.vcf')
+
+
+def make_incremental_delly(pipeline, stages, sorted_suffix='.sorted.bam', cohort=True):
+    '''Discover structural variants with DELLY in each sample separately,
+    merge the discoveries into the sites of the cohort, genotype each sample
+    at those sites, and merge the genotypes into the cohort VCF files. The
+    discoveries are kept, so adding a sample to the cohort only runs the
+    discovery on the new sample, followed by the genotyping.'''
+    for sv_type, name in [('DEL', 'deletions_delly'),
+                          ('DUP', 'duplications_delly'),
+                          ('INV', 'inversions_delly'),
+                          ('TRA', 'translocations_delly')]:
+        sample_name = '{}_sample'.format(name)
+        (pipeline.transform(
+            task_func=stages.structural_variants_delly_sample,
+            name=sample_name,
+            input=output_from('sort_alignment'),
+            filter=sorted_alignment_filter(sorted_suffix),
+            output='{{path[0]}}/{{sample[0]}}.delly.{}.bcf'.format(sv_type),
+            extras=[sv_type])
+            .follows('index_alignment'))
+
+        if cohort:
+            sites_name = '{}_sites'.format(name)
+            sites = 'delly.{}.sites.bcf'.format(sv_type)
+            pipeline.merge(
+                task_func=stages.merge_delly_sites,
+                name=sites_name,
+                input=output_from(sample_name),
+                output=sites,
+                extras=[sv_type])
+
+            genotype_name = '{}_genotype'.format(name)
+            (pipeline.transform(
+                task_func=stages.genotype_delly_sample,
+                name=genotype_name,
+                input=output_from('sort_alignment'),
+                filter=sorted_alignment_filter(sorted_suffix),
+                add_inputs=add_inputs(sites),
+                output='{{path[0]}}/{{sample[0]}}.delly.{}.geno.bcf'.format(sv_type),
+                extras=[sv_type])
+                .follows(sites_name))
+
+            pipeline.merge(
+                task_func=stages.merge_delly_calls,
+                name=name,
+                input=output_from(genotype_name),
+                output='delly.{}.vcf'.format(sv_type))
+
+
+# Scattered structural variant calling
+#
+# A scattered caller runs once per region listed in the scatter_regions
+# option, and a gather stage combines the per-region results into the
+# output that the unscattered stage would have made. Only reads aligned
+# within a region are seen by its job, so a scattered caller only reports
+# SVs with both breakpoints in the same region. Inter-chromosomal events
+# are lost, which is why translocations_delly is never scattered, and
+# regions should normally be whole chromosomes.
+
+def check_scatter_regions(regions, stage):
+    '''A scattered stage needs at least one region to scatter over'''
+    if not regions:
+        raise Exception("Stage: {} is scattered, but the configuration " \
+            "does not define any scatter_regions".format(stage))
+
+
+def make_scattered_delly(pipeline, stages, regions, sv_type, name):
+    '''Call one type of SV with DELLY separately in each region, then
+    gather the regions into a single VCF file for the cohort'''
+    check_scatter_regions(regions, 'structural_variants_delly')
+    shard_names = []
+    for region in regions:
+        shard_name = '{}_{}'.format(name, region_name(region))
+        (pipeline.merge(
+            task_func=stages.structural_variants_delly_shard,
+            name=shard_name,
+            input=output_from('sort_alignment'),
+            output='delly_shards/delly.{}.{}.vcf'.format(sv_type, region_name(region)),
+            extras=[sv_type, region])
+            .follows('index_alignment'))
+        shard_names.append(shard_name)
+
+    pipeline.merge(
+        task_func=stages.gather_vcfs,
+        name=name,
+        input=output_from(*shard_names),
+        output='delly.{}.vcf'.format(sv_type))
+
+
+def make_scattered_lumpy(pipeline, stages, regions, sorted_suffix='.sorted.bam'):
+    '''Call SVs with lumpy separately in each region of each sample, then
+    gather the regions into a single VCF file for each sample'''
+    check_scatter_regions(regions, 'structural_variants_lumpy')
+
+    # Region queries on the splitters and discordants need an index
+    pipeline.transform(
+        task_func=stages.index_bam,
+        name='index_discordants',
+        input=output_from('sort_discordants'),
+        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).discordants.bam'),
+        output='{path[0]}/{sample[0]}.discordants.bam.bai')
+
+    pipeline.transform(
+        task_func=stages.index_bam,
+        name='index_splitters',
+        input=output_from('sort_splitters'),
+        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+).splitters.bam'),
+        output='{path[0]}/{sample[0]}.splitters.bam.bai')
+
+    shard_names = []
+    for region in regions:
+        shard_name = 'structural_variants_lumpy_{}'.format(region_name(region))
+        (pipeline.transform(
+            task_func=stages.structural_variants_lumpy_shard,
+            name=shard_name,
+            input=output_from('sort_alignment'),
+            filter=sorted_alignment_filter(sorted_suffix),
+            add_inputs=add_inputs(['{path[0]}/{sample[0]}.splitters.bam', '{path[0]}/{sample[0]}.discordants.bam']),
+            output='{path[0]}/{sample[0]}_lumpy_shards/' + region_name(region) + '.vcf',
+            extras=[region])
+            .follows('index_alignment')
+            .follows('index_splitters')
+            .follows('index_discordants'))
+        shard_names.append(shard_name)
+
+    pipeline.collate(
+        task_func=stages.gather_vcfs,
+        name='structural_variants_lumpy',
+        input=output_from(*shard_names),
+        filter=formatter('.+/(?P<sample>[a-zA-Z0-9]+)_lumpy_shards/[^/]+.vcf'),
+        output='{subpath[0][1]}/{sample[0]}.lumpy.vcf')
+
+
+def make_scattered_socrates(pipeline, stages, regions, sorted_suffix='.sorted.bam',
+                            socrates_indexes=()):
+    '''Call SVs with Socrates separately in each region of each sample,
+    then gather the regions into a single results file for each sample.
+    The regions are called after the socrates_indexes tasks.'''
+    check_scatter_regions(regions, 'structural_variants_socrates')
+    shard_names = []
+    for region in regions:
+        shard_name = 'structural_variants_socrates_{}'.format(region_name(region))
+        # Socrates names its output after the input bam file, so the region
+        # of each sample is extracted to socrates/{region}/{sample}.{region}.bam
+        shard_dir = '{path[0]}/socrates/' + region_name(region)
+        shard_bam = '{}/{{sample[0]}}.{}.bam'.format(shard_dir, region_name(region))
+        follows_all(pipeline.transform(
+            task_func=stages.structural_variants_socrates_shard,
+            name=shard_name,
+            input=output_from('sort_alignment'),
+            filter=sorted_alignment_filter(sorted_suffix),
+            output='{}/results_Socrates_paired_{{sample[0]}}.{}_long_sc_l25_q5_m5_i95.txt' \
+                .format(shard_dir, region_name(region)),
+            extras=[shard_bam, region])
+            .follows('index_alignment'), socrates_indexes)
+        shard_names.append(shard_name)
+
+    pipeline.collate(
+        task_func=stages.gather_socrates,
+        name='structural_variants_socrates',
+        input=output_from(*shard_names),
+        filter=formatter('.+/socrates/[^/]+/results_Socrates_paired_(?P<sample>[a-zA-Z0-9]+)[.][^/]+.txt'),
+        output='{subpath[0][1]}/results_Socrates_paired_{sample[0]}.sorted_long_sc_l25_q5_m5_i95.txt')
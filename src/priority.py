@@ -0,0 +1,120 @@
+'''
+Critical path priorities for pipeline stages.
+
+Ruffus starts jobs as soon as their inputs are ready, in the order of the
+pipeline graph, so a job at the start of a long chain of stages (align,
+sort, call structural variants) waits its turn with cheap jobs at the
+end of short chains (fastqc, stats). The whole pipeline finishes sooner if
+the jobs with the longest chain of work still ahead of them go first.
+
+The priority of a task of the pipeline is the length of its remaining
+critical path: its own duration plus the longest remaining path of the
+tasks which follow it in the pipeline graph. The duration of a task is
+that of the stage it runs (several tasks may run the same stage, such as
+index_bam), from the "duration" option of the stage (in hours) or else
+from the mean run time of the stage in the run database.
+
+Jobs of tasks with a higher priority are started first by the job
+engine, and are submitted to the cluster with a lower nice value.
+'''
+
+import threading
+from functools import wraps
+from collections import defaultdict
+
+
+# Cluster jobs get a nice value between 0 (most urgent) and MAX_NICE
+MAX_NICE = 1000
+SECONDS_IN_HOUR = 3600.0
+
+
+class Priorities(object):
+    '''The remaining critical path of each task of the pipeline, in
+    seconds'''
+    def __init__(self, durations):
+        # stage -> duration in seconds
+        self.durations = durations
+        # task -> remaining critical path in seconds
+        self.remaining = {}
+        self.longest = 0.0
+        # the task whose job the current thread is running
+        self.current = threading.local()
+
+    def track(self, tasks):
+        '''Learn the remaining critical path of each task from the pipeline
+        graph: the (task, stage it runs, tasks which follow it) of each
+        task'''
+        durations = dict((task, self.durations.get(stage, 0.0))
+                         for task, stage, _ in tasks)
+        consumers = dict((task, following) for task, _, following in tasks)
+        self.remaining = remaining_critical_paths(durations, consumers)
+        self.longest = max(self.remaining.values()) if self.remaining else 0.0
+
+    def wrap(self, task, task_func):
+        '''Wrap the function of a ruffus task, so that its jobs are given
+        the priority of the task'''
+        @wraps(task_func)
+        def run_job(*params):
+            self.current.task = task
+            try:
+                return task_func(*params)
+            finally:
+                self.current.task = None
+        return run_job
+
+    def priority(self):
+        '''The priority of the job the current thread is running'''
+        return self.remaining.get(getattr(self.current, 'task', None), 0.0)
+
+    def nice(self):
+        '''SLURM nice value for the job the current thread is running,
+        smaller is more urgent'''
+        if self.longest <= 0:
+            return 0
+        return int(round(MAX_NICE * (1 - self.priority() / self.longest)))
+
+
+def stage_durations(config, jobs):
+    '''Duration in seconds of each stage: configured, or the mean run time
+    of its successful jobs'''
+    run_times = defaultdict(list)
+    for job in jobs:
+        run_time = job.run_time()
+        if job.succeeded() and run_time is not None:
+            run_times[job.stage].append(run_time)
+    durations = dict((stage, sum(times) / len(times))
+                     for stage, times in run_times.items())
+    for stage in config.get_option('stages') or {}:
+        duration = config.get_optional_stage_option(stage, 'duration')
+        if duration is not None:
+            durations[stage] = float(duration) * SECONDS_IN_HOUR
+    return durations
+
+
+def remaining_critical_paths(durations, consumers):
+    '''The remaining critical path of each task, from the duration of each
+    task and the tasks which follow it'''
+    remaining = {}
+
+    def longest(task, visiting):
+        if task in remaining:
+            return remaining[task]
+        visiting.add(task)
+        downstream = [longest(consumer, visiting) for consumer in consumers.get(task, [])
+                      if consumer not in visiting]
+        visiting.discard(task)
+        remaining[task] = durations.get(task, 0.0) + max(downstream or [0.0])
+        return remaining[task]
+
+    for task in set(durations) | set(consumers):
+        longest(task, set())
+    return remaining
+
+
+def make_priorities(config, rundb):
+    '''The task priorities, or None if the configuration does not turn on
+    prioritise. The tasks are learnt when the pipeline is built.'''
+    if not config.get_optional_option('prioritise', False):
+        return None
+    jobs = rundb.jobs() if rundb is not None else []
+    return Priorities(stage_durations(config, jobs))
@@ -0,0 +1,175 @@
+'''
+Preparation of the reference genome, with a cache of its indexes which is
+shared between projects.
+
+Without the reference_cache option, the indexes of the reference (made by
+bwa index, samtools faidx and, for Socrates, bowtie2-build) must be built
+by hand next to the FASTA file. With
+
+    reference_cache: /path/to/crpipe_references
+
+the pipeline builds them itself, once for each reference. The FASTA file
+is linked into reference_cache/<sha1 of its contents>/, and the indexes
+are built next to it by the index_reference_bwa, index_reference_samtools
+and index_reference_bowtie2 stages, which run in parallel. Every project
+whose reference has the same contents uses the same directory, whatever
+the path of its reference, so it finds the indexes up to date.
+
+The index stages run this module as a program:
+
+    python reference.py bwa /path/to/crpipe_references/<sha1>/genome.fa
+
+which takes a lock on the index, so that pipelines sharing the cache never
+build the same index at once: the second one waits for the lock, then
+finds the index built. Indexes are built under temporary names and renamed
+into place, so an interrupted build never leaves an index which looks
+complete.
+'''
+
+import os
+import sys
+import glob
+import errno
+import fcntl
+import sqlite3
+import hashlib
+import argparse
+import subprocess
+from utils import safe_make_dir
+
+
+# Read files in 1MB blocks when computing checksums
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+# Seconds to wait for another process to release its lock on the checksum
+# database
+CHECKSUM_DB_TIMEOUT = 60
+# The files made by each index, after the FASTA file (bwa, samtools) or
+# after the prefix of the bowtie2 index
+INDEX_SUFFIXES = {
+    'bwa': ['.amb', '.ann', '.bwt', '.pac', '.sa'],
+    'samtools': ['.fai'],
+    'bowtie2': ['.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2', '.rev.2.bt2'],
+}
+# Commands which build each index, with the files named after tmp
+BUILD_COMMANDS = {
+    'bwa': 'bwa index -p {tmp} {fasta}',
+    'samtools': 'samtools faidx --fai-idx {tmp}.fai {fasta}',
+    'bowtie2': 'bowtie2-build --threads {threads} {fasta} {tmp}',
+}
+
+SCHEMA = '''
+create table if not exists checksums (
+    path text primary key,
+    size integer,
+    mtime real,
+    inode integer,
+    digest text
+);
+'''
+
+
+def reference_checksum(cache_dir, path):
+    '''Checksum of the contents of a reference, remembered in the cache for
+    as long as the file's size, modification time and inode are the same'''
+    info = os.stat(path)
+    safe_make_dir(cache_dir)
+    with sqlite3.connect(os.path.join(cache_dir, 'checksums.db'),
+                         timeout=CHECKSUM_DB_TIMEOUT) as checksums:
+        checksums.executescript(SCHEMA)
+        row = checksums.execute('select size, mtime, inode, digest from checksums '
+            'where path = ?', (os.path.abspath(path),)).fetchone()
+    if row is not None and tuple(row[:3]) == (info.st_size, info.st_mtime, info.st_ino):
+        return row[3]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fasta:
+        for block in iter(lambda: fasta.read(CHECKSUM_BLOCK_SIZE), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+    with sqlite3.connect(os.path.join(cache_dir, 'checksums.db'),
+                         timeout=CHECKSUM_DB_TIMEOUT) as checksums:
+        checksums.execute('insert or replace into checksums values (?, ?, ?, ?, ?)',
+            (os.path.abspath(path), info.st_size, info.st_mtime, info.st_ino, digest))
+    return digest
+
+
+def cached_reference(cache_dir, reference):
+    '''The path of the reference in the cache'''
+    return os.path.join(os.path.abspath(cache_dir),
+                        reference_checksum(cache_dir, reference),
+                        os.path.basename(reference))
+
+
+def index_files(fasta, index):
+    '''The files of an index of the reference'''
+    prefix = bowtie2_prefix(fasta) if index == 'bowtie2' else fasta
+    return [prefix + suffix for suffix in INDEX_SUFFIXES[index]]
+
+
+def bowtie2_prefix(fasta):
+    '''The prefix of the bowtie2 index of the reference, for Socrates'''
+    name = os.path.splitext(os.path.basename(fasta))[0]
+    return os.path.join(os.path.dirname(fasta), 'bowtie2', name)
+
+
+def link_reference(reference, cached):
+    '''Put the reference in the cache, as a hard link if it is on the same
+    filesystem and a symbolic link otherwise'''
+    if os.path.exists(cached):
+        return
+    safe_make_dir(os.path.dirname(cached))
+    tmp = '{}.{}.crpipe_part'.format(cached, os.getpid())
+    try:
+        os.link(reference, tmp)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        os.symlink(os.path.abspath(reference), tmp)
+    # Another pipeline may be putting the same reference in place
+    os.rename(tmp, cached)
+
+
+def build_index(index, fasta, threads=1):
+    '''Build an index of the reference, unless it has been built already,
+    holding a lock on it while it is built'''
+    outputs = index_files(fasta, index)
+    safe_make_dir(os.path.dirname(outputs[0]))
+    with open('{}.{}.lock'.format(fasta, index), 'w') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        if all(os.path.exists(path) for path in outputs):
+            return
+        prefix = bowtie2_prefix(fasta) if index == 'bowtie2' else fasta
+        tmp = '{}.{}.{}'.format(prefix, index, os.getpid())
+        try:
+            command = BUILD_COMMANDS[index].format(tmp=tmp, fasta=fasta, threads=threads)
+            if subprocess.call(command, shell=True) != 0:
+                raise Exception("Failed to build the {} index of: {}".format(index, fasta))
+            for suffix, path in zip(INDEX_SUFFIXES[index], outputs):
+                os.rename(tmp + suffix, path)
+        finally:
+            for path in glob.glob(tmp + '.*'):
+                os.remove(path)
+
+
+def index_reference_command(index, fasta, threads=1):
+    '''The command which builds an index of the reference'''
+    program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    return '{python} {program} --threads {threads} {index} {fasta}' \
+        .format(python=sys.executable, program=program, threads=threads,
+                index=index, fasta=fasta)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build an index of the reference')
+    parser.add_argument('--threads', type=int, default=1, help='Threads for bowtie2-build')
+    parser.add_argument('index', choices=sorted(INDEX_SUFFIXES), help='Index to build')
+    parser.add_argument('fasta', help='Reference in FASTA format, in the reference cache')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    build_index(args.index, args.fasta, args.threads)
+
+
+if __name__ == '__main__':
+    main()
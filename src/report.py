@@ -0,0 +1,170 @@
+'''
+Report on the jobs recorded in the run database: where the time and
+memory of a pipeline run went, and which chain of jobs determined how
+long it took.
+
+    crpipe report [--config pipeline.config] [--run_db path] [--top N]
+
+The report has three parts:
+    - per stage: number of jobs and failures, total and mean run time,
+      mean queue wait, peak memory and CPU utilisation
+    - hotspots: the samples, and the jobs, which took the longest
+    - the critical path: the longest chain of jobs, each of which needed
+      the outputs of the one before it, which bounds the time taken by
+      the whole pipeline
+'''
+
+import os
+import re
+import argparse
+from collections import defaultdict
+from config import Config, DEFAULT_CONFIG_FILE
+from rundb import RunDatabase, DEFAULT_RUN_DB
+
+
+# Number of hotspots to show by default
+DEFAULT_TOP = 10
+# Sample names in file names, as matched by the pipeline stages
+SAMPLE_REGEX = re.compile('^([a-zA-Z0-9]+)')
+# Name of the sample of jobs which combine several samples
+COHORT = 'cohort'
+SECONDS_IN_HOUR = 3600.0
+
+
+def job_sample(inputs):
+    '''The sample a job works on, from the names of its input files, or
+    COHORT if the job combines the files of several samples'''
+    samples = set()
+    for path in inputs:
+        directory, name = os.path.split(path)
+        # chunks of a sample are in the sample's chunk directory
+        if os.path.basename(directory).endswith('_chunks'):
+            name = os.path.basename(directory)
+        match = SAMPLE_REGEX.match(name)
+        if match:
+            samples.add(match.group(1))
+    if len(samples) == 1:
+        return samples.pop()
+    return COHORT
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return sum(values) / float(len(values))
+
+
+def show(value, form='{:.2f}'):
+    return '-' if value is None else form.format(value)
+
+
+def stage_summary(jobs):
+    print('Stages')
+    print('{:<36} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>6}'.format('stage',
+        'jobs', 'failed', 'total(h)', 'mean(h)', 'wait(h)', 'peak(GB)', 'cpu%'))
+    by_stage = defaultdict(list)
+    for job in jobs:
+        by_stage[job.stage].append(job)
+    rows = []
+    for stage, stage_jobs in by_stage.items():
+        run_times = [job.run_time() for job in stage_jobs]
+        total = sum(run_time for run_time in run_times if run_time is not None)
+        peaks = [job.peak_rss for job in stage_jobs if job.peak_rss is not None]
+        utilisation = mean([job.cpu_utilisation() for job in stage_jobs])
+        wait = mean([job.queue_wait() for job in stage_jobs])
+        rows.append((total, stage, len(stage_jobs),
+            len([job for job in stage_jobs if not job.succeeded()]),
+            mean(run_times), wait, max(peaks) / 1024.0 if peaks else None,
+            utilisation * 100 if utilisation is not None else None))
+    for total, stage, count, failed, run_time, wait, peak, utilisation in \
+            sorted(rows, reverse=True):
+        print('{:<36} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>6}'.format(stage,
+            count, failed, show(total / SECONDS_IN_HOUR),
+            show(run_time / SECONDS_IN_HOUR if run_time is not None else None),
+            show(wait / SECONDS_IN_HOUR if wait is not None else None),
+            show(peak), show(utilisation, '{:.0f}')))
+
+
+def hotspots(jobs, top):
+    print('\nSamples by total run time')
+    by_sample = defaultdict(float)
+    for job in jobs:
+        by_sample[job.sample] += job.run_time() or 0.0
+    for sample, total in sorted(by_sample.items(), key=lambda item: -item[1])[:top]:
+        print('{:<36} {:>10}h'.format(sample, show(total / SECONDS_IN_HOUR)))
+    print('\nLongest jobs')
+    longest = sorted(jobs, key=lambda job: -(job.run_time() or 0.0))[:top]
+    for job in longest:
+        print('{:<36} {:<16} {:>10}h {:>10}GB'.format(job.stage, job.sample,
+            show((job.run_time() or 0.0) / SECONDS_IN_HOUR),
+            show(job.peak_rss / 1024.0 if job.peak_rss is not None else None)))
+
+
+def critical_path(jobs):
+    '''The longest chain of successful jobs, by time from submission to
+    finishing, in which each job used an output of the one before it. The
+    latest successful job to make each file is the one used.'''
+    producers = {}
+    for job in jobs:
+        if job.succeeded():
+            for output in job.outputs:
+                producers[output] = job
+    finish = {}
+
+    def longest(job, visiting):
+        # returns (time, chain) of the longest chain ending with job
+        if id(job) in finish:
+            return finish[id(job)]
+        visiting.add(id(job))
+        best = (0.0, [])
+        for path in job.inputs:
+            producer = producers.get(path)
+            if producer is None or id(producer) in visiting:
+                continue
+            best = max(best, longest(producer, visiting), key=lambda item: item[0])
+        visiting.discard(id(job))
+        finish[id(job)] = (best[0] + job.elapsed(), best[1] + [job])
+        return finish[id(job)]
+
+    result = (0.0, [])
+    for job in set(producers.values()):
+        result = max(result, longest(job, set()), key=lambda item: item[0])
+    return result
+
+
+def show_critical_path(jobs):
+    total, chain = critical_path(jobs)
+    print('\nCritical path: {}h'.format(show(total / SECONDS_IN_HOUR)))
+    for job in chain:
+        print('{:<36} {:<16} {:>10}h'.format(job.stage, job.sample,
+            show(job.elapsed() / SECONDS_IN_HOUR)))
+
+
+def report_command(args):
+    '''Report on the jobs in the run database: crpipe report'''
+    parser = argparse.ArgumentParser(prog='crpipe report',
+        description='Report where the time of pipeline runs went')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG_FILE,
+        help='Pipeline configuration file in YAML format, defaults to {}' \
+            .format(DEFAULT_CONFIG_FILE))
+    parser.add_argument('--run_db', type=str,
+        help='Run database, defaults to run_db from the configuration ' \
+             'file, or {}'.format(DEFAULT_RUN_DB))
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+        help='Number of hotspots to show, defaults to {}'.format(DEFAULT_TOP))
+    options = parser.parse_args(args)
+    run_db_path = options.run_db
+    if run_db_path is None:
+        run_db_path = DEFAULT_RUN_DB
+        if os.path.exists(options.config):
+            run_db_path = Config(options.config).get_optional_option('run_db',
+                DEFAULT_RUN_DB)
+    if not os.path.exists(run_db_path):
+        raise Exception("Run database {} does not exist".format(run_db_path))
+    jobs = RunDatabase(run_db_path).jobs()
+    for job in jobs:
+        job.sample = job_sample(job.inputs)
+    stage_summary(jobs)
+    hotspots(jobs, options.top)
+    show_critical_path(jobs)
@@ -0,0 +1,160 @@
+'''
+Accounting for the cores and memory of a machine, or of a cluster
+allocation, which are shared out between the jobs running on it.
+'''
+
+import os
+from collections import namedtuple
+from distutils.spawn import find_executable
+
+
+# Cores and memory (in MB) given to one job. cpus are the ids of the
+# processors the job is pinned to, or None if jobs are not pinned.
+Grant = namedtuple("Grant", ["cores", "mem", "cpus"])
+
+
+class ResourceBudget(object):
+    '''A fixed number of cores and amount of memory (in MB), from which
+    jobs acquire their share before they start, and release it when they
+    finish'''
+    def __init__(self, cores, mem, cpus=None):
+        self.cores = cores
+        self.mem = mem
+        self.free_cores = cores
+        self.free_mem = mem
+        # ids of the processors which are not pinned to a job, jobs are
+        # only pinned if there is a processor for each core
+        self.free_cpus = None
+        if cpus and len(cpus) >= cores:
+            self.free_cpus = list(cpus[:cores])
+
+    def try_acquire(self, cores, mem):
+        '''Take cores and memory for a job if they are free, returning a
+        Grant, or None if the job does not fit yet. A job which asks for
+        more than the whole budget gets the whole budget.'''
+        cores = min(cores, self.cores)
+        mem = min(mem, self.mem)
+        if cores > self.free_cores or mem > self.free_mem:
+            return None
+        self.free_cores -= cores
+        self.free_mem -= mem
+        cpus = None
+        if self.free_cpus is not None:
+            cpus, self.free_cpus = self.free_cpus[:cores], self.free_cpus[cores:]
+        return Grant(cores=cores, mem=mem, cpus=cpus)
+
+    def release(self, grant):
+        '''Return the resources of a finished job to the budget'''
+        self.free_cores += grant.cores
+        self.free_mem += grant.mem
+        if grant.cpus is not None:
+            self.free_cpus.extend(grant.cpus)
+
+    def idle(self):
+        return self.free_cores == self.cores and self.free_mem == self.mem
+
+
+def allowed_cpus():
+    '''The ids of the processors this process may run on (which in a
+    cluster allocation are the ones allocated to it), or None if they
+    can't be found'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Cpus_allowed_list:'):
+                    return parse_cpu_list(line.split(':', 1)[1])
+    except IOError:
+        pass
+    return None
+
+
+def total_memory():
+    '''The physical memory of the machine in MB, or None if it can't be
+    found'''
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (ValueError, OSError):
+        return None
+
+
+def parse_cpu_list(cpu_list):
+    '''Parse a list of processor ids in the kernel's format, eg: 0-3,8,10-11'''
+    cpus = []
+    for item in cpu_list.strip().split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif item:
+            cpus.append(int(item))
+    return cpus
+
+
+def limit_command(args, grant):
+    '''The command line and environment to run a job within its grant: it
+    is pinned to its processors (when taskset is available) and
+    multithreaded libraries are told how many cores it has'''
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(grant.cores)
+    if grant.cpus and find_executable('taskset'):
+        args = ['taskset', '-c', ','.join(map(str, grant.cpus))] + list(args)
+    return args, env
+
+
+def usage_from_rusage(rusage):
+    '''Peak memory (MB) and CPU time (seconds) of a finished process,
+    from the rusage returned by os.wait3 or os.wait4'''
+    # ru_maxrss is in KB on Linux
+    return {'peak_rss': rusage.ru_maxrss / 1024.0,
+            'cpu_time': rusage.ru_utime + rusage.ru_stime}
+
+
+def usage_from_drmaa(resource_usage, end_time):
+    '''Peak memory (MB), CPU time (seconds) and start and end times of a
+    finished cluster job, from the resource usage reported by DRMAA. The
+    names and units of the values depend on the DRMAA library, the ones
+    reported by slurm-drmaa and pbs-drmaa are recognised (memory in KB,
+    times in seconds).'''
+    usage = {}
+    for name in ('maxrss', 'mem', 'max_rss'):
+        if name in resource_usage:
+            usage['peak_rss'] = parse_number(resource_usage[name]) / 1024.0
+            break
+    for name in ('cpu', 'cpu_time'):
+        if name in resource_usage:
+            usage['cpu_time'] = parse_number(resource_usage[name])
+            break
+    if 'start_time' in resource_usage and 'end_time' in resource_usage:
+        usage['start_time'] = parse_number(resource_usage['start_time'])
+        usage['end_time'] = parse_number(resource_usage['end_time'])
+    elif 'walltime' in resource_usage:
+        usage['start_time'] = end_time - parse_number(resource_usage['walltime'])
+        usage['end_time'] = end_time
+    return usage
+
+
+def parse_number(value):
+    '''A number from DRMAA resource usage, which may have a unit suffix
+    (such as 100kb) that is dropped'''
+    number = str(value).strip().rstrip('kKbB')
+    try:
+        return float(number)
+    except ValueError:
+        return 0.0
+
+
+def parse_walltime(walltime):
+    '''The number of minutes in a walltime from the configuration file,
+    in Hours:Minutes (or Hours:Minutes:Seconds) format'''
+    fields = [int(field) for field in str(walltime).split(':')]
+    if len(fields) == 1:
+        return fields[0] * 60
+    minutes = fields[0] * 60 + fields[1]
+    if len(fields) == 3 and fields[2] > 0:
+        minutes += 1
+    return minutes
+
+
+def format_walltime(minutes):
+    '''A walltime in minutes in the Hours:Minutes format of the
+    configuration file'''
+    return '{}:{:02d}'.format(minutes // 60, minutes % 60)
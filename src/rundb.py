@@ -0,0 +1,266 @@
+'''
+A database of the jobs the pipeline has run, and the resources they used.
+
+Each job which finishes (successfully or not) is recorded with the
+resources it asked for, the total size of its input files, and the peak
+memory, CPU time and wall clock time it actually used (where the local
+machine or the cluster reports them). Stages with the "adaptive" option
+have their memory and walltime requests sized from these records instead
+of the guesses in the configuration file.
+
+The modification times of the files made by successful jobs are recorded
+too, as a snapshot of the state of the pipeline's files which the status
+command reads instead of looking at every file again, and so are the
+intermediate files removed by the cleanup (with where they were moved to,
+if they were kept in cold storage).
+
+The database is an sqlite file in the directory where the pipeline runs.
+'''
+
+import os
+import json
+import sqlite3
+import threading
+
+
+# default name of the run database
+DEFAULT_RUN_DB = '.crpipe_runs.sqlite'
+# Seconds to wait for another process to release a lock on the database
+DB_TIMEOUT = 60
+# Requests are this much more than the largest usage seen
+HEADROOM = 1.2
+# Smallest requests made for an adaptive stage, memory in MB and
+# walltime in minutes
+MIN_MEM = 512
+MIN_WALLTIME = 10
+# Only the most recent successful runs of a stage are used for sizing
+MAX_HISTORY = 50
+
+SCHEMA = '''
+create table if not exists jobs (
+    id integer primary key autoincrement,
+    stage text,
+    job_id text,
+    inputs text,
+    outputs text,
+    input_size integer,
+    cores integer,
+    mem integer,
+    walltime integer,
+    local integer,
+    submitted real,
+    started real,
+    finished real,
+    peak_rss real,
+    cpu_time real,
+    exit_status integer,
+    signal integer,
+    attempt integer
+);
+create index if not exists jobs_stage on jobs (stage);
+create table if not exists files (
+    path text primary key,
+    mtime real,
+    size integer
+);
+create table if not exists retired (
+    path text primary key,
+    mtime real,
+    destination text
+);
+'''
+
+
+class RunDatabase(object):
+    '''Records of the jobs run by the pipeline'''
+    def __init__(self, path=DEFAULT_RUN_DB):
+        self.path = path
+        # sqlite connections can't be shared between threads, so each
+        # operation opens its own
+        self.lock = threading.Lock()
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=DB_TIMEOUT)
+
+    def record(self, stage, job, inputs, outputs, attempt=0):
+        '''Record a finished job'''
+        usage = job.resource_usage
+        started = usage.get('start_time', job.start_time)
+        finished = usage.get('end_time', job.end_time)
+        with self.lock:
+            with self.connect() as db:
+                db.execute('insert into jobs (stage, job_id, inputs, outputs, '
+                    'input_size, cores, mem, walltime, local, submitted, started, '
+                    'finished, peak_rss, cpu_time, exit_status, signal, attempt) '
+                    'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (stage, str(job.job_id), json.dumps(inputs or []),
+                     json.dumps(outputs or []), input_size(inputs), job.cores,
+                     job.mem, job.walltime, int(job.local), job.submit_time,
+                     started, finished, usage.get('peak_rss'),
+                     usage.get('cpu_time'), job.exit_status, job.signal, attempt))
+                if job.exit_status == 0:
+                    self.save_file_states(db, outputs)
+
+    def record_files(self, paths):
+        '''Record the current state of files made without running a job,
+        for example restored from the cache'''
+        with self.lock:
+            with self.connect() as db:
+                self.save_file_states(db, paths)
+
+    def save_file_states(self, db, paths):
+        states = [(path,) + file_state(path) for path in paths or []]
+        db.executemany('insert or replace into files (path, mtime, size) '
+            'values (?, ?, ?)', [state for state in states if state[1] is not None])
+
+    def file_states(self):
+        '''path -> (modification time, size) of the files in the snapshot'''
+        with self.lock:
+            with self.connect() as db:
+                rows = db.execute('select path, mtime, size from files').fetchall()
+        return dict((path, (mtime, size)) for path, mtime, size in rows)
+
+    def record_retired(self, path, mtime, destination=None):
+        '''Record an intermediate file removed by the cleanup, with its
+        modification time and where it was moved to (None if deleted)'''
+        with self.lock:
+            with self.connect() as db:
+                db.execute('insert or replace into retired (path, mtime, destination) '
+                    'values (?, ?, ?)', (path, mtime, destination))
+
+    def forget_retired(self, path):
+        '''Forget a removed file which has been put back'''
+        with self.lock:
+            with self.connect() as db:
+                db.execute('delete from retired where path = ?', (path,))
+
+    def retired_files(self):
+        '''path -> (modification time, destination) of the files removed by
+        the cleanup'''
+        with self.lock:
+            with self.connect() as db:
+                rows = db.execute('select path, mtime, destination from retired').fetchall()
+        return dict((path, (mtime, destination)) for path, mtime, destination in rows)
+
+    def history(self, stage):
+        '''(input size, peak memory in MB, run time in minutes) of the most
+        recent successful jobs of a stage'''
+        with self.lock:
+            with self.connect() as db:
+                rows = db.execute('select input_size, peak_rss, started, finished '
+                    'from jobs where stage = ? and exit_status = 0 '
+                    'order by id desc limit ?', (stage, MAX_HISTORY)).fetchall()
+        history = []
+        for size, peak_rss, started, finished in rows:
+            run_time = None
+            if started is not None and finished is not None:
+                run_time = (finished - started) / 60.0
+            history.append((size or 0, peak_rss, run_time))
+        return history
+
+    def estimate(self, stage, size):
+        '''Memory (MB) and walltime (minutes) to request for a job of a
+        stage with inputs of the given total size. Either is None if
+        there are no records to base it on.'''
+        history = self.history(stage)
+        mem = fit_upper_bound([(s, m) for s, m, _ in history if m is not None], size)
+        walltime = fit_upper_bound([(s, t) for s, _, t in history if t is not None], size)
+        if mem is not None:
+            mem = max(int(mem * HEADROOM), MIN_MEM)
+        if walltime is not None:
+            walltime = max(int(walltime * HEADROOM) + 1, MIN_WALLTIME)
+        return mem, walltime
+
+    def jobs(self):
+        '''All the jobs in the database, oldest first'''
+        with self.lock:
+            with self.connect() as db:
+                rows = db.execute('select stage, job_id, inputs, outputs, cores, '
+                    'submitted, started, finished, peak_rss, cpu_time, exit_status '
+                    'from jobs order by id').fetchall()
+        return [JobRecord(row) for row in rows]
+
+
+class JobRecord(object):
+    '''A job from the run database'''
+    def __init__(self, row):
+        (self.stage, self.job_id, inputs, outputs, self.cores, self.submitted,
+         self.started, self.finished, self.peak_rss, self.cpu_time,
+         self.exit_status) = row
+        self.inputs = json.loads(inputs or '[]')
+        self.outputs = json.loads(outputs or '[]')
+
+    def succeeded(self):
+        return self.exit_status == 0
+
+    def run_time(self):
+        '''Seconds the job ran for, or None if unknown'''
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def queue_wait(self):
+        '''Seconds between submitting and starting the job, or None if unknown'''
+        if self.started is None or self.submitted is None:
+            return None
+        return max(self.started - self.submitted, 0.0)
+
+    def elapsed(self):
+        '''Seconds from submitting to finishing the job'''
+        if self.submitted is None or self.finished is None:
+            return self.run_time() or 0.0
+        return self.finished - self.submitted
+
+    def cpu_utilisation(self):
+        '''Fraction of the requested cores which the job kept busy'''
+        run_time = self.run_time()
+        if self.cpu_time is None or not run_time or not self.cores:
+            return None
+        return self.cpu_time / (run_time * self.cores)
+
+
+def fit_upper_bound(points, x):
+    '''Predict the largest y for x from (x, y) points. Usage is assumed
+    to grow linearly with input size: a least squares line is moved up
+    to lie above every point. With fewer than two different sizes, usage
+    is assumed to grow in proportion to size.'''
+    if not points:
+        return None
+    sizes = set(size for size, _ in points)
+    if len(sizes) < 2:
+        size, y = max(points, key=lambda point: point[1])
+        if size > 0 and x > size:
+            return y * float(x) / size
+        return y
+    n = float(len(points))
+    mean_x = sum(size for size, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((size - mean_x) ** 2 for size, _ in points)
+    slope = sum((size - mean_x) * (y - mean_y) for size, y in points) / var_x
+    slope = max(slope, 0.0)
+    intercept = mean_y - slope * mean_x
+    offset = max(y - (intercept + slope * size) for size, y in points)
+    return max(intercept + slope * x + offset, 0.0)
+
+
+def file_state(path):
+    '''(modification time, size) of a file, or (None, None) if it does not
+    exist'''
+    try:
+        info = os.stat(path)
+    except OSError:
+        return (None, None)
+    return (info.st_mtime, info.st_size)
+
+
+def input_size(inputs):
+    '''Total size in bytes of the input files of a job which exist'''
+    total = 0
+    for path in inputs or []:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
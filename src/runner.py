@@ -4,11 +4,33 @@ taking into account the configuration settings,
 and command line options of the pipeline.
 '''
 
-from ruffus.drmaa_wrapper import run_job, error_drmaa_job
+import os
+import re
+import signal
+import multiprocessing
+from engine import Job, JobError, read_lines
+from executor import DrmaaExecutor, LocalExecutor, MockCluster, MOCK_NODES, \
+    MOCK_NODE_CORES, MOCK_NODE_MEM
+from packer import Packing, MAX_PACK_JOBS
+from resources import ResourceBudget, parse_walltime, format_walltime, \
+    allowed_cpus, total_memory
+from rundb import input_size
+from cache import remove_file
 
 
 # slurm memory is requested in MB, but the config file specifies in GB
 MEGABYTES_IN_GIGABYTE = 1024
+# Number of times to resubmit an adaptive job killed for lack of resources
+DEFAULT_RESOURCE_RETRIES = 2
+# Messages from SLURM in the stderr of jobs killed for lack of resources
+OUT_OF_MEMORY_MESSAGES = ['oom-kill', 'Exceeded job memory limit', 'out-of-memory', 'OUT_OF_MEMORY']
+OUT_OF_TIME_MESSAGES = ['DUE TO TIME LIMIT', 'TIMEOUT']
+# Shell variable holding the private scratch directory of a job of a stage
+# with the scratch option
+SCRATCH_VARIABLE = 'CRPIPE_SCRATCH'
+# Characters which end a path in a command: shell syntax, the = of an
+# option and the ## of samtools' file##idx##index syntax
+PATH_BOUNDARY = r'''\s'"=<>|;&(),#'''
 
 '''
 SLURM options:
@@ -33,8 +55,26 @@ SLURM options:
                         REQUEUE, and ALL (any state change)
 '''
 
-def run_stage(state, stage, command):
-    '''Run a pipeline stage, either locally or on the cluster'''
+def run_stage(state, stage, command, inputs=None, outputs=None, extra_cores=0):
+    '''Run a pipeline stage, either locally or on the cluster.
+
+    If the input and output files of the command are given, and the output
+    cache is enabled, the outputs are restored from the cache when the same
+    command has already been run on the same inputs.
+
+    Every job is recorded in the run database. Stages with the "adaptive"
+    option request memory and walltime according to what earlier jobs of
+    the stage used, and jobs killed for running out of memory or time are
+    resubmitted with more.
+
+    Stages with the "scratch" option run in a private directory on
+    node-local disk, from which the outputs are copied back when the
+    command succeeds.
+
+    Commands which run helper processes alongside the tool (such as the
+    parallel FASTQ reader) request extra_cores cores on top of the cores
+    of the stage.
+    '''
 
     # Grab the configuration options for this stage
     config = state.config
@@ -45,36 +85,296 @@ def run_stage(state, stage, command):
     walltime = config.get_stage_option(stage, 'walltime')
     run_local = config.get_stage_option(stage, 'local')
     cores = config.get_stage_option(stage, 'cores')
+    if extra_cores:
+        cores = int(cores) + extra_cores
+    # Submit the jobs of this stage to the cluster as job arrays
+    array = config.get_optional_stage_option(stage, 'array', False)
+    # Size memory and walltime requests from earlier jobs of the stage
+    adaptive = state.rundb is not None and \
+        config.get_optional_stage_option(stage, 'adaptive', False)
+    retries = 0
+    if adaptive:
+        retries = config.get_optional_stage_option(stage, 'resource_retries',
+            DEFAULT_RESOURCE_RETRIES)
+        mem, walltime = adapt_resources(state, stage, inputs, mem, walltime)
+    # Run the jobs of this stage in allocations shared with other short jobs
+    pack = use_packing(config, stage, walltime)
+    # Start the jobs of tasks with the longest critical path ahead first
+    priority, nice = 0, None
+    if state.priorities is not None:
+        priority, nice = state.priorities.priority(), state.priorities.nice()
 
     # Generate a "module load" command for each required module
     module_loads = '\n'.join(['module load ' + module for module in modules])
-    cluster_command = '\n'.join([module_loads, command])
-
-    # Specify job-specific options for SLURM
-    job_options = '--nodes=1 --ntasks-per-node={cores} --ntasks={cores} --time={time} --mem={mem} --partition={queue} --account={account}' \
-                      .format(cores=cores, time=walltime, mem=mem, queue=queue, account=account)
-
-    # Log a message about the job we are about to run
-    log_messages = ['Running stage: {}'.format(stage),
-                    'Command: {}'.format(command)]
-    if not run_local:
-        log_messages.append('Job options: {}'.format(job_options))
-    state.logger.info('\n'.join(log_messages))
-
-    # Run the job, capturing stdout and stderr
-    stdout_res, stderr_res = None, None
-    try:
-        stdout_res, stderr_res = \
-            run_job(cmd_str=cluster_command,
-                job_name = stage,
-                logger = state.logger.proxy,
-                drmaa_session = state.drmaa_session,
-                # Determines whether to run the command on the local
-                # machine or run it on the cluster
-                run_locally = run_local,
-                # Keep a copy of the job script for diagnostic purposes
-                retain_job_scripts = True,
-                job_script_directory = state.options.jobscripts, 
-                job_other_options = job_options)
-    except error_drmaa_job as err:
-        raise Exception("\n".join(map(str, ["Failed to run:", command, err, stdout_res, stderr_res])))
+    scratch = config.get_optional_stage_option(stage, 'scratch')
+    if scratch is not None:
+        copy_inputs = config.get_optional_stage_option(stage, 'scratch_inputs', False)
+        cluster_command = '\n'.join([module_loads, scratch_command(command,
+            scratch, inputs or [], outputs or [], copy_inputs)])
+    else:
+        cluster_command = '\n'.join([module_loads, command])
+
+    # Look for the outputs of the job in the cache
+    cache_key = None
+    if use_cache(state, stage, outputs):
+        cache_key = state.cache.key(command, inputs or [], outputs, modules)
+        if state.cache.restore(cache_key, outputs):
+            if state.rundb is not None:
+                state.rundb.record_files(outputs)
+            if state.stat_cache is not None:
+                state.stat_cache.invalidate(outputs)
+            state.logger.info('\n'.join(['Restored stage from cache: {}'.format(stage),
+                                         'Command: {}'.format(command)]))
+            return
+        # The outputs may be hard links into the cache, which the command
+        # must not overwrite in place
+        for output in outputs:
+            remove_file(output)
+
+    for attempt in range(retries + 1):
+        # Specify job-specific options for SLURM
+        job_options = make_job_options(cores, walltime, mem, queue, account, nice)
+
+        # Log a message about the job we are about to run
+        log_messages = ['Running stage: {}'.format(stage),
+                        'Command: {}'.format(command)]
+        if not run_local:
+            log_messages.append('Job options: {}'.format(job_options))
+        state.logger.info('\n'.join(log_messages))
+
+        # Run the job, capturing stdout and stderr. The job engine runs the
+        # command on the local machine or submits it to the cluster, and
+        # this thread sleeps until it has finished.
+        job = Job(command=cluster_command, name=stage, options=job_options,
+                  local=run_local, array=array, pack=pack, cores=cores, mem=mem,
+                  walltime=parse_walltime(walltime), priority=priority)
+        try:
+            state.engine.run(job)
+            state.logger.info(usage_message(stage, job))
+            break
+        except JobError as err:
+            shortage = resource_shortage(job)
+            if shortage is None or attempt == retries:
+                raise Exception("\n".join(map(str, ["Failed to run:", command, err])))
+            # Try again with twice as much of what the job ran out of
+            if shortage == 'mem':
+                mem *= 2
+            else:
+                walltime = format_walltime(parse_walltime(walltime) * 2)
+            state.logger.info('Stage {} ran out of {}, resubmitting'.format(stage, shortage))
+        finally:
+            if state.rundb is not None and job.done.is_set():
+                state.rundb.record(stage, job, inputs, outputs, attempt)
+            # Files written by the job (all files, if its outputs are not
+            # known) are looked at again by later up to date checks
+            if state.stat_cache is not None:
+                state.stat_cache.invalidate(outputs)
+
+    if cache_key is not None:
+        state.cache.store(cache_key, stage, outputs)
+
+
+def usage_message(stage, job):
+    '''A log message about the time and memory a finished job used'''
+    usage = job.resource_usage
+    start_time = usage.get('start_time', job.start_time)
+    end_time = usage.get('end_time', job.end_time)
+    message = ['Finished stage: {}'.format(stage)]
+    if start_time is not None and end_time is not None:
+        message.append('Run time: {:.0f}s'.format(end_time - start_time))
+    if start_time is not None and job.submit_time is not None:
+        message.append('Queue wait: {:.0f}s'.format(max(start_time - job.submit_time, 0)))
+    if 'peak_rss' in usage:
+        message.append('Peak memory: {:.0f}MB'.format(usage['peak_rss']))
+    if 'cpu_time' in usage:
+        message.append('CPU time: {:.0f}s'.format(usage['cpu_time']))
+    return '\n'.join(message)
+
+
+def adapt_resources(state, stage, inputs, mem, walltime):
+    '''Memory (MB) and walltime to request for a job of an adaptive stage,
+    from the usage of earlier jobs of the stage with inputs of different
+    sizes. Requests without earlier jobs to go on are left as configured.'''
+    size = input_size(inputs)
+    estimated_mem, estimated_walltime = state.rundb.estimate(stage, size)
+    if estimated_mem is not None:
+        mem = estimated_mem
+    if estimated_walltime is not None:
+        walltime = format_walltime(estimated_walltime)
+    return mem, walltime
+
+
+def resource_shortage(job):
+    '''Decide whether a failed job was killed for running out of memory
+    ('mem') or time ('walltime'), or return None if it failed for some
+    other reason'''
+    if job.error is not None:
+        return None
+    stderr = ''.join(read_lines(job.stderr_path, tries=1))
+    if any(message in stderr for message in OUT_OF_MEMORY_MESSAGES):
+        return 'mem'
+    if any(message in stderr for message in OUT_OF_TIME_MESSAGES):
+        return 'walltime'
+    usage = job.resource_usage
+    killed = job.signal in (signal.SIGKILL, signal.SIGXCPU) or \
+        job.exit_status in (128 + signal.SIGKILL, 128 + signal.SIGXCPU)
+    if killed and usage.get('peak_rss', 0) >= job.mem * 0.95:
+        return 'mem'
+    if killed and 'start_time' in usage and 'end_time' in usage and \
+            usage['end_time'] - usage['start_time'] >= job.walltime * 60 * 0.95:
+        return 'walltime'
+    return None
+
+
+def make_job_options(cores, walltime, mem, queue, account, nice=None):
+    '''SLURM options for a job, with mem in MB'''
+    options = '--nodes=1 --ntasks-per-node={cores} --ntasks={cores} --time={time} --mem={mem} --partition={queue} --account={account}' \
+                  .format(cores=cores, time=walltime, mem=mem, queue=queue, account=account)
+    if nice is not None:
+        options += ' --nice={}'.format(nice)
+    return options
+
+
+def use_packing(config, stage, walltime):
+    '''Decide whether to pack the jobs of a stage into shared allocations:
+    either the stage says so with "pack: True", or its walltime is no more
+    than the "threshold" of the pack settings'''
+    pack = config.get_optional_stage_option(stage, 'pack')
+    if pack is not None:
+        return pack
+    threshold = config.get_optional_stage_option('pack', 'threshold')
+    return threshold is not None and \
+        parse_walltime(walltime) <= parse_walltime(threshold)
+
+
+def make_packing(config):
+    '''The allocations for packed jobs, whose resources are given by the
+    settings of the "pack" stage, or None if there is no "pack" stage'''
+    if 'pack' not in config.get_option('stages'):
+        return None
+    cores = config.get_stage_option('pack', 'cores')
+    mem = config.get_stage_option('pack', 'mem') * MEGABYTES_IN_GIGABYTE
+    walltime = config.get_stage_option('pack', 'walltime')
+    queue = config.get_stage_option('pack', 'queue')
+    account = config.get_stage_option('pack', 'account')
+    max_jobs = config.get_optional_stage_option('pack', 'max_jobs', MAX_PACK_JOBS)
+    return Packing(cores, mem, parse_walltime(walltime),
+        make_job_options(cores, walltime, mem, queue, account), max_jobs)
+
+
+def make_local_budget(config):
+    '''The cores and memory shared by jobs which run on the local machine,
+    given by the local_cores and local_mem (in GB) options, and defaulting
+    to those of the machine (or of the allocation the pipeline runs in)'''
+    cpus = allowed_cpus()
+    cores = config.get_optional_option('local_cores')
+    if cores is None:
+        cores = len(cpus) if cpus else multiprocessing.cpu_count()
+    mem = config.get_optional_option('local_mem')
+    if mem is not None:
+        mem = int(float(mem) * MEGABYTES_IN_GIGABYTE)
+    else:
+        mem = total_memory() or float('inf')
+    return ResourceBudget(cores, mem, cpus)
+
+
+def make_executor(config, job_script_dir, local_budget):
+    '''The executor of the jobs which are not local, chosen by the executor
+    option: the cluster through DRMAA (the default), the local machine,
+    sharing local_budget with the local jobs, or a mock cluster whose
+    nodes and queue are given by the mock_* options (memory in GB)'''
+    executor = config.get_optional_option('executor', 'drmaa')
+    if executor == 'local':
+        return LocalExecutor(local_budget)
+    if executor == 'mock':
+        mem = config.get_optional_option('mock_node_mem')
+        return MockCluster(
+            nodes=config.get_optional_option('mock_nodes', MOCK_NODES),
+            cores=config.get_optional_option('mock_node_cores', MOCK_NODE_CORES),
+            mem=int(float(mem) * MEGABYTES_IN_GIGABYTE) if mem is not None else MOCK_NODE_MEM,
+            queue_latency=config.get_optional_option('mock_queue_latency', 0),
+            submit_latency=config.get_optional_option('mock_submit_latency', 0),
+            runtime=config.get_optional_option('mock_runtime', 0))
+    return DrmaaExecutor(job_script_dir)
+
+
+def scratch_command(command, scratch, inputs, outputs, copy_inputs=False):
+    '''Wrap a command so that it runs with a private directory under
+    scratch (named by $CRPIPE_SCRATCH), and writes its outputs there. The
+    outputs are copied back (to a temporary name, then renamed into place)
+    only if the command succeeds, and the directory is removed however the
+    job ends. With copy_inputs the inputs are copied to the directory
+    first, otherwise they are read where they are.
+
+    Only whole paths in the command are replaced, and every output must be
+    named in it. The job fails if the tool writes a file next to its
+    outputs in scratch which is not an output itself (such as an index),
+    as that file would be lost with the directory.'''
+    scratch_paths = []
+    replacements = []
+    for n, path in enumerate(outputs):
+        if not path_pattern(path).search(command):
+            raise Exception("Output: {} is not named in the command, so it " \
+                "can't be written to scratch: {}".format(path, command))
+        scratch_path = '${}/output{}_{}'.format(SCRATCH_VARIABLE, n, os.path.basename(path))
+        scratch_paths.append(scratch_path)
+        replacements.append((path, scratch_path))
+    lines = ['{var}=$(mktemp -d {scratch}/crpipe.XXXXXX) || exit 1'.format(
+                 var=SCRATCH_VARIABLE, scratch=scratch),
+             'export {}'.format(SCRATCH_VARIABLE),
+             # copies of outputs which have not been renamed into place yet
+             # are removed along with the directory
+             "trap 'rm -rf ${var} {parts}' EXIT".format(var=SCRATCH_VARIABLE,
+                 parts=' '.join(path + '.crpipe_part' for path in outputs)),
+             "trap 'exit 143' INT TERM"]
+    if copy_inputs:
+        for n, path in enumerate(inputs):
+            scratch_path = '${}/input{}_{}'.format(SCRATCH_VARIABLE, n, os.path.basename(path))
+            lines.append('cp {} {} || exit 1'.format(path, scratch_path))
+            replacements.append((path, scratch_path))
+    # Replace longer paths first, in case one path is a prefix of another
+    replacements.sort(key=lambda item: len(item[0]), reverse=True)
+    for path, scratch_path in replacements:
+        command = path_pattern(path).sub(lambda match: scratch_path, command)
+    lines.extend(['(', command, ') || exit $?'])
+    if outputs:
+        # Files named after an output, which the tool wrote alongside it
+        lines.extend(['for written in ${}/output*; do'.format(SCRATCH_VARIABLE),
+                      '    case $written in',
+                      '        {}) ;;'.format('|'.join(scratch_paths)),
+                      '        *) [ -e "$written" ] || continue',
+                      '           echo "$written is not an output of the stage, ' \
+                      'it would be lost in scratch" >&2',
+                      '           exit 1 ;;',
+                      '    esac',
+                      'done'])
+    for path, scratch_path in zip(outputs, scratch_paths):
+        lines.append('cp {scratch_path} {part} && mv -f {part} {path} || exit 1'
+                     .format(scratch_path=scratch_path, part=path + '.crpipe_part', path=path))
+    return '\n'.join(lines)
+
+
+def path_pattern(path):
+    '''A regular expression matching a path where it is a whole word of a
+    command, and not part of a longer path'''
+    return re.compile('(?<![^{boundary}]){path}(?![^{boundary}])'.format(
+        boundary=PATH_BOUNDARY, path=re.escape(path)))
+
+
+def stage_tmp_dir(config, stage, default):
+    '''The directory for the temporary files of the tool run by a stage:
+    the job's scratch directory if the stage has the scratch option, or
+    else default'''
+    if config.get_optional_stage_option(stage, 'scratch') is not None:
+        return '$' + SCRATCH_VARIABLE
+    return default
+
+
+def use_cache(state, stage, outputs):
+    '''Decide whether to use the output cache for a job. The cache only
+    holds regular files, and can be disabled for a stage with "cache: False"'''
+    if state.cache is None or not outputs:
+        return False
+    if not state.config.get_optional_stage_option(stage, 'cache', True):
+        return False
+    return not any(os.path.isdir(output) for output in outputs)
@@ -7,14 +7,44 @@ the state parameter, has full access to the state of the pipeline, such
 as config, options, DRMAA and the logger.
 '''
 
-from utils import safe_make_dir
-from runner import run_stage
+from utils import safe_make_dir, parse_region, read_fasta_index, \
+    alignment_index, is_cram
+from runner import run_stage, stage_tmp_dir, MEGABYTES_IN_GIGABYTE
+from fastq_qc import fastq_qc_command, qc_tsv
+from fastq_reader import fastq_reader_command
+from reference import cached_reference, link_reference, index_files, \
+    bowtie2_prefix, index_reference_command
 import os
 
+# Chromosomes extracted by extract_chromosomes_samtools by default
+DEFAULT_EXTRACT_CHROMOSOMES = ['chr2', 'chr3', 'chr7']
+
+
+def runs_stage(stage):
+    '''Mark a method of Stages with the stage whose options its jobs run
+    with, when that is not the name of the method'''
+    def mark(method):
+        method.stage = stage
+        return method
+    return mark
+
+
+def task_stage(task_func):
+    '''The stage whose options the jobs of a task function run with'''
+    return getattr(task_func, 'stage', task_func.__name__)
+
+
 class Stages(object):
     def __init__(self, state):
         self.state = state
-        self.reference = self.get_options('reference')
+        self.reference_in = self.get_options('reference')
+        # With the reference_cache option the reference is read from the
+        # cache, where the pipeline builds its indexes
+        self.reference_cache = self.state.config.get_optional_option('reference_cache')
+        if self.reference_cache is not None:
+            self.reference = cached_reference(self.reference_cache, self.reference_in)
+        else:
+            self.reference = self.reference_in
 
     def get_stage_options(self, stage, *options):
         return self.state.config.get_stage_options(stage, *options)
@@ -22,25 +52,175 @@ class Stages(object):
     def get_options(self, *options):
         return self.state.config.get_options(*options)
 
+    def make_dir(self, path):
+        '''Make an output directory if it does not already exist, which the
+        stat cache may already know'''
+        if self.state.stat_cache is not None:
+            self.state.stat_cache.make_dir(path)
+        else:
+            safe_make_dir(path)
+
+    def reference_option(self, bam_in):
+        '''The samtools view option giving the reference for reading a CRAM
+        file, nothing for a BAM file'''
+        return ' -T {}'.format(self.reference) if is_cram(bam_in) else ''
+
+    def output_format(self, bam_out):
+        '''The samtools sort and merge options to write an alignment in the
+        format its name says, CRAM being compressed against the reference'''
+        if is_cram(bam_out):
+            return ' -O cram --reference {}'.format(self.reference)
+        return ''
+
     def original_fastqs(self, output):
         '''Original fastq files'''
         pass
 
+    def original_reference(self, output):
+        '''Put the reference in the reference cache'''
+        link_reference(self.reference_in, output)
+
+    def index_reference_bwa(self, fasta_in, outputs):
+        '''Index the reference with bwa, unless another pipeline has'''
+        self.index_reference('bwa', fasta_in)
+
+    def index_reference_samtools(self, fasta_in, outputs):
+        '''Index the reference with samtools, unless another pipeline has'''
+        self.index_reference('samtools', fasta_in)
+
+    def index_reference_bowtie2(self, fasta_in, outputs):
+        '''Index the reference with bowtie2 for Socrates, unless another
+        pipeline has'''
+        self.index_reference('bowtie2', fasta_in)
+
+    def index_reference(self, index, fasta_in):
+        '''Build an index of the reference in the reference cache'''
+        stage = 'index_reference_' + index
+        cores = self.state.config.get_stage_option(stage, 'cores')
+        command = index_reference_command(index, fasta_in, cores)
+        run_stage(self.state, stage, command,
+            inputs=[fasta_in], outputs=index_files(fasta_in, index))
+
+    def bowtie2_index(self):
+        '''The bowtie2 index of the reference for Socrates: the
+        bowtie2_ref_dir option of the stage, or else the one the pipeline
+        builds in the reference cache'''
+        bowtie2_ref_dir = self.state.config.get_optional_stage_option(
+            'structural_variants_socrates', 'bowtie2_ref_dir')
+        if bowtie2_ref_dir is None and self.reference_cache is not None:
+            return bowtie2_prefix(self.reference)
+        return self.state.config.get_stage_option('structural_variants_socrates', 'bowtie2_ref_dir')
+
     def fastq_to_fasta(self, fastq_in, fasta_out):
         '''Convert FASTQ file to FASTA'''
         # -n flag says keep reads with 'N' (unknown) bases, otherwise
         # they would have been discarded
         # -Q33 means use Illumina quality scores
-        command = 'zcat {fastq_in} | fastq_to_fasta -n -Q33 -o {fasta_out}'.format(fastq_in=fastq_in, fasta_out=fasta_out)
-        run_stage(self.state, 'fastq_to_fasta', command)
+        command = self.read_fastqs([fastq_in],
+            'fastq_to_fasta -n -Q33 -o {fasta_out}'.format(fasta_out=fasta_out), fasta_out)
+        run_stage(self.state, 'fastq_to_fasta', command,
+            inputs=[fastq_in], outputs=[fasta_out], extra_cores=self.reader_cores(1))
 
 
     def fastqc(self, fastq_in, dir_out):
         '''Quality check fastq file using fastqc'''
-        safe_make_dir(dir_out)
+        self.make_dir(dir_out)
         command = "fastqc --quiet -o {dir} {fastq}".format(dir=dir_out, fastq=fastq_in)
         run_stage(self.state, 'fastqc', command)
-    
+
+
+    def fastq_qc(self, inputs, json_out, sample):
+        '''Quality check the pair of fastq files of a sample, without fastqc'''
+        tsv_out = qc_tsv(json_out)
+        command = fastq_qc_command(inputs, json_out, tsv_out,
+            workers=self.decompress_workers())
+        run_stage(self.state, 'fastq_qc', command,
+            inputs=list(inputs), outputs=[json_out, tsv_out],
+            extra_cores=self.reader_cores(len(inputs)))
+
+    def qc_tap(self):
+        '''Whether the fastq files are quality checked as bwa reads them'''
+        return self.state.config.get_optional_option('qc', 'fastqc') == 'tap' and \
+            not self.state.config.get_optional_stage_option('align_bwa', 'chunk_size')
+
+    def decompress_workers(self):
+        '''The number of processes decompressing each fastq file, or None
+        if the fastq files are read by the tools themselves'''
+        return self.state.config.get_optional_option('decompress_workers')
+
+    def reader_cores(self, files):
+        '''The cores taken by the processes decompressing the given number
+        of fastq files at once, which a job requests on top of the cores of
+        its stage (the tools are still given the stage's cores)'''
+        workers = self.decompress_workers()
+        return int(workers) * files if workers else 0
+
+    def read_fastqs(self, fastqs, command, output, interleave=False):
+        '''A command which reads fastq from its input, fed the fastq files
+        by the parallel reader (interleaved if the flag is set) with the
+        decompress_workers option, or by zcat. The command fails if the
+        reader does.'''
+        workers = self.decompress_workers()
+        if not workers and not interleave:
+            return 'zcat {fastqs} | {command}'.format(fastqs=' '.join(fastqs),
+                                                      command=command)
+        reader = fastq_reader_command(fastqs, workers or 1, interleave)
+        # sh has no pipefail, so the status of the reader is kept in a file
+        return \
+        '''(
+reader_status=$(mktemp {output}.reader.XXXXXX)
+({reader}; echo $? > $reader_status) | {command}
+status=$?
+[ "$(cat $reader_status)" = 0 ] || status=1
+rm -f $reader_status
+exit $status
+)'''.format(output=output, reader=reader, command=command)
+
+    def aligner_reads(self, inputs):
+        '''The bwa mem option and arguments which give it the fastq files:
+        named pipes fed by the quality check when it taps the alignment,
+        interleaved pairs on its input with the decompress_workers option,
+        or else the files'''
+        if self.qc_tap():
+            return '', '$qc_fifos/R1 $qc_fifos/R2'
+        if self.decompress_workers():
+            return ' -p', '-'
+        return '', ' '.join(inputs)
+
+    def feed_alignment(self, align_command, inputs, bam_out, sample):
+        '''Run the alignment command with what reads the fastq files for it
+        (see aligner_reads). Returns the command and the outputs of the
+        quality check, if it taps the alignment.'''
+        if self.qc_tap():
+            return self.tap_alignment(align_command, inputs, bam_out, sample)
+        if self.decompress_workers():
+            return self.read_fastqs(inputs, align_command, bam_out, interleave=True), []
+        return align_command, []
+
+    def tap_alignment(self, align_command, inputs, bam_out, sample):
+        '''Run the alignment command alongside the quality check which
+        feeds it the fastq files. Returns the command and the outputs of
+        the quality check.'''
+        json_out = os.path.join(os.path.dirname(bam_out), sample + '.qc.json')
+        tsv_out = qc_tsv(json_out)
+        qc_command = fastq_qc_command(inputs, json_out, tsv_out,
+            taps=['$qc_fifos/R1', '$qc_fifos/R2'], workers=self.decompress_workers())
+        # If the alignment fails the quality check may be waiting for bwa to
+        # open the pipes, so it is stopped
+        command = \
+        '''
+qc_fifos=$(mktemp -d {bam}.qc.XXXXXX)
+mkfifo $qc_fifos/R1 $qc_fifos/R2
+{qc_command} &
+qc_pid=$!
+{align_command}
+status=$?
+[ $status -eq 0 ] || kill $qc_pid
+wait $qc_pid || status=1
+rm -rf $qc_fifos
+exit $status
+        '''.format(bam=bam_out, qc_command=qc_command, align_command=align_command)
+        return command, [json_out, tsv_out]
 
 
     def align_bwa(self, inputs, bam_out, sample):
@@ -52,37 +232,182 @@ class Stages(object):
         # number of threads to give to bwa's -t option
         cores = self.state.config.get_stage_option('align_bwa', 'cores')
         # Run bwa and pipe the output through samtools view to generate a BAM file
-        command = 'bwa mem -t {cores} -R "{read_group}" {reference} {fastq_read1} {fastq_read2} ' \
+        # bwa reads the fastq files, or is fed them (see aligner_reads)
+        interleave, reads = self.aligner_reads(inputs)
+        command = 'bwa mem{interleave} -t {cores} -R "{read_group}" {reference} {reads} ' \
                   '| samtools view -S -b - > {bam}' \
                   .format(cores=cores,
                       read_group=read_group,
-                      fastq_read1=fastq_read1_in,
-                      fastq_read2=fastq_read2_in,
+                      interleave=interleave,
+                      reads=reads,
                       reference=self.reference,
                       bam=bam_out)
-        run_stage(self.state, 'align_bwa', command)
- 
+        command, qc_outputs = self.feed_alignment(command, inputs, bam_out, sample)
+        run_stage(self.state, 'align_bwa', command,
+            inputs=[fastq_read1_in, fastq_read2_in], outputs=[bam_out] + qc_outputs,
+            extra_cores=self.reader_cores(len(inputs)))
+
+
+    @runs_stage('align_bwa')
+    def align_sort_bwa(self, inputs, bam_out, sample):
+        '''Align the paired end fastq files to the reference genome using bwa,
+        sorting and indexing the alignments as they are streamed out of bwa'''
+        fastq_read1_in, fastq_read2_in = inputs
+        read_group = self.state.config.get_read_group(sample)
+        cores = self.state.config.get_stage_option('align_bwa', 'cores')
+        # Memory for sorting in GB, shared between the sorting threads
+        sort_mem = self.state.config.get_optional_stage_option('align_bwa', 'sort_mem', 4)
+        sort_mem_per_thread = max(int(sort_mem) * MEGABYTES_IN_GIGABYTE // int(cores), 1)
+        tmp = stage_tmp_dir(self.state.config, 'align_bwa',
+            self.state.config.get_option('tmp'))
+        tmp_prefix = os.path.join(tmp, '{}.{}'.format(sample, os.path.basename(bam_out)))
+        # bwa reads the fastq files, or is fed them (see aligner_reads)
+        interleave, reads = self.aligner_reads(inputs)
+        # samtools sort writes the index alongside the bam file when given
+        # --write-index and the bam##idx##index output syntax
+        command = 'bwa mem{interleave} -t {cores} -R "{read_group}" {reference} {reads} ' \
+                  '| samtools sort -@ {cores} -m {sort_mem}M -T {tmp_prefix}{format} ' \
+                  '--write-index -o {bam}##idx##{index} -' \
+                  .format(cores=cores,
+                      read_group=read_group,
+                      interleave=interleave,
+                      reads=reads,
+                      reference=self.reference,
+                      sort_mem=sort_mem_per_thread,
+                      tmp_prefix=tmp_prefix,
+                      format=self.output_format(bam_out),
+                      bam=bam_out,
+                      index=alignment_index(bam_out))
+        command, qc_outputs = self.feed_alignment(command, inputs, bam_out, sample)
+        run_stage(self.state, 'align_bwa', command,
+            inputs=[fastq_read1_in, fastq_read2_in],
+            outputs=[bam_out, alignment_index(bam_out)] + qc_outputs,
+            extra_cores=self.reader_cores(len(inputs)))
+
+
+    def split_fastqs(self, inputs, chunks_out, sample, chunk_dir):
+        '''Split a pair of fastq files into chunks of a fixed number of reads'''
+        fastq_read1_in, fastq_read2_in = inputs
+        # Number of reads per chunk, each fastq record spans 4 lines
+        chunk_size = self.state.config.get_stage_option('align_bwa', 'chunk_size')
+        self.make_dir(chunk_dir)
+        # Remove chunks left over from a previous run, they may have been
+        # made with a different chunk size
+        commands = ['rm -f {dir}/*.fastq.gz'.format(dir=chunk_dir)]
+        for read, fastq_in in [('R1', fastq_read1_in), ('R2', fastq_read2_in)]:
+            commands.append(self.read_fastqs([fastq_in], "split -l {lines} -d -a 4 " \
+                "--additional-suffix=_{read}.fastq.gz --filter='gzip -1 > $FILE' " \
+                "- {dir}/chunk" \
+                .format(lines=4 * int(chunk_size), read=read, dir=chunk_dir),
+                os.path.join(chunk_dir, read)))
+        command = ' && '.join(commands)
+        # the files are read one after the other
+        run_stage(self.state, 'split_fastqs', command, extra_cores=self.reader_cores(1))
+
+
+    def merge_alignment_chunks(self, bams_in, bam_out):
+        '''Concatenate the unsorted bam files of the chunks of a sample'''
+        command = 'samtools cat -o {bam_out} {bams}' \
+                  .format(bam_out=bam_out, bams=' '.join(sorted(bams_in)))
+        run_stage(self.state, 'merge_alignment_chunks', command,
+            inputs=sorted(bams_in), outputs=[bam_out])
+
+
+    @runs_stage('merge_alignment_chunks')
+    def merge_sorted_alignment_chunks(self, bams_in, bam_out):
+        '''Merge the sorted bam files of the chunks of a sample, and index
+        the result'''
+        cores = self.state.config.get_stage_option('merge_alignment_chunks', 'cores')
+        command = 'samtools merge -f -@ {cores}{format} --write-index {bam_out}##idx##{index} {bams}' \
+                  .format(cores=cores, format=self.output_format(bam_out), bam_out=bam_out,
+                          index=alignment_index(bam_out), bams=' '.join(sorted(bams_in)))
+        run_stage(self.state, 'merge_alignment_chunks', command,
+            inputs=sorted(bams_in), outputs=[bam_out, alignment_index(bam_out)])
+
 
     def bamtools_stats(self, bam_in, stats_out):
         '''Generate alignment stats with bamtools'''
-        command = 'bamtools stats -in {bam} > {stats}' \
-                  .format(bam=bam_in, stats=stats_out)
-        run_stage(self.state, 'bamtools_stats', command)
+        if is_cram(bam_in):
+            # bamtools only reads BAM, which is streamed to it
+            command = 'samtools view -u{ref} {bam} | bamtools stats > {stats}' \
+                      .format(ref=self.reference_option(bam_in), bam=bam_in, stats=stats_out)
+        else:
+            command = 'bamtools stats -in {bam} > {stats}' \
+                      .format(bam=bam_in, stats=stats_out)
+        run_stage(self.state, 'bamtools_stats', command,
+            inputs=[bam_in], outputs=[stats_out])
 
 
     def extract_genes_bedtools(self, bam_in, bam_out):
         '''Extract MMR genes from the sorted BAM file'''
         bed_file = self.state.config.get_stage_option('extract_genes_bedtools', 'bed') 
-        command = 'bedtools intersect -abam {bam_in} -b {bed_file} > {bam_out}' \
-                  .format(bam_in=bam_in, bed_file=bed_file, bam_out=bam_out)
-        run_stage(self.state, 'extract_genes_bedtools', command)
+        if is_cram(bam_in):
+            # bedtools only reads BAM, which is streamed to it
+            command = 'samtools view -u{ref} {bam_in} | ' \
+                      'bedtools intersect -abam stdin -b {bed_file} > {bam_out}' \
+                      .format(ref=self.reference_option(bam_in), bam_in=bam_in,
+                              bed_file=bed_file, bam_out=bam_out)
+        else:
+            command = 'bedtools intersect -abam {bam_in} -b {bed_file} > {bam_out}' \
+                      .format(bam_in=bam_in, bed_file=bed_file, bam_out=bam_out)
+        run_stage(self.state, 'extract_genes_bedtools', command,
+            inputs=[bam_in, bed_file], outputs=[bam_out])
 
 
     def extract_chromosomes_samtools(self, bam_in, bam_out):
         '''Extract selected chomosomes from the bam files'''
-        command = 'samtools view -h -b {bam_in} chr2 chr3 chr7 > {bam_out}' \
-                  .format(bam_in=bam_in, bam_out=bam_out)
-        run_stage(self.state, 'extract_chromosomes_samtools', command)
+        chromosomes = self.get_extract_chromosomes()
+        command = 'samtools view -h -b{ref} {bam_in} {chromosomes} > {bam_out}' \
+                  .format(ref=self.reference_option(bam_in), bam_in=bam_in,
+                          chromosomes=' '.join(chromosomes), bam_out=bam_out)
+        run_stage(self.state, 'extract_chromosomes_samtools', command,
+            inputs=[bam_in], outputs=[bam_out])
+
+    def get_extract_chromosomes(self):
+        '''The chromosomes to extract from the bam files'''
+        return self.state.config.get_optional_stage_option(
+            'extract_chromosomes_samtools', 'chromosomes', DEFAULT_EXTRACT_CHROMOSOMES)
+
+
+    def fan_out_alignment(self, bam_in, outputs):
+        '''Extract the discordant alignments, the split-read alignments and
+        the selected chromosomes, and generate alignment stats, all from a
+        single pass over the bam file'''
+        discordants_out, splitters_out, chroms_out, stats_out = outputs
+        chromosomes = self.get_extract_chromosomes()
+        # Keep the header and the alignments on the selected chromosomes
+        chroms_filter = ' || '.join(['/^@/'] +
+            ['$3 == "{}"'.format(chrom) for chrom in chromosomes])
+        # The SAM text is decompressed once and copied with tee to a named
+        # pipe for each extraction, and the stats are computed from the copy
+        # of the stream which comes out of tee. sh has no pipefail, so the
+        # status of each command before the end of a pipe is kept in a file.
+        command = \
+        '''
+fifos=$(mktemp -d {bam_out_prefix}.fan_out.XXXXXX)
+mkfifo $fifos/discordants $fifos/splitters $fifos/chroms
+samtools view -S -b -F 1294 $fifos/discordants > {discordants} &
+discordants_pid=$!
+(extractSplitReads_BwaMem -i $fifos/splitters; echo $? > $fifos/split_reads.status) | samtools view -Sb - > {splitters} &
+splitters_pid=$!
+(awk '{chroms_filter}' $fifos/chroms; echo $? > $fifos/filter.status) | samtools view -Sb - > {chroms} &
+chroms_pid=$!
+(samtools view -h{ref} {bam}; echo $? > $fifos/view.status) | (tee $fifos/discordants $fifos/splitters $fifos/chroms; echo $? > $fifos/tee.status) | (samtools view -S -u -; echo $? > $fifos/stats_input.status) | bamtools stats > {stats}
+status=$?
+wait $discordants_pid || status=1
+wait $splitters_pid || status=1
+wait $chroms_pid || status=1
+for part in split_reads filter view tee stats_input; do
+    [ "$(cat $fifos/$part.status)" = 0 ] || status=1
+done
+rm -rf $fifos
+exit $status
+        '''.format(bam_out_prefix=os.path.splitext(chroms_out)[0], discordants=discordants_out,
+                   splitters=splitters_out, chroms_filter=chroms_filter,
+                   chroms=chroms_out, ref=self.reference_option(bam_in), bam=bam_in,
+                   stats=stats_out)
+        run_stage(self.state, 'fan_out_alignment', command,
+            inputs=[bam_in], outputs=outputs)
 
 
     #def alignment_coverage_gatk(self, inputs, summary_out, output_prefix):
@@ -97,18 +422,22 @@ class Stages(object):
 
     def extract_discordant_alignments(self, bam_in, discordants_bam_out):
         '''Extract the discordant paired-end alignments using samtools'''
-        command = 'samtools view -b -F 1294 {input_bam} > {output_bam}' \
-                  .format(input_bam=bam_in, output_bam=discordants_bam_out)
-        run_stage(self.state, 'extract_discordant_alignments', command)
+        command = 'samtools view -b{ref} -F 1294 {input_bam} > {output_bam}' \
+                  .format(ref=self.reference_option(bam_in), input_bam=bam_in,
+                          output_bam=discordants_bam_out)
+        run_stage(self.state, 'extract_discordant_alignments', command,
+            inputs=[bam_in], outputs=[discordants_bam_out])
 
 
     def extract_split_read_alignments(self, bam_in, splitters_bam_out):
         '''Extract the split-read alignments using samtools'''
-        command = ('samtools view -h {input_bam} | ' \
+        command = ('samtools view -h{ref} {input_bam} | ' \
                    'extractSplitReads_BwaMem -i stdin | ' \
                    'samtools view -Sb - > {output_bam}' 
-                   .format(input_bam=bam_in, output_bam=splitters_bam_out))
-        run_stage(self.state, 'extract_split_read_alignments', command)
+                   .format(ref=self.reference_option(bam_in), input_bam=bam_in,
+                           output_bam=splitters_bam_out))
+        run_stage(self.state, 'extract_split_read_alignments', command,
+            inputs=[bam_in], outputs=[splitters_bam_out])
 
     # Samtools annoyingly takes the prefix of the output bam name as its argument.
     # So we pass this as an extra argument. However Ruffus needs to know the full name
@@ -117,19 +446,33 @@ class Stages(object):
         '''Sort the reads in a bam file using samtools'''
         command = 'samtools sort {input_bam} {output_bam_prefix}' \
                   .format(input_bam=bam_in, output_bam_prefix=sorted_bam_prefix)
-        run_stage(self.state, 'sort_bam', command)
+        run_stage(self.state, 'sort_bam', command,
+            inputs=[bam_in], outputs=[sorted_bam_out])
 
     def sort_bam_sambamba(self, bam_in, sorted_bam_out):
         '''Sort the reads in a bam file using sambamba'''
         cores = self.state.config.get_stage_option('sort_bam_sambamba', 'cores')
-        # Get the tmp directory
-        tmp = self.state.config.get_option('tmp') 
+        # Get the tmp directory, which is the job's scratch directory if
+        # the stage has one
+        tmp = stage_tmp_dir(self.state.config, 'sort_bam_sambamba',
+            self.state.config.get_option('tmp'))
         # Get the amount of memory requested for the job
         mem = int(self.state.config.get_stage_option('sort_bam_sambamba', 'mem'))
         mem_limit = max(mem - 4, 1)
-        command = 'sambamba sort --nthreads={cores} --memory-limit={mem}GB --tmpdir={tmp} --out={output_bam} {input_bam}' \
-                  .format(cores=cores, mem=mem_limit, tmp=tmp, input_bam=bam_in, output_bam=sorted_bam_out)
-        run_stage(self.state, 'sort_bam_sambamba', command)
+        if is_cram(sorted_bam_out):
+            # sambamba can't write CRAM, samtools sort is used instead, with
+            # the same memory per thread
+            tmp_prefix = os.path.join(tmp, os.path.basename(sorted_bam_out))
+            mem_per_thread = max(mem_limit * MEGABYTES_IN_GIGABYTE // int(cores), 1)
+            command = 'samtools sort -@ {cores} -m {mem}M -T {tmp_prefix}{format} -o {output_bam} {input_bam}' \
+                      .format(cores=cores, mem=mem_per_thread, tmp_prefix=tmp_prefix,
+                              format=self.output_format(sorted_bam_out),
+                              input_bam=bam_in, output_bam=sorted_bam_out)
+        else:
+            command = 'sambamba sort --nthreads={cores} --memory-limit={mem}GB --tmpdir={tmp} --out={output_bam} {input_bam}' \
+                      .format(cores=cores, mem=mem_limit, tmp=tmp, input_bam=bam_in, output_bam=sorted_bam_out)
+        run_stage(self.state, 'sort_bam_sambamba', command,
+            inputs=[bam_in], outputs=[sorted_bam_out])
 
 
     def structural_variants_lumpy(self, inputs, vcf_out):
@@ -139,7 +482,11 @@ class Stages(object):
                   '-D {discordants_bam} -o {vcf}' \
                   .format(sample_bam=sample_bam, splitters_bam=splitters_bam,
                           discordants_bam=discordants_bam, vcf=vcf_out)
-        run_stage(self.state, 'structural_variants_lumpy', command)
+        if is_cram(sample_bam):
+            # lumpyexpress reads CRAM with the reference
+            command += ' -R {}'.format(self.reference)
+        run_stage(self.state, 'structural_variants_lumpy', command,
+            inputs=[sample_bam, splitters_bam, discordants_bam], outputs=[vcf_out])
 
 
     def genotype_svtyper(self, inputs, vcf_out):
@@ -149,31 +496,83 @@ class Stages(object):
                   '-i {vcf_in} -o {vcf_out}' \
                   .format(sample_bam=sample_bam, splitters_bam=splitters_bam,
                           vcf_in=vcf_in, vcf_out=vcf_out)
-        run_stage(self.state, 'genotype_svtyper', command)
+        run_stage(self.state, 'genotype_svtyper', command,
+            inputs=[vcf_in, sample_bam, splitters_bam], outputs=[vcf_out])
 
 
     def index_bam(self, bam_in, index_out):
         '''Index a bam file with samtools'''
         command = 'samtools index {bam}'.format(bam=bam_in)
-        run_stage(self.state, 'index_bam', command)
+        run_stage(self.state, 'index_bam', command,
+            inputs=[bam_in], outputs=[index_out])
+
+
+    @runs_stage('index_bam')
+    def check_index(self, bam_in, index_out):
+        '''Index a bam file with samtools, unless the index was already
+        written when the bam file was made'''
+        if not os.path.exists(index_out):
+            self.index_bam(bam_in, index_out)
 
 
     def structural_variants_socrates(self, bam_in, variants_out, sample_dir):
         '''Call structural variants with Socrates'''
+        output_dir = os.path.join(sample_dir, 'socrates')
+        self.make_dir(output_dir)
+        if is_cram(bam_in):
+            # Socrates only reads BAM, and names its results after the BAM
+            # file, so the CRAM file is converted to {sample}.sorted.bam
+            # next to its working files while it runs
+            work_dir = stage_tmp_dir(self.state.config, 'structural_variants_socrates', output_dir)
+            bam = os.path.join(work_dir, os.path.basename(bam_in)[:-len('.cram')] + '.bam')
+            command = 'samtools view -b{ref} -o {bam} {cram} || exit $?\n' \
+                      .format(ref=self.reference_option(bam_in), bam=bam, cram=bam_in) + \
+                      self.socrates_command(output_dir, bam) + \
+                      'rm -f {bam}\n'.format(bam=bam)
+        else:
+            command = self.socrates_command(output_dir, bam_in)
+        run_stage(self.state, 'structural_variants_socrates', command)
+
+    @runs_stage('structural_variants_socrates')
+    def structural_variants_socrates_shard(self, bam_in, variants_out, shard_bam, region):
+        '''Call structural variants with Socrates in a single region'''
+        output_dir = os.path.dirname(shard_bam)
+        self.make_dir(output_dir)
+        # The region's reads are only needed while Socrates runs
+        shard_bam = os.path.join(stage_tmp_dir(self.state.config,
+            'structural_variants_socrates', output_dir), os.path.basename(shard_bam))
+        command = 'samtools view -b{ref} {bam} {region} > {shard_bam} || exit $?\n' \
+                  .format(ref=self.reference_option(bam_in), bam=bam_in, region=region,
+                          shard_bam=shard_bam) + \
+                  self.socrates_command(output_dir, shard_bam) + \
+                  'rm -f {shard_bam}\n'.format(shard_bam=shard_bam)
+        run_stage(self.state, 'structural_variants_socrates', command)
+
+    def socrates_command(self, output_dir, bam_in):
+        '''The commands to run Socrates on a bam file, leaving its results
+        in output_dir. With the scratch option Socrates (and bowtie2) work
+        in the job's scratch directory, and only the results are copied to
+        output_dir.'''
         threads = self.state.config.get_stage_option('structural_variants_socrates', 'cores') 
         # jvm_mem is in gb
         jvm_mem = self.state.config.get_stage_option('structural_variants_socrates', 'jvm_mem') 
-        bowtie2_ref_dir = self.state.config.get_stage_option('structural_variants_socrates', 'bowtie2_ref_dir') 
-        output_dir = os.path.join(sample_dir, 'socrates')
-        safe_make_dir(output_dir)
+        bowtie2_ref_dir = self.bowtie2_index()
+        work_dir = stage_tmp_dir(self.state.config, 'structural_variants_socrates', output_dir)
         command = \
         '''
-cd {output_dir}
-export _JAVA_OPTIONS='-Djava.io.tmpdir={output_dir}'
-Socrates all -t {threads} --bowtie2_threads {threads} --bowtie2_db {bowtie2_ref_dir} --jvm_memory {jvm_mem}g {bam}
-        '''.format(output_dir=output_dir, threads=threads, bowtie2_ref_dir=bowtie2_ref_dir, jvm_mem=jvm_mem, bam=bam_in)
-        run_stage(self.state, 'structural_variants_socrates', command)
-
+cd {work_dir}
+export _JAVA_OPTIONS="-Djava.io.tmpdir={work_dir}"
+Socrates all -t {threads} --bowtie2_threads {threads} --bowtie2_db {bowtie2_ref_dir} --jvm_memory {jvm_mem}g {bam} || exit $?
+'''.format(work_dir=work_dir, threads=threads, bowtie2_ref_dir=bowtie2_ref_dir, jvm_mem=jvm_mem, bam=bam_in)
+        if work_dir != output_dir:
+            command += \
+                'for results in results_Socrates_*; do ' \
+                'cp $results {dir}/$results.crpipe_part && ' \
+                'mv -f {dir}/$results.crpipe_part {dir}/$results || exit 1; done\n' \
+                .format(dir=output_dir)
+        return command
+
+    @runs_stage('structural_variants_delly')
     def deletions_delly(self, bams_in, vcf_out):
         '''Call deletions with delly'''
         bams_args = ' '.join(bams_in)
@@ -181,8 +580,10 @@ Socrates all -t {threads} --bowtie2_threads {threads} --bowtie2_db {bowtie2_ref_
         exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
         command = 'OMP_NUM_THREADS={threads} delly -t DEL -x {exclude} -o {vcf_out} -g {reference} {bams}' \
             .format(threads=threads, exclude=exclude, vcf_out=vcf_out, reference=self.reference, bams=bams_args)
-        run_stage(self.state, 'structural_variants_delly', command)
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=list(bams_in) + [exclude], outputs=[vcf_out])
 
+    @runs_stage('structural_variants_delly')
     def duplications_delly(self, bams_in, vcf_out):
         '''Call duplicaitons with delly'''
         bams_args = ' '.join(bams_in)
@@ -190,8 +591,10 @@ Socrates all -t {threads} --bowtie2_threads {threads} --bowtie2_db {bowtie2_ref_
         exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
         command = 'OMP_NUM_THREADS={threads} delly -t DUP -x {exclude} -o {vcf_out} -g {reference} {bams}' \
             .format(threads=threads, exclude=exclude, vcf_out=vcf_out, reference=self.reference, bams=bams_args)
-        run_stage(self.state, 'structural_variants_delly', command)
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=list(bams_in) + [exclude], outputs=[vcf_out])
 
+    @runs_stage('structural_variants_delly')
     def inversions_delly(self, bams_in, vcf_out):
         '''Call inversions with delly'''
         bams_args = ' '.join(bams_in)
@@ -199,8 +602,10 @@ Socrates all -t {threads} --bowtie2_threads {threads} --bowtie2_db {bowtie2_ref_
         exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
         command = 'OMP_NUM_THREADS={threads} delly -t INV -x {exclude} -o {vcf_out} -g {reference} {bams}' \
             .format(threads=threads, exclude=exclude, vcf_out=vcf_out, reference=self.reference, bams=bams_args)
-        run_stage(self.state, 'structural_variants_delly', command)
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=list(bams_in) + [exclude], outputs=[vcf_out])
 
+    @runs_stage('structural_variants_delly')
     def translocations_delly(self, bams_in, vcf_out):
         '''Call translocatins with delly'''
         bams_args = ' '.join(bams_in)
@@ -208,7 +613,131 @@ Socrates all -t {threads} --bowtie2_threads {threads} --bowtie2_db {bowtie2_ref_
         exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
         command = 'OMP_NUM_THREADS={threads} delly -t TRA -x {exclude} -o {vcf_out} -g {reference} {bams}' \
             .format(threads=threads, exclude=exclude, vcf_out=vcf_out, reference=self.reference, bams=bams_args)
-        run_stage(self.state, 'structural_variants_delly', command)
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=list(bams_in) + [exclude], outputs=[vcf_out])
+
+    @runs_stage('structural_variants_delly')
+    def structural_variants_delly_shard(self, bams_in, vcf_out, sv_type, region):
+        '''Call structural variants of one type with delly in a single region'''
+        bams_args = ' '.join(bams_in)
+        threads = self.state.config.get_stage_option('structural_variants_delly', 'cores') 
+        exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
+        self.make_dir(os.path.dirname(vcf_out))
+        # delly can't be restricted to a region, instead everything outside
+        # the region is added to the excluded regions
+        region_exclude = '{}.exclude.tsv'.format(os.path.splitext(vcf_out)[0])
+        self.write_region_exclude(exclude, region_exclude, region)
+        command = 'OMP_NUM_THREADS={threads} delly -t {sv_type} -x {exclude} -o {vcf_out} -g {reference} {bams}' \
+            .format(threads=threads, sv_type=sv_type, exclude=region_exclude, vcf_out=vcf_out, reference=self.reference, bams=bams_args)
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=list(bams_in) + [region_exclude], outputs=[vcf_out])
+
+    @runs_stage('structural_variants_delly')
+    def structural_variants_delly_sample(self, bam_in, bcf_out, sv_type):
+        '''Discover structural variants of one type with delly in a single
+        sample, for incremental calling over the cohort'''
+        threads = self.state.config.get_stage_option('structural_variants_delly', 'cores') 
+        exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
+        command = 'OMP_NUM_THREADS={threads} delly call -t {sv_type} -x {exclude} -o {bcf_out} -g {reference} {bam}' \
+            .format(threads=threads, sv_type=sv_type, exclude=exclude, bcf_out=bcf_out,
+                    reference=self.reference, bam=bam_in)
+        # delly indexes the BCF file it writes
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=[bam_in, exclude], outputs=[bcf_out, bcf_out + '.csi'])
+
+    @runs_stage('merge_delly_calls')
+    def merge_delly_sites(self, bcfs_in, bcf_out, sv_type):
+        '''Merge the structural variants discovered in each sample into
+        a single set of sites for the cohort'''
+        bcfs_in = sorted(bcfs_in)
+        command = 'delly merge -t {sv_type} -o {bcf_out} {bcfs}' \
+                  .format(sv_type=sv_type, bcf_out=bcf_out, bcfs=' '.join(bcfs_in))
+        run_stage(self.state, 'merge_delly_calls', command,
+            inputs=bcfs_in, outputs=[bcf_out, bcf_out + '.csi'])
+
+    @runs_stage('structural_variants_delly')
+    def genotype_delly_sample(self, inputs, bcf_out, sv_type):
+        '''Genotype a single sample at the structural variant sites of the
+        cohort with delly'''
+        bam_in, sites = inputs
+        threads = self.state.config.get_stage_option('structural_variants_delly', 'cores') 
+        exclude = self.state.config.get_stage_option('structural_variants_delly', 'exclude') 
+        command = 'OMP_NUM_THREADS={threads} delly call -t {sv_type} -v {sites} -x {exclude} -o {bcf_out} -g {reference} {bam}' \
+            .format(threads=threads, sv_type=sv_type, sites=sites, exclude=exclude,
+                    bcf_out=bcf_out, reference=self.reference, bam=bam_in)
+        run_stage(self.state, 'structural_variants_delly', command,
+            inputs=[bam_in, sites, exclude], outputs=[bcf_out, bcf_out + '.csi'])
+
+    def merge_delly_calls(self, bcfs_in, vcf_out):
+        '''Merge the delly genotypes of each sample into a single VCF file
+        for the cohort'''
+        bcfs_in = sorted(bcfs_in)
+        if len(bcfs_in) == 1:
+            # bcftools merge needs at least two files
+            command = 'bcftools view -O v -o {vcf_out} {bcf}' \
+                      .format(vcf_out=vcf_out, bcf=bcfs_in[0])
+        else:
+            # every sample is genotyped at the same sites, whose IDs match
+            command = 'bcftools merge -m id -O v -o {vcf_out} {bcfs}' \
+                      .format(vcf_out=vcf_out, bcfs=' '.join(bcfs_in))
+        run_stage(self.state, 'merge_delly_calls', command,
+            inputs=bcfs_in, outputs=[vcf_out])
+
+    def write_region_exclude(self, exclude_in, exclude_out, region):
+        '''Write a delly exclude file which excludes everything outside of
+        region, as well as everything excluded by exclude_in'''
+        chrom, start, end = parse_region(region)
+        with open(exclude_in) as excluded, open(exclude_out, 'w') as out:
+            for line in excluded:
+                out.write(line if line.endswith('\n') else line + '\n')
+            # delly exclude files use 0-based half open intervals
+            for name, length in read_fasta_index(self.reference + '.fai'):
+                if name != chrom:
+                    out.write('{}\t0\t{}\tscatter\n'.format(name, length))
+                    continue
+                if start is not None and start > 1:
+                    out.write('{}\t0\t{}\tscatter\n'.format(name, start - 1))
+                if end is not None and end < length:
+                    out.write('{}\t{}\t{}\tscatter\n'.format(name, end, length))
+
+    @runs_stage('structural_variants_lumpy')
+    def structural_variants_lumpy_shard(self, inputs, vcf_out, region):
+        '''Call structural variants with lumpy in a single region'''
+        sample_bam, [splitters_bam, discordants_bam] = inputs
+        self.make_dir(os.path.dirname(vcf_out))
+        shard_prefix = os.path.splitext(vcf_out)[0]
+        shard_bams = ['{}.{}.bam'.format(shard_prefix, kind) for kind in
+                      ['sample', 'splitters', 'discordants']]
+        commands = ['samtools view -b{ref} {bam} {region} > {shard_bam}' \
+                    .format(ref=self.reference_option(bam), bam=bam, region=region,
+                            shard_bam=shard_bam)
+                    for bam, shard_bam in
+                    zip([sample_bam, splitters_bam, discordants_bam], shard_bams)]
+        commands.append('lumpyexpress -B {} -S {} -D {} -o {}' \
+                        .format(shard_bams[0], shard_bams[1], shard_bams[2], vcf_out))
+        commands.append('rm -f {}'.format(' '.join(shard_bams)))
+        command = ' && '.join(commands)
+        run_stage(self.state, 'structural_variants_lumpy', command,
+            inputs=[sample_bam, splitters_bam, discordants_bam], outputs=[vcf_out])
+
+    @runs_stage('gather_shards')
+    def gather_vcfs(self, vcfs_in, vcf_out):
+        '''Concatenate the VCF files from the regions of a scattered stage
+        and sort the result'''
+        command = 'bcftools concat {vcfs} | bcftools sort -O v -o {vcf_out}' \
+                  .format(vcfs=' '.join(vcfs_in), vcf_out=vcf_out)
+        run_stage(self.state, 'gather_shards', command,
+            inputs=vcfs_in, outputs=[vcf_out])
+
+    @runs_stage('gather_shards')
+    def gather_socrates(self, results_in, results_out):
+        '''Concatenate the Socrates results from the regions of a scattered
+        stage and sort the result by the position of the first breakpoint'''
+        command = "(grep '^#' {first}; cat {results} | grep -v '^#' | sort -k1,1V) > {results_out}" \
+                  .format(first=results_in[0], results=' '.join(results_in),
+                          results_out=results_out)
+        run_stage(self.state, 'gather_shards', command,
+            inputs=results_in, outputs=[results_out])
 
     #def gustaf_mate_joining(self, inputs, fasta_out):
     #    '''Join both read pair fasta files using gustaf_mate_joining'''
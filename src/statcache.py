@@ -0,0 +1,186 @@
+'''
+A cache of the state of files, for checking whether pipeline jobs are up
+to date without a round trip to shared storage for every file.
+
+Ruffus decides whether a job needs to run by checking that each of its
+input and output files exists, then reading their modification times.
+With thousands of samples on a network filesystem these metadata calls
+dominate startup. With the "stat_cache" option, the pipeline answers
+these checks from a StatCache instead: the first time a file in a
+directory is asked about, the whole directory is listed in one scan, so
+files which don't exist cost nothing more, and each file which does is
+looked at no more than once. The directories which are known to exist
+(those which have been listed, and their subdirectories when scandir
+tells them apart) are remembered too, so that the stages can make their
+output directories without asking the filesystem again.
+
+Only the names of the files come from the directory scan: the
+modification time of each file which exists is still read with one stat,
+the first time it is asked about, because a directory listing on Linux
+does not include modification times (not even with scandir, which is
+used when available for the types of the entries).
+
+Entries are refreshed only when a job writes to the directory: run_stage
+forgets the directories of the outputs of each job it runs (or everything,
+for jobs which don't say what their outputs are).
+
+As in ruffus, an output which exists is only up to date if the job history
+of ruffus records that the job which made it finished, so the partial
+outputs of a pipeline which was killed (with Ctrl-C, or by the loss of a
+node or the walltime of the pipeline's own job) are made again. The
+history is read once, when the pipeline is built. The originate tasks
+(the FASTQ files and the reference) keep the check of ruffus.
+'''
+
+import os
+import threading
+from utils import file_names, safe_make_dir
+try:
+    from os import scandir
+except ImportError:
+    # The backport of scandir for Python 2, if it is installed
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class StatCache(object):
+    '''Modification times of files, read a directory at a time'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # directory -> {file name: modification time, or None if the file
+        # has not been looked at yet}
+        self.directories = {}
+        # directories which are known to exist
+        self.existing = set()
+        # the outputs of the jobs which ruffus has recorded as finished,
+        # or None if ruffus keeps no job history
+        self.history = None
+
+    def entries(self, directory):
+        with self.lock:
+            entries = self.directories.get(directory)
+        if entries is None:
+            names, subdirectories = list_directory(directory)
+            entries = dict.fromkeys(names or [])
+            with self.lock:
+                self.directories[directory] = entries
+                if names is not None:
+                    self.existing.add(directory)
+                    self.existing.update(os.path.join(directory, name)
+                                         for name in subdirectories)
+        return entries
+
+    def mtime(self, path):
+        '''The modification time of a file, or None if it does not exist'''
+        directory, name = os.path.split(os.path.abspath(path))
+        entries = self.entries(directory)
+        if name not in entries:
+            return None
+        mtime = entries[name]
+        if mtime is None:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # removed since the directory was scanned, or a broken link
+                entries.pop(name, None)
+                return None
+            entries[name] = mtime
+        return mtime
+
+    def make_dir(self, path):
+        '''Make a directory if it is not already known to exist'''
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.existing:
+                return
+        safe_make_dir(path)
+        with self.lock:
+            self.existing.add(path)
+            # the listing of the parent may be missing the new directory
+            self.directories.pop(os.path.dirname(path), None)
+
+    def invalidate(self, paths=None):
+        '''Forget the directories of files which a job has written, or every
+        directory if the files are not known'''
+        with self.lock:
+            if paths is None:
+                self.directories = {}
+                self.existing = set()
+                return
+            for path in paths:
+                self.directories.pop(os.path.dirname(os.path.abspath(path)), None)
+
+    def needs_update(self, *params):
+        '''Whether a ruffus job needs to run: if an output is missing, or an
+        input is newer than an output. For Task.check_if_uptodate.'''
+        inputs = file_names(params[0]) if params else []
+        outputs = file_names(params[1]) if len(params) > 1 else []
+        return check_times(inputs, outputs, self.mtime, self.history)
+
+
+def check_times(inputs, outputs, mtime, history=None):
+    '''(needs update, reason) for a job, as ruffus decides it, with the
+    modification time of each file (or None if it does not exist) given by
+    the mtime function, and the outputs of the jobs which finished given by
+    history (unless it is None)'''
+    if not outputs:
+        return True, 'No output files'
+    output_times = []
+    for path in outputs:
+        output_time = mtime(path)
+        if output_time is None:
+            return True, 'Missing file {}'.format(path)
+        output_times.append(output_time)
+    if history is not None:
+        for path in outputs:
+            if os.path.relpath(path) not in history:
+                return True, 'Uncheckpointed file {} (left over from a failed run?)'.format(path)
+    oldest_output = min(output_times)
+    for path in inputs:
+        input_time = mtime(path)
+        if input_time is None:
+            return True, 'Missing input file {}'.format(path)
+        if input_time > oldest_output:
+            return True, 'Input file {} is newer than the outputs'.format(path)
+    return False, 'Up to date'
+
+
+def job_history(options):
+    '''The outputs of the jobs which ruffus has recorded as finished,
+    relative to the working directory as ruffus records them, or None if
+    ruffus keeps no job history'''
+    from ruffus.ruffus_utility import CHECKSUM_HISTORY_TIMESTAMPS, \
+        get_default_checksum_level, open_job_history
+    if get_default_checksum_level() < CHECKSUM_HISTORY_TIMESTAMPS:
+        return None
+    history = open_job_history(getattr(options, 'history_file', None))
+    return set(os.path.relpath(path) for path in history.keys())
+
+
+def list_directory(directory):
+    '''The names in a directory and the names of its subdirectories, or
+    None and nothing if it does not exist. The subdirectories are only
+    known with scandir, which can tell them apart without a stat.'''
+    try:
+        if scandir is None:
+            return os.listdir(directory), []
+        names, subdirectories = [], []
+        for entry in scandir(directory):
+            names.append(entry.name)
+            try:
+                if entry.is_dir():
+                    subdirectories.append(entry.name)
+            except OSError:
+                pass
+        return names, subdirectories
+    except OSError:
+        return None, []
+
+
+def make_stat_cache(config):
+    '''The stat cache, or None if the configuration does not turn it on'''
+    if not config.get_optional_option('stat_cache', False):
+        return None
+    return StatCache()
@@ -3,9 +3,20 @@ Global state of the pipeline:
     - options: the command line arguments of the pipeline program
     - config: the parsed contents of the pipeline configuration file
     - logger: the concurrency friendly logging facility
-    - drmaa_session: the DRMAA session for running jobs on the cluster
+    - cache: the output cache, or None if it is not enabled
+    - engine: the job engine which runs commands locally or on the cluster
+      (it opens the DRMAA session when the first cluster job is submitted)
+    - rundb: the database of jobs run and the resources they used
+    - priorities: critical path priorities of the stages, or None if jobs
+      are not prioritised
+    - stat_cache: the cache of file states for up to date checks, or None
+      if it is not enabled
+    - cleanup: the cleanup of intermediate files, or None if there are no
+      cleanup rules
 '''
 
 from collections import namedtuple
 
-State = namedtuple("State", ["options", "config", "logger", "drmaa_session"])
+State = namedtuple("State", ["options", "config", "logger", "cache",
+                             "engine", "rundb", "priorities", "stat_cache",
+                             "cleanup"])
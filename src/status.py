@@ -0,0 +1,166 @@
+'''
+Fast status of the pipeline: which jobs are up to date and which would
+run, without building the ruffus pipeline and looking at every file.
+
+    crpipe status [--config pipeline.config] [--refresh] [--list]
+
+To find the jobs which need to run (as a dry run with -n does), ruffus
+builds the whole pipeline graph and looks at the modification time of
+every input and output file. With thousands of samples on a parallel
+filesystem this takes minutes. The status command uses two snapshots
+instead:
+    - the pipeline graph: the jobs of each stage with their input and
+      output files, saved in the file named by the graph_cache option
+      (default .crpipe_graph.json). It is rebuilt when the configuration
+      file, the sample manifest or the pipeline code change.
+    - the file states: the modification times of the files made by
+      successful jobs, which are recorded in the run database as the jobs
+      finish. Other files (such as the FASTQ files) are looked at many at
+      a time, and added to the snapshot.
+
+A job is up to date, as in ruffus, if all its outputs exist, none is
+older than its inputs, and none of its inputs will be made again by a
+job which is not up to date. Intermediate files removed by the cleanup
+count as they were when they were removed. Files changed outside the
+pipeline, and the jobs of stages whose inputs are found by wildcards (the
+chunks of a chunked alignment), are only noticed with --refresh, which
+rebuilds the graph and looks at every file again.
+
+Only this command uses the snapshots: dry runs (-n) and flowcharts still
+build the whole pipeline graph with ruffus.
+'''
+
+import os
+import json
+import hashlib
+import argparse
+from multiprocessing.pool import ThreadPool
+from config import Config, DEFAULT_CONFIG_FILE
+from rundb import RunDatabase, DEFAULT_RUN_DB, file_state
+
+
+# default name of the pipeline graph snapshot
+DEFAULT_GRAPH_CACHE = '.crpipe_graph.json'
+# Files are looked at by this many threads at once: each look is slow on
+# a parallel filesystem, but many can be in flight
+STAT_THREADS = 32
+# The pipeline code which decides the shape of the graph
+GRAPH_SOURCES = ['pipeline.py', 'stages.py']
+
+
+def graph_fingerprint(config):
+    '''A hash of everything the pipeline graph is built from'''
+    paths = [config.config_filename]
+    manifest = config.get_optional_option('manifest')
+    if manifest is not None:
+        paths.append(manifest)
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    paths.extend(os.path.join(source_dir, name) for name in GRAPH_SOURCES)
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as graph_file:
+            digest.update(graph_file.read())
+    return digest.hexdigest()
+
+
+def build_graph(config):
+    '''The stages of the pipeline, in an order in which they can run, each
+    with the inputs and outputs of its jobs'''
+    # ruffus and the stages are only loaded when the graph is rebuilt
+    from pipeline import make_pipeline, pipeline_jobs
+    from state import State
+    state = State(**dict((field, None) for field in State._fields))._replace(config=config)
+    pipeline = make_pipeline(state, name='crpipe_status')
+    return [{'stage': stage, 'jobs': jobs} for stage, jobs in pipeline_jobs(pipeline)]
+
+
+def load_graph(config, path, refresh=False):
+    '''The pipeline graph from its snapshot, rebuilding the snapshot if it
+    is out of date'''
+    fingerprint = graph_fingerprint(config)
+    if not refresh and os.path.exists(path):
+        with open(path) as graph_file:
+            graph = json.load(graph_file)
+        if graph.get('fingerprint') == fingerprint:
+            return graph['stages']
+    stages = build_graph(config)
+    with open(path + '.tmp', 'w') as graph_file:
+        json.dump({'fingerprint': fingerprint, 'stages': stages}, graph_file)
+    os.rename(path + '.tmp', path)
+    return stages
+
+
+def file_states(paths, rundb, refresh=False):
+    '''path -> (modification time, size) of each file, taken from the run
+    database where possible. Files which exist but are not in the
+    snapshot are added to it.'''
+    states = {} if refresh else rundb.file_states()
+    unknown = [path for path in set(paths) if path not in states]
+    if unknown:
+        pool = ThreadPool(STAT_THREADS)
+        try:
+            found = dict(zip(unknown, pool.map(file_state, unknown)))
+        finally:
+            pool.close()
+        states.update(found)
+        rundb.record_files([path for path, state in found.items()
+                            if state[0] is not None])
+    # Intermediate files removed by the cleanup count as they were
+    for path, (mtime, _) in rundb.retired_files().items():
+        if path in states and states[path][0] is None:
+            states[path] = (mtime, None)
+    return states
+
+
+def pipeline_status(stages, states):
+    '''For each stage: (stage, number of jobs, jobs which would run)'''
+    # outputs of the jobs which would run
+    remade = set()
+    result = []
+    for stage in stages:
+        to_run = []
+        for inputs, outputs in stage['jobs']:
+            output_times = [states[path][0] for path in outputs]
+            input_times = [states[path][0] for path in inputs
+                           if states[path][0] is not None]
+            up_to_date = outputs and None not in output_times and \
+                not remade.intersection(inputs) and \
+                (not input_times or min(output_times) >= max(input_times))
+            if not up_to_date:
+                to_run.append(outputs)
+                remade.update(outputs)
+        result.append((stage['stage'], len(stage['jobs']), to_run))
+    return result
+
+
+def status_command(args):
+    '''Show which jobs of the pipeline would run: crpipe status'''
+    parser = argparse.ArgumentParser(prog='crpipe status',
+        description='Show which jobs of the pipeline are up to date')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG_FILE,
+        help='Pipeline configuration file in YAML format, defaults to {}' \
+            .format(DEFAULT_CONFIG_FILE))
+    parser.add_argument('--refresh', action='store_true',
+        help='Rebuild the pipeline graph and look at every file again')
+    parser.add_argument('--list', action='store_true',
+        help='List the outputs of each job which would run')
+    options = parser.parse_args(args)
+    config = Config(options.config)
+    config.validate()
+    rundb = RunDatabase(config.get_optional_option('run_db', DEFAULT_RUN_DB))
+    stages = load_graph(config,
+        config.get_optional_option('graph_cache', DEFAULT_GRAPH_CACHE),
+        options.refresh)
+    paths = [path for stage in stages for inputs, outputs in stage['jobs']
+             for path in inputs + outputs]
+    status = pipeline_status(stages, file_states(paths, rundb, options.refresh))
+    print('{:<36} {:>8} {:>8} {:>8}'.format('stage', 'jobs', 'done', 'to run'))
+    for stage, jobs, to_run in status:
+        print('{:<36} {:>8} {:>8} {:>8}'.format(stage, jobs, jobs - len(to_run),
+                                                len(to_run)))
+        if options.list:
+            for outputs in to_run:
+                print('    ' + ' '.join(outputs))
+    total = sum(jobs for _, jobs, _ in status)
+    waiting = sum(len(to_run) for _, _, to_run in status)
+    print('{} jobs, {} up to date, {} to run'.format(total, total - waiting, waiting))
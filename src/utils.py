@@ -3,8 +3,81 @@ Various utility functions that don't have a sensible home elsewhere
 '''
 
 import os
+import errno
 
 def safe_make_dir(path):
     '''Make a directory if it does not already exist'''
-    if not os.path.exists(path):
+    # One call rather than checking whether it exists first, which is
+    # another round trip on a network filesystem
+    try:
         os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def file_names(params):
+    '''The file names in the (possibly nested) parameters of a ruffus job'''
+    if isinstance(params, basestring):
+        return [params]
+    if isinstance(params, (list, tuple)):
+        return [name for param in params for name in file_names(param)]
+    return []
+
+
+def alignment_index(path):
+    '''The name of the index of a BAM or CRAM file'''
+    return path + ('.crai' if is_cram(path) else '.bai')
+
+
+def is_cram(path):
+    '''Whether an alignment file is CRAM rather than BAM'''
+    return path.endswith('.cram')
+
+
+def read_regions(regions):
+    '''Read a list of genomic regions in samtools syntax: chrom or
+    chrom:start-end. The regions are either given as a list, or as the
+    path of a file with one region per line, in samtools syntax or as
+    BED (chrom, start, end) columns.
+    '''
+    if not isinstance(regions, str):
+        return [str(region) for region in regions]
+    result = []
+    with open(regions) as regions_file:
+        for line in regions_file:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) >= 3:
+                # BED start coordinates are 0-based
+                result.append('{}:{}-{}'.format(fields[0], int(fields[1]) + 1,
+                    fields[2]))
+            else:
+                result.append(fields[0])
+    return result
+
+
+def parse_region(region):
+    '''Split a region in samtools syntax into (chrom, start, end).
+    Coordinates are 1-based and inclusive, start and end are None for a
+    whole chromosome.
+    '''
+    chrom, sep, interval = region.rpartition(':')
+    if sep and '-' in interval:
+        start, end = interval.split('-', 1)
+        return chrom, int(start.replace(',', '')), int(end.replace(',', ''))
+    return region, None, None
+
+
+def region_name(region):
+    '''A version of a region which is safe to use in file and task names'''
+    return region.replace(':', '_').replace('-', '_').replace(',', '')
+
+
+def read_fasta_index(fai_filename):
+    '''Read the (name, length) of each sequence in a samtools FASTA index'''
+    with open(fai_filename) as fai_file:
+        for line in fai_file:
+            fields = line.split('\t')
+            yield fields[0], int(fields[1])
@@ -0,0 +1,148 @@
+'''
+Watch mode: run the pipeline on samples as their FASTQ files arrive.
+
+    crpipe --watch [other options]
+
+The configuration option "watch" names either a directory, in which new
+SAMPLE_R1.fastq.gz and SAMPLE_R2.fastq.gz pairs appear, or a manifest
+file listing the paths of FASTQ files, one per line, which grows as
+samples arrive. The watch is checked every watch_interval seconds. A pair
+is ready when both files exist and have not changed size or modification
+time since the previous check, so files which are still being copied are
+left alone.
+
+Whenever new samples are ready, the per-sample stages are run on every
+sample seen so far (ruffus skips the ones which are up to date). The
+stages which combine the whole cohort (DELLY) are run every
+cohort_interval hours if that option is given, and always once the cohort
+is closed, which is signalled by creating the file named by the
+watch_close option (default: COHORT_CLOSED next to the watched files).
+The pipeline then finishes.
+
+Each batch is a separate, synchronous run of the pipeline, so FASTQ files
+which arrive while a batch is running wait for the whole batch to finish
+(including any cohort stages run with it) before their own run starts.
+Watch mode always runs jobs: it cannot be combined with --just_print,
+--flowchart or --touch_files_only.
+'''
+
+import os
+import re
+import glob
+import time
+import ruffus.cmdline as cmdline
+from pipeline import make_pipeline
+
+
+# Seconds between checks for new FASTQ files
+DEFAULT_WATCH_INTERVAL = 60
+# File which closes the cohort, next to the watched files
+DEFAULT_CLOSE_FILE = 'COHORT_CLOSED'
+# Read 1 files of pairs, as matched by the pipeline stages
+READ1_REGEX = re.compile('^(?P<sample>[a-zA-Z0-9]+)_R1.fastq.gz$')
+SECONDS_IN_HOUR = 3600.0
+
+
+class FastqWatcher(object):
+    '''Find the FASTQ pairs in a directory or manifest which have stopped
+    changing'''
+    def __init__(self, watch):
+        self.watch = watch
+        # path -> (size, mtime) at the previous check
+        self.previous = {}
+
+    def candidates(self):
+        '''All FASTQ files currently listed'''
+        if os.path.isdir(self.watch):
+            return glob.glob(os.path.join(self.watch, '*.fastq.gz'))
+        if not os.path.exists(self.watch):
+            return []
+        with open(self.watch) as manifest:
+            return [line.strip() for line in manifest
+                    if line.strip() and not line.startswith('#')]
+
+    def ready(self, stable_only=True):
+        '''The FASTQ files of the complete pairs which are ready. Without
+        stable_only, files which are still changing count as ready.'''
+        current = {}
+        for path in self.candidates():
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            current[path] = (info.st_size, info.st_mtime)
+        stable = set(path for path, stat in current.items()
+                     if self.previous.get(path) == stat or not stable_only)
+        self.previous = current
+        fastqs = []
+        for path in sorted(stable):
+            directory, name = os.path.split(path)
+            match = READ1_REGEX.match(name)
+            if match is None:
+                continue
+            read2 = os.path.join(directory, match.group('sample') + '_R2.fastq.gz')
+            if read2 in stable:
+                fastqs.extend([path, read2])
+        return fastqs
+
+
+def run_pipeline(pipeline, options):
+    '''Run one pipeline, honouring the command line options like
+    cmdline.run does for the whole program. Only called when jobs are run,
+    see main.parse_command_line.'''
+    options = cmdline.handle_verbose(options)
+    multithread = None
+    if options.use_threads and options.jobs and options.jobs > 1:
+        multithread = options.jobs
+    pipeline.run(multiprocess=options.jobs, multithread=multithread,
+                 verbose=options.verbose,
+                 verbose_abbreviated_path=options.verbose_abbreviated_path,
+                 history_file=options.history_file)
+
+
+def watch(state):
+    '''Run the pipeline on new samples as they arrive, until the cohort is
+    closed'''
+    config = state.config
+    watched = config.get_option('watch')
+    interval = config.get_optional_option('watch_interval', DEFAULT_WATCH_INTERVAL)
+    cohort_interval = config.get_optional_option('cohort_interval')
+    watch_dir = watched if os.path.isdir(watched) else os.path.dirname(watched)
+    close_file = config.get_optional_option('watch_close',
+        os.path.join(watch_dir, DEFAULT_CLOSE_FILE))
+    watcher = FastqWatcher(watched)
+    fastqs = []
+    last_cohort_run = time.time()
+    runs = 0
+    while True:
+        # Once the cohort is closed, all of its files are complete
+        closed = os.path.exists(close_file)
+        ready = watcher.ready(stable_only=not closed)
+        new_fastqs = [path for path in ready if path not in fastqs]
+        fastqs = sorted(set(fastqs) | set(new_fastqs))
+        run_cohort = closed or (cohort_interval is not None and
+            time.time() - last_cohort_run >= float(cohort_interval) * SECONDS_IN_HOUR)
+        if fastqs and (new_fastqs or run_cohort):
+            runs += 1
+            # New files have arrived since the last run
+            if state.stat_cache is not None:
+                state.stat_cache.invalidate()
+            state.logger.info('Watch: running {} on {} FASTQ files'.format(
+                'all stages' if run_cohort else 'the per-sample stages', len(fastqs)))
+            pipeline = make_pipeline(state, fastqs, name='crpipe_watch_{}'.format(runs),
+                                     cohort=run_cohort)
+            try:
+                run_pipeline(pipeline, state.options)
+                if state.cleanup is not None:
+                    state.cleanup.finish()
+            except Exception as err:
+                # A failed sample should not stop the others, it is tried
+                # again on the next run
+                if closed:
+                    raise
+                state.logger.info('Watch: pipeline run failed: {}'.format(err))
+            if run_cohort:
+                last_cohort_run = time.time()
+        if closed:
+            return
+        time.sleep(interval)